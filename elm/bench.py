@@ -0,0 +1,591 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+###########################################################################
+# ELM327-emulator
+# ELM327 Emulator for testing software interfacing OBDII via ELM327 adapter
+# https://github.com/Ircama/ELM327-emulator
+# (C) Ircama 2021 - CC-BY-NC-SA-4.0
+###########################################################################
+
+"""
+Benchmark of the request pipeline (handle_request + handle_response).
+
+Usage: python3 -m elm.bench [-h]
+
+Each workload is run in-process (Elm.query), over a pty and over a local
+TCP/IP socket; requests/s, p50/p99 latency and allocations per request
+are reported in JSON format, so that results of different versions can be
+compared (-c option). The emulator uses a virtual clock, so that the
+configured delays (e.g., ATZ) do not affect the measures.
+
+The -g option measures the overhead of the logging configured with debug
+messages filtered out by the handler level (e.g., "loglevel" command)
+with respect to disabled logging, and fails if it exceeds the target.
+"""
+
+import sys
+import os
+import time
+import json
+import socket
+import select
+import logging
+import argparse
+import platform
+import io
+import re
+import subprocess
+import tempfile
+import tracemalloc
+from .elm import Elm, VirtualClock
+from .__version__ import __version__
+
+BENCH_REQUESTS = 20000  # default number of timed requests per workload
+ALLOC_REQUESTS = 2000  # max number of requests measured with tracemalloc
+IO_TIMEOUT = 5  # seconds - max time to wait for the prompt (pty and TCP/IP)
+PROMPT = b">"
+TRANSPORTS = ['inprocess', 'pty', 'tcp']
+LOG_OVERHEAD_WORKLOAD = 'car_mode01'
+LOG_OVERHEAD_TARGET = 5.0  # max overhead (%) of the filtered debug logging
+LOG_OVERHEAD_RUNS = 5  # the fastest run of each configuration is compared
+IMPORT_TIME_TARGET = 100.0  # max import time (ms) of the 'elm -b' cold start
+IMPORT_TIME_RUNS = 3  # the fastest run is compared
+IMPORT_TIME_TOP = 5  # number of most expensive modules reported
+
+"""
+Workloads: scenario, setup requests (not measured) and requests repeated
+in a loop up to the number of timed requests.
+"""
+WORKLOADS = {
+    'car_mode01': {
+        'descr': "Mode 01 polling in the 'car' scenario",
+        'scenario': 'car',
+        'setup': ['ATE0', 'ATH1'],
+        'requests': ['0100', '0101', '0104', '0105', '010B', '010C', '010D',
+                     '010F', '0110', '0111', '011F', '0120']
+    },
+    'at_init': {
+        'descr': "AT initialization sequence",
+        'scenario': 'default',
+        'setup': [],
+        'requests': ['ATZ', 'ATE0', 'ATL0', 'ATS0', 'ATH1', 'ATSP0', 'ATDPN',
+                     'ATRV', 'ATI', 'AT@1', 'ATAT1', 'ATST32']
+    },
+    'unknown_pids': {
+        'descr': "Unknown requests in the 'car' scenario",
+        'scenario': 'car',
+        'setup': ['ATE0'],
+        'requests': ['AB%04X' % i for i in range(256)]
+    },
+    'isotp_multiframe': {
+        'descr': "ISO-TP multiframe requests (IsoTpMultiframe task)",
+        'scenario': 'car',
+        'setup': ['ATE0', 'ATCAF0', 'ATH1', 'ATSH7E5'],
+        'requests': ['10 14 2E F1 90 57 50 30', '21 5A 5A 5A 39 39 5A 54',
+                     '22 53 33 39 30 30 30 30']
+    },
+    'mt05_read_mem': {
+        'descr': "Memory reads of the mt05 plugins (ECU 11F1)",
+        'scenario': 'default',
+        'setup': ['ATE0', 'ATH1', 'ATSH8111F1', '81'],
+        'requests': ['2300%04X%02X' % (i * 0x40, 4 + i % 12)
+                     for i in range(64)]
+    },
+}
+
+
+def percentile(latencies, q):
+    """
+    Return a percentile of a sorted list of latencies.
+    :param latencies: sorted list of values
+    :param q: percentile (0 to 1)
+    :return: value of the percentile
+    """
+    if not latencies:
+        return None
+    return latencies[min(len(latencies) - 1,
+                         int(round(q * (len(latencies) - 1))))]
+
+
+def request_list(workload, n):
+    """
+    Return the list of n requests of a workload, repeating its requests.
+    :param workload: WORKLOADS item
+    :param n: number of requests
+    :return: list of request strings
+    """
+    requests = workload['requests']
+    return [requests[i % len(requests)] for i in range(n)]
+
+
+def new_emulator(workload, **kwargs):
+    """
+    Create an emulator with virtual clock configured for a workload.
+    :param workload: WORKLOADS item
+    :param kwargs: additional arguments of the Elm class
+    :return: Elm object
+    """
+    emulator = Elm(batch_mode=True, clock=VirtualClock(), **kwargs)
+    emulator.set_sorted_obd_msg(workload['scenario'])
+    return emulator
+
+
+def summary(name, transport, workload, latencies, elapsed, n):
+    """
+    Return the result of a run of a workload.
+    :param name: workload name
+    :param transport: 'inprocess', 'pty' or 'tcp'
+    :param workload: WORKLOADS item
+    :param latencies: list of latencies of each answer (seconds)
+    :param elapsed: overall time of the run (seconds)
+    :param n: number of requests
+    :return: result dictionary
+    """
+    latencies = sorted(latencies)
+    return {
+        'workload': name,
+        'transport': transport,
+        'scenario': workload['scenario'],
+        'requests': n,
+        'answers': len(latencies),
+        'seconds': round(elapsed, 6),
+        'requests_per_s': round(n / elapsed, 1) if elapsed else None,
+        'p50_us': round(percentile(latencies, 0.50) * 1e6, 2),
+        'p99_us': round(percentile(latencies, 0.99) * 1e6, 2),
+    }
+
+
+def bench_inprocess(name, workload, n):
+    """
+    Run a workload in-process through Elm.query().
+    Allocations are measured in a separate run with tracemalloc.
+    :return: result dictionary
+    """
+    emulator = new_emulator(workload)
+    emulator.query_many(workload['setup'])
+    requests = request_list(workload, n)
+    query = emulator.query
+    clock = time.perf_counter
+    latencies = []
+    append = latencies.append
+    start = time.perf_counter()
+    for cmd in requests:
+        t = clock()
+        query(cmd)
+        append(clock() - t)
+    result = summary(name, 'inprocess', workload, latencies,
+                     time.perf_counter() - start, n)
+
+    # Allocation measures (peak of the memory allocated by each request
+    # and blocks still allocated after the run)
+    requests = requests[:ALLOC_REQUESTS]
+    peak = 0
+    tracemalloc.start()
+    blocks = sys.getallocatedblocks()
+    for cmd in requests:
+        if hasattr(tracemalloc, 'reset_peak'):  # Python >= 3.9
+            tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        query(cmd)
+        peak += tracemalloc.get_traced_memory()[1] - current
+    blocks = sys.getallocatedblocks() - blocks
+    tracemalloc.stop()
+    result['alloc_peak_bytes_per_request'] = round(peak / len(requests), 1)
+    result['retained_blocks_per_request'] = round(blocks / len(requests), 3)
+    return result
+
+
+def time_requests(emulator, requests):
+    """
+    Return the time needed to process a list of requests in-process.
+    """
+    query = emulator.query
+    start = time.perf_counter()
+    for cmd in requests:
+        query(cmd)
+    return time.perf_counter() - start
+
+
+def bench_log_overhead(n, target=LOG_OVERHEAD_TARGET):
+    """
+    Measure the overhead of logging configured with the root logger at
+    DEBUG level and a handler discarding debug messages, with respect to
+    disabled logging (in-process run of LOG_OVERHEAD_WORKLOAD).
+    :param n: number of timed requests of each run
+    :param target: max overhead (percentage)
+    :return: result dictionary
+    """
+    workload = WORKLOADS[LOG_OVERHEAD_WORKLOAD]
+    emulator = new_emulator(workload)
+    emulator.query_many(workload['setup'])
+    requests = request_list(workload, n)
+    root = logging.getLogger()
+    handlers, level = root.handlers, root.level
+    handler = logging.StreamHandler(io.StringIO())
+    handler.setLevel(logging.INFO)
+    root.handlers = [handler]
+    root.setLevel(logging.DEBUG)
+    emulator.update_log_level()
+    disabled, enabled = [], []
+    try:
+        time_requests(emulator, requests)  # warm-up
+        for i in range(LOG_OVERHEAD_RUNS):
+            logging.disable(logging.CRITICAL)
+            emulator.update_log_level()
+            disabled.append(time_requests(emulator, requests))
+            logging.disable(logging.NOTSET)
+            emulator.update_log_level()
+            enabled.append(time_requests(emulator, requests))
+    finally:
+        logging.disable(logging.CRITICAL)
+        root.handlers = handlers
+        root.setLevel(level)
+    overhead = (min(enabled) / min(disabled) - 1) * 100
+    return {
+        'workload': LOG_OVERHEAD_WORKLOAD,
+        'requests': n,
+        'disabled_seconds': round(min(disabled), 6),
+        'filtered_seconds': round(min(enabled), 6),
+        'overhead_percent': round(overhead, 2),
+        'target_percent': target,
+        'passed': overhead <= target,
+    }
+
+
+def import_time(top=IMPORT_TIME_TOP):
+    """
+    Run "python -X importtime -m elm -b FILE" in a temporary directory and
+    stop it when the batch mode is ready.
+    :param top: number of most expensive top-level modules returned
+    :return: tuple (total import time in ms, list of (module, ms) tuples)
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+        ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        batch = os.path.join(tmpdir, 'batch.txt')
+        open(batch, 'w').close()
+        process = subprocess.Popen(
+            [sys.executable, '-X', 'importtime', '-m', 'elm', '-b', batch],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE, cwd=tmpdir, env=env)
+        try:
+            start = time.time()
+            while time.time() - start < IO_TIMEOUT:
+                with open(batch) as f:
+                    if 'End of batch commands' in f.read():
+                        break
+                time.sleep(0.05)
+            else:
+                raise TimeoutError("the emulator did not start")
+            time.sleep(0.2)  # imports performed after the batch header
+        finally:
+            process.kill()
+            stderr = process.communicate()[1].decode(errors='replace')
+    modules = [
+        (m.group(2), int(m.group(1)) / 1000) for m in re.finditer(
+            r'^import time:\s+\d+ \|\s+(\d+) \| (\S+)', stderr, re.M)]
+    return (sum(ms for name, ms in modules),
+            sorted(modules, key=lambda m: -m[1])[:top])
+
+
+def bench_import_time(target=IMPORT_TIME_TARGET):
+    """
+    Measure the import time of the CLI cold start in batch mode (python
+    -X importtime) and compare the fastest run with the target.
+    :param target: max import time (ms)
+    :return: result dictionary
+    """
+    runs = [import_time() for i in range(IMPORT_TIME_RUNS)]
+    total, top = min(runs)
+    return {
+        'command': 'python -X importtime -m elm -b FILE',
+        'import_ms': round(total, 3),
+        'top_modules_ms': [[name, round(ms, 3)] for name, ms in top],
+        'target_ms': target,
+        'passed': total <= target,
+    }
+
+
+def read_prompt(read, fd):
+    """
+    Read the answer of a request up to the prompt.
+    :param read: function reading available bytes
+    :param fd: object or file descriptor to be used with select()
+    :return: read bytes, or None in case of timeout
+    """
+    answer = b""
+    while not answer.endswith(PROMPT):
+        if not select.select([fd], [], [], IO_TIMEOUT)[0]:
+            return None
+        answer += read()
+    return answer
+
+
+def exchanges(workload, requests):
+    """
+    Group the requests into the data written before waiting for each
+    prompt: requests which produce no output (e.g., ISO-TP consecutive
+    frames) are sent together with the next one. The output of each
+    request is checked in-process.
+    :param workload: WORKLOADS item
+    :param requests: list of request strings
+    :return: list of bytes
+    """
+    answers = new_emulator(workload).query_many(requests)
+    data = []
+    pending = b""
+    for cmd, answer in zip(requests, answers):
+        pending += cmd.encode() + b'\r'
+        if answer:
+            data.append(pending)
+            pending = b""
+    return data
+
+
+def bench_stream(name, transport, workload, n, write, read, fd):
+    """
+    Run a workload over a byte stream connected to the emulator thread.
+    :param write: function writing bytes
+    :param read: function reading available bytes
+    :param fd: object or file descriptor to be used with select()
+    :return: result dictionary, or None in case of timeout
+    """
+    setup = workload['setup']
+    data = exchanges(workload, setup + request_list(workload, n))
+    setup_exchanges = len(exchanges(workload, setup))
+    for i, cmd in enumerate(data):
+        if i == setup_exchanges:
+            break
+        write(cmd)
+        if read_prompt(read, fd) is None:
+            return None
+    clock = time.perf_counter
+    latencies = []
+    append = latencies.append
+    start = time.perf_counter()
+    for cmd in data[setup_exchanges:]:
+        t = clock()
+        write(cmd)
+        if read_prompt(read, fd) is None:
+            return None
+        append(clock() - t)
+    return summary(name, transport, workload, latencies,
+                   time.perf_counter() - start, n)
+
+
+def wait_active(emulator):
+    """
+    Wait for the emulator thread to be ready.
+    :return: True if the thread is active
+    """
+    while emulator.threadState == emulator.THREAD.STARTING:
+        time.sleep(0.01)
+    logging.disable(logging.CRITICAL)  # run() sets up the logging
+    return emulator.threadState == emulator.THREAD.ACTIVE
+
+
+def bench_pty(name, workload, n):
+    """
+    Run a workload over a pseudo-tty (not available with Windows).
+    :return: result dictionary, or None if not possible
+    """
+    if os.name == 'nt':
+        return None
+    import tty
+    with new_emulator(workload) as emulator:
+        if not wait_active(emulator):
+            return None
+        fd = os.open(emulator.get_pty(), os.O_RDWR | os.O_NOCTTY)
+        try:
+            tty.setraw(fd)
+            return bench_stream(
+                name, 'pty', workload, n,
+                lambda b: os.write(fd, b), lambda: os.read(fd, 4096), fd)
+        finally:
+            os.close(fd)
+
+
+def bench_tcp(name, workload, n):
+    """
+    Run a workload over a local TCP/IP connection.
+    :return: result dictionary, or None if not possible
+    """
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    with new_emulator(workload, net_port=port) as emulator:
+        if not wait_active(emulator):
+            return None
+        with socket.create_connection(('127.0.0.1', port)) as conn:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return bench_stream(
+                name, 'tcp', workload, n,
+                conn.sendall, lambda: conn.recv(4096), conn)
+
+
+BENCH_FUNCTIONS = {
+    'inprocess': bench_inprocess,
+    'pty': bench_pty,
+    'tcp': bench_tcp,
+}
+
+
+def run_benchmarks(workloads, transports, n):
+    """
+    Run the selected workloads with the selected transports.
+    The mt05 workload uses a temporary directory with the memory map file
+    of the ECU 11F1 plugin.
+    :param workloads: list of workload names
+    :param transports: list of transport names
+    :param n: number of timed requests per workload
+    :return: list of result dictionaries
+    """
+    from .plugins import task_ecu_11F1
+    results = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            with open(task_ecu_11F1.MMAP_INPUT_FILE, 'wb') as f:
+                f.truncate(task_ecu_11F1.MEM_RANGE + 1)
+            for name in workloads:
+                for transport in transports:
+                    result = BENCH_FUNCTIONS[transport](
+                        name, WORKLOADS[name], n)
+                    if result is None:
+                        print('Skipped workload "%s" with transport %s.'
+                              % (name, transport), file=sys.stderr)
+                        continue
+                    results.append(result)
+                    print('%-18s %-10s %10.1f req/s  p50 %8.2f us  '
+                          'p99 %8.2f us' % (
+                              name, transport, result['requests_per_s'],
+                              result['p50_us'], result['p99_us']),
+                          file=sys.stderr)
+        finally:
+            os.chdir(cwd)
+    return results
+
+
+def compare(results, baseline):
+    """
+    Print the throughput and latency ratios with respect to a previous
+    JSON output.
+    :param results: list of result dictionaries
+    :param baseline: JSON object produced by a previous run
+    """
+    previous = {(r['workload'], r['transport']): r
+                for r in baseline.get('results', [])}
+    print('Comparison with version %s (ratio new/old):'
+          % baseline.get('version'), file=sys.stderr)
+    for result in results:
+        old = previous.get((result['workload'], result['transport']))
+        if not old:
+            continue
+        print('%-18s %-10s req/s x%.2f  p50 x%.2f  p99 x%.2f' % (
+            result['workload'], result['transport'],
+            result['requests_per_s'] / old['requests_per_s'],
+            result['p50_us'] / old['p50_us'],
+            result['p99_us'] / old['p99_us']), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        epilog='ELM327-emulator v' + __version__ +
+        ' - Benchmark of the request pipeline')
+    parser.prog = "python3 -m elm.bench"
+    parser.add_argument(
+        '-w', '--workload',
+        dest='workloads',
+        action='append',
+        choices=list(WORKLOADS),
+        help="Workload to run (can be repeated; default is all).")
+    parser.add_argument(
+        '-t', '--transport',
+        dest='transports',
+        action='append',
+        choices=TRANSPORTS,
+        help="Transport to use (can be repeated; default is all).")
+    parser.add_argument(
+        '-n', '--requests',
+        dest='requests',
+        type=int,
+        default=BENCH_REQUESTS,
+        help="Number of timed requests per workload "
+             "(default is %s)." % BENCH_REQUESTS)
+    parser.add_argument(
+        '-o', '--output',
+        dest='output',
+        type=argparse.FileType('w'),
+        default=sys.stdout,
+        metavar='FILE',
+        help="JSON output file (default is standard output).")
+    parser.add_argument(
+        '-c', '--compare',
+        dest='compare',
+        type=argparse.FileType('r'),
+        metavar='FILE',
+        help="JSON output of a previous run to compare with.")
+    parser.add_argument(
+        '-g', '--log-overhead',
+        dest='log_overhead',
+        action='store_true',
+        help="Also measure the overhead of the filtered debug logging and "
+             "exit with error if higher than %s%%." % LOG_OVERHEAD_TARGET)
+    parser.add_argument(
+        '-i', '--import-time',
+        dest='import_time',
+        action='store_true',
+        help="Also measure the import time of the batch mode cold start and "
+             "exit with error if higher than %s ms." % IMPORT_TIME_TARGET)
+    parser.add_argument(
+        '-l', '--list',
+        dest='list',
+        action='store_true',
+        help="List the workloads and exit.")
+    args = parser.parse_args()
+
+    if args.list:
+        for name, workload in WORKLOADS.items():
+            print('%-18s %s' % (name, workload['descr']))
+        return
+
+    logging.disable(logging.CRITICAL)
+    results = run_benchmarks(
+        args.workloads or list(WORKLOADS),
+        args.transports or TRANSPORTS,
+        args.requests)
+    output = {
+        'version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'requests': args.requests,
+        'results': results,
+    }
+    log_overhead = None
+    if args.log_overhead:
+        log_overhead = output['log_overhead'] = bench_log_overhead(
+            args.requests)
+        print('Logging overhead %.2f%% (target %s%%): %s' % (
+            log_overhead['overhead_percent'], LOG_OVERHEAD_TARGET,
+            'passed' if log_overhead['passed'] else 'FAILED'),
+            file=sys.stderr)
+    imports = None
+    if args.import_time:
+        imports = output['import_time'] = bench_import_time()
+        print('Import time %.1f ms (target %s ms): %s' % (
+            imports['import_ms'], IMPORT_TIME_TARGET,
+            'passed' if imports['passed'] else 'FAILED'), file=sys.stderr)
+    json.dump(output, args.output, indent=2)
+    args.output.write('\n')
+    if args.compare:
+        compare(results, json.load(args.compare))
+    if ((log_overhead and not log_overhead['passed']) or
+            (imports and not imports['passed'])):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
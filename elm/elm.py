@@ -8,36 +8,40 @@
 ###########################################################################
 
 import logging
-import logging.config
-from pathlib import Path
-import yaml
 import re
 import os
+import sys
 import socket
-import serial
 from enum import Enum
 
 if not os.name == 'nt':
     import pty
     import tty
 import threading
+from collections import OrderedDict, deque
+from collections.abc import Mapping, MutableMapping
 import time
+import struct
+import marshal
+import itertools
 import traceback
 import errno
-from random import choices
+from random import choices, random
 from .obd_message import ObdMessage
-from .obd_message import ELM_R_OK, ELM_R_UNKNOWN, ST
+from .obd_message import ELM_R_OK, ELM_R_UNKNOWN, ST, HD, SZ, DT
 from .obd_message import ECU_ADDR_E, ECU_R_ADDR_E, ECU_ADDR_I, ECU_R_ADDR_I
 from .__version__ import __version__
 from functools import reduce  # only used in readme examples
+from functools import lru_cache
+from operator import attrgetter
 import string
-from xml.etree.ElementTree import fromstring, ParseError
-import importlib
-import pkgutil
-import inspect
 
 # Configuration constants__________________________________________________
-FORWARD_READ_TIMEOUT = 0.2  # seconds
+FORWARD_READ_TIMEOUT = 0.2  # seconds - forward read without terminator
+FORWARD_TIMEOUT = 5.0  # seconds - max time to wait for the forward terminator
+FORWARD_PROMPT = b">"  # default terminator of the forwarded answers
+FORWARD_QUEUE_SIZE = 256  # max number of requests queued for background forwarding
+READ_BUFFER_SIZE = 1024  # Max number of bytes read from the port at a time
 SERIAL_BAUDRATE = 38400  # bps
 NETWORK_INTERFACES = ""
 PLUGIN_DIR = __package__ + ".plugins"
@@ -50,6 +54,59 @@ ECU_TASK = "task_ecu_"
 DEFAULT_ECU_TASK = 'Default ECU Task module'
 ELM_VERSION = "ELM327 v1.5"
 ELM_HEADER_VERSION = "\r\r"
+REGEX_SPECIAL_CHARS = '.^$*+?{}[]\\|()'
+DISPATCH_CACHE_SIZE = 1024  # Max number of cached request dispatch lists
+SCENARIO_CACHE_SIZE = 4096  # Max number of cached compiled regex/code objects
+RESPONSE_CACHE_SIZE = 1024  # Max number of cached compiled response templates
+SCENARIO_DISK_CACHE = True  # Store the compiled scenarios in __pycache__
+UNKNOWN_REQUESTS_SIZE = 1000  # Max number of unknown request counters per session
+ISO_TP_MAX_LENGTH = 0xFFF  # Max payload length of an ISO-TP first frame
+HISTOGRAM_SUB_BITS = 4  # Latency histogram: 16 sub-buckets per power of 2
+HISTOGRAM_MAX_BITS = 40  # Latency histogram: max tracked value is 2^40 ns
+PROFILE_RATE = 100  # Default sampling rate of the profiler (samples/second)
+TRACE_SIZE = 4096  # Max number of records of the session trace
+TRACE_LINKTYPE = 147  # pcap link type of the trace (LINKTYPE_USER0)
+LEARN_SIZE = 4096  # Max number of answers of the learning cache
+LEARN_SCENARIO = 'learned'  # Scenario name of the exported learned answers
+LEARN_TRANSIENT = (  # answers of the OBD-II interface which are not learned
+    'STOPPED', 'BUFFER FULL', 'BUS BUSY', 'BUS ERROR', 'CAN ERROR',
+    'DATA ERROR', 'FB ERROR', 'LV RESET', 'UNABLE TO CONNECT', 'ERR')
+LEARN_CAN_FRAME = re.compile(  # 11-bit CAN header, size and data bytes
+    r'^([0-9A-F]{3}) ?([0-9A-F]{2}) ?((?:[0-9A-F]{2} ?)+)$')
+TIMING_QUANTILES = 64  # Size of the quantile tables of the timing profiles
+TIMING_ANY = '*'  # Timing profile key of all the recorded requests
+
+# Upper case hex string of each byte value
+HEX_BYTE = ['%02X' % i for i in range(256)]
+
+# Counters stored as Session attributes (counter name: attribute name)
+SESSION_SETTINGS = {
+    'cmd_echo': 'echo',
+    'cmd_set_header': 'set_header',
+    'cmd_use_header': 'use_header',
+    'cmd_spaces': 'spaces',
+    'cmd_linefeeds': 'linefeeds',
+    'cmd_caf': 'caf',
+    'cmd_cra': 'cra',
+    'cmd_can': 'can',
+    'cmd_last_cmd': 'last_cmd',
+    'cmd_last_pid': 'last_pid',
+    'req_timeout': 'req_timeout'
+}
+
+# Counters defining the output profile (see OutputProfile)
+OUTPUT_PROFILE_COUNTERS = (
+    'cmd_cra', 'cmd_use_header', 'cmd_spaces', 'cmd_linefeeds', 'cmd_caf')
+
+# Newline string for each 'cmd_linefeeds' value
+NL_TYPE = {
+    0: "\r",
+    1: "\r\n",
+    2: "\n",
+    3: "\r",
+    4: "\r\n",
+    5: "\n"
+}
 
 """
 Ref. to ISO 14229-1 and ISO 14230, this is a list of SIDs (UDS service
@@ -87,6 +144,85 @@ uds_sid_pos_answer = {
 # End of configuration constants_______________________________________________
 
 
+class RealClock:
+    """
+    Clock used by the emulator and by the tasks (Elm.clock) for all timers
+    (P2 delay, inter-byte delay, P3 and P4 timers, task execution times)
+    and delays (Elm.sleep). Real time.
+    """
+    virtual = False
+
+    def time(self):
+        """
+        :return: current time in seconds since the epoch (as time.time())
+        """
+        return time.time()
+
+    def monotonic(self):
+        """
+        :return: value of a monotonic clock in seconds (as time.monotonic())
+        """
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        """
+        Suspend the execution for the given number of seconds.
+        :param seconds: delay in seconds
+        """
+        time.sleep(seconds)
+
+    def bind(self, current_session):
+        """
+        Associate the clock with the sessions of an emulator (ref. Elm).
+        :param current_session: function returning the current Session
+        """
+
+
+class VirtualClock(RealClock):
+    """
+    Clock jumping forward instantly instead of sleeping: the time is the
+    real time plus the sum of all the delays requested so far, so that
+    the timers (e.g., P3 and P4) expire exactly as with the real clock,
+    without waiting. Used in batch or in-process test mode to run
+    timing-heavy scenarios faster than real time.
+    When bound to an emulator, the skipped delays are summed separately
+    for each session (Session.clock_offset), so that the delays of a
+    client do not expire the timers of the other ones (multi-session
+    mode).
+    """
+    virtual = True
+
+    def __init__(self):
+        self.offset = 0.0  # sum of the skipped delays (seconds, unbound)
+        self.current_session = None  # function returning the current Session
+        self.lock = threading.Lock()
+
+    def bind(self, current_session):
+        self.current_session = current_session
+
+    def get_offset(self):
+        """
+        :return: sum of the delays skipped by the current session (seconds)
+        """
+        if self.current_session is None:
+            return self.offset
+        return self.current_session().clock_offset
+
+    def time(self):
+        return time.time() + self.get_offset()
+
+    def monotonic(self):
+        return time.monotonic() + self.get_offset()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            with self.lock:
+                if self.current_session is None:
+                    self.offset += seconds
+                else:
+                    self.current_session().clock_offset += seconds
+
+
 class Tasks:
     """
     Base class for tasks.
@@ -128,7 +264,7 @@ class Tasks:
         else:
             self.shared = self  # ECU Task
         self.logging = emulator.logger  # logger reference
-        self.time_started = time.time()  # timer (to be used to simulate background processing)
+        self.time_started = emulator.clock.time()  # timer (to be used to simulate background processing)
 
     def HD(self, header):
         """
@@ -196,7 +332,7 @@ class Tasks:
         """
         if not self.attrib:
             return None
-        return re.match(self.attrib['REQUEST'], request)
+        return compile_request(self.attrib['REQUEST']).match(request)
 
     def start(self, cmd, length=None, frame=None):
         """
@@ -320,10 +456,58 @@ class IsoTpMultiframe(Tasks):
         return Tasks.RETURN.INCOMPLETE
 
 
+class Plugins(Mapping):
+    """
+    Task plugins (Elm.plugins): modules of PLUGIN_DIR whose name starts with
+    "task_", listed when the object is created and imported when they are
+    used for the first time (e.g., when a 'Task' entry of the dictionary
+    fires). Modules without a Task class are logged and removed.
+    """
+
+    def __init__(self):
+        import importlib
+        import importlib.machinery
+        suffixes = tuple(importlib.machinery.all_suffixes())
+        names = set()
+        for path in importlib.import_module(PLUGIN_DIR).__path__:
+            try:
+                files = os.listdir(path)
+            except OSError:
+                continue
+            for file in files:
+                name, ext = os.path.splitext(file)
+                if name.startswith('task_') and ext in suffixes:
+                    names.add(name.split('.')[0])
+        self.names = sorted(names)
+        self.modules = {}  # imported plugins
+
+    def __getitem__(self, name):
+        try:
+            return self.modules[name]
+        except KeyError:
+            if name not in self.names:
+                raise
+        import importlib
+        module = importlib.import_module(PLUGIN_DIR + "." + name)
+        if not isinstance(getattr(module, "Task", None), type):
+            logging.critical("Task class not available in plugin %s", name)
+            self.names.remove(name)
+            raise KeyError(name)
+        self.modules[name] = module
+        return module
+
+    def __iter__(self):
+        return iter(list(self.names))
+
+    def __len__(self):
+        return len(self.names)
+
+
 def setup_logging(
-        default_path=Path(__file__).stem + '.yaml',
+        default_path=os.path.splitext(os.path.basename(__file__))[0] + '.yaml',
         default_level=logging.INFO,
-        env_key=os.path.basename(Path(__file__).stem).upper() + '_LOG_CFG'):
+        env_key=os.path.splitext(
+            os.path.basename(__file__))[0].upper() + '_LOG_CFG'):
     """
     Setup logging facility
     :param default_path: logging file pathname
@@ -334,18 +518,115 @@ def setup_logging(
     path = default_path
     if not os.path.exists(path):
         path = os.path.join(
-            os.path.dirname(Path(__file__)), 'elm.yaml')
+            os.path.dirname(__file__), 'elm.yaml')
     value = os.getenv(env_key, None)
     if value:
         path = value
     if os.path.exists(path):
-        with open(path, 'rt') as f:
-            config = yaml.safe_load(f.read())
+        # The parsed configuration is cached, so that yaml is only imported
+        # when the configuration file changes
+        file = cache_file("logging")
+        stamp = file_stamp(path)
+        config = read_cache(file, stamp)
+        if config is None:
+            import yaml
+            with open(path, 'rt') as f:
+                config = yaml.safe_load(f.read())
+            write_cache(file, stamp, config)
+        import logging.config
         logging.config.dictConfig(config)
     else:
         logging.basicConfig(level=default_level)
 
 
+def cache_file(name):
+    """
+    Return the pathname of a cache file in the __pycache__ directory of
+    the package, specific to the Python implementation (as for bytecode).
+    :param name: name of the cached data
+    :return: pathname
+    """
+    return os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), '__pycache__',
+        "%s.%s.marshal" % (name, sys.implementation.cache_tag))
+
+
+def file_stamp(path):
+    """
+    Return the stamp identifying the version of a source file of cached
+    data: package version, pathname, modification time and size.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return __version__, path, 0, 0
+    return __version__, path, st.st_mtime_ns, st.st_size
+
+
+def read_cache(file, stamp):
+    """
+    Read data written by write_cache().
+    :param file: pathname of the cache file
+    :param stamp: stamp of the source of the data (ref. file_stamp())
+    :return: cached data, or None if missing or related to another stamp
+    """
+    try:
+        with open(file, 'rb') as f:
+            cached_stamp, data = marshal.loads(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if cached_stamp != stamp:
+        return None
+    return data
+
+
+def write_cache(file, stamp, data):
+    """
+    Write data with marshal to a cache file, replacing it atomically.
+    As with Python bytecode, nothing is written if sys.dont_write_bytecode
+    is set.
+    :param file: pathname of the cache file
+    :param stamp: stamp of the source of the data (ref. file_stamp())
+    :param data: data supported by marshal
+    :return: False if the file cannot be written, otherwise True
+    """
+    if sys.dont_write_bytecode:
+        return True
+    tmp_file = "%s.%s.tmp" % (file, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        with open(tmp_file, 'wb') as f:
+            marshal.dump((stamp, data), f)
+        os.replace(tmp_file, file)
+    except (OSError, ValueError) as e:
+        logging.debug("Cannot write the cache file %s: %s", file, e)
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+        return False
+    return True
+
+
+def log_debug_enabled(logger):
+    """
+    Return True if a debug message of a logger is written by at least
+    one of its handlers or of the handlers of its ancestors.
+    :param logger: Logger object
+    :return: boolean
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return False
+    while logger:
+        for handler in logger.handlers:
+            if handler.level <= logging.DEBUG:
+                return True
+        if not logger.propagate:
+            break
+        logger = logger.parent
+    return False
+
+
 def is_hex_sp(s):
     """
     Validate a string containing hex (in any number, not necessarily
@@ -373,6 +654,1477 @@ def len_hex(s):
         return False
 
 
+def regex_literal_prefix(pattern):
+    """
+    Return the literal string that any request matched by the "Request"
+    regular expression (re.match semantics) must start with.
+    An empty string is returned when no literal prefix can be safely
+    extracted (e.g., alternations, character classes at the beginning,
+    case-insensitive patterns).
+    :param pattern: regular expression string or compiled pattern
+    :return: literal prefix string (possibly empty)
+    """
+    if hasattr(pattern, 'pattern'):  # compiled regular expression
+        if pattern.flags & (re.IGNORECASE | re.VERBOSE):
+            return ""
+        pattern = pattern.pattern
+    if not isinstance(pattern, str) or '|' in pattern:
+        return ""
+    prefix = ""
+    i = 1 if pattern.startswith('^') else 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c in REGEX_SPECIAL_CHARS:
+            break
+        quantifier = pattern[i + 1:i + 2]
+        if quantifier and quantifier in '*?{':  # optional character
+            break
+        prefix += c
+        if quantifier == '+':
+            break
+        i += 1
+    return prefix
+
+
+@lru_cache(maxsize=SCENARIO_CACHE_SIZE)
+def compile_request(pattern):
+    """
+    Compile (and cache) the regular expression of a 'Request' tag.
+    :param pattern: regular expression string or compiled pattern
+    :return: compiled pattern
+    """
+    return re.compile(pattern)
+
+
+@lru_cache(maxsize=SCENARIO_CACHE_SIZE)
+def compile_code(source, filename, mode='exec'):
+    """
+    Compile (and cache) the Python statements of a dictionary tag
+    ('Exec', 'Log', 'Info', 'Warning').
+    :param source: Python source string
+    :param filename: name shown in tracebacks
+    :param mode: compile() mode
+    :return: code object, or the source string if it cannot be compiled
+        (so that the error is reported when the code is run)
+    """
+    try:
+        return compile(source, filename, mode)
+    except Exception:
+        return source
+
+
+# Identifiers of the statistics counters (name: index) and related names
+COUNTER_IDS = {'commands': 0}
+COUNTER_NAMES = ['commands']
+COMMANDS_ID = 0
+counter_ids_lock = threading.Lock()
+
+
+def counter_id(name):
+    """
+    Return the index of the statistics counter "name" (e.g., a PID),
+    allocating it if new. Indexes are shared by all sessions.
+    """
+    try:
+        return COUNTER_IDS[name]
+    except KeyError:
+        with counter_ids_lock:
+            if name not in COUNTER_IDS:
+                COUNTER_IDS[name] = len(COUNTER_NAMES)
+                COUNTER_NAMES.append(name)
+            return COUNTER_IDS[name]
+
+
+def is_unknown_counter(key):
+    """
+    Return True if "key" is a counter of an unknown request.
+    """
+    return isinstance(key, str) and key.startswith('unknown_')
+
+
+class StatisticsSnapshot(Mapping):
+    """
+    Read-only dictionary view of the statistics of a session at the time
+    the snapshot was taken (ref. Statistics.snapshot()).
+    """
+    __slots__ = ('counts', 'unknown')
+
+    def __init__(self, counts, unknown):
+        self.counts = counts
+        self.unknown = unknown
+
+    def __getitem__(self, key):
+        if is_unknown_counter(key):
+            return self.unknown[key]
+        i = COUNTER_IDS.get(key)
+        if i is None or i >= len(self.counts) or self.counts[i] is None:
+            raise KeyError(key)
+        return self.counts[i]
+
+    def __iter__(self):
+        counts = self.counts
+        for i in range(len(counts)):
+            if counts[i] is not None:
+                yield COUNTER_NAMES[i]
+        yield from self.unknown
+
+    def __len__(self):
+        return (len(self.counts) - self.counts.count(None) +
+                len(self.unknown))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class Statistics(StatisticsSnapshot, MutableMapping):
+    """
+    Statistics counters of a session: number of executed PIDs and tasks,
+    'commands' (stored in a list indexed by counter_id()) and unknown
+    requests (stored in an LRU table with max UNKNOWN_REQUESTS_SIZE
+    elements, so that memory stays bounded with any sequence of requests).
+    snapshot() shares the tables with the returned snapshot, which are
+    copied at the next change (copy on write). The snapshot and the
+    changes are serialized by a lock, so that a snapshot taken by another
+    thread (e.g., metrics) is never changed afterwards.
+    """
+    __slots__ = ('frozen', 'evicted', 'lock')
+
+    def __init__(self):
+        super().__init__([], OrderedDict())
+        self.frozen = False  # tables are shared with a snapshot
+        self.evicted = 0  # number of removed unknown request counters
+        self.lock = threading.Lock()
+
+    def thaw(self):
+        self.counts = list(self.counts)
+        self.unknown = OrderedDict(self.unknown)
+        self.frozen = False
+
+    def snapshot(self):
+        """
+        Return a StatisticsSnapshot of the current counters (in O(1)).
+        """
+        with self.lock:
+            self.frozen = True
+            return StatisticsSnapshot(self.counts, self.unknown)
+
+    def hit(self, i):
+        """
+        Increment the counter with index i (ref. counter_id()).
+        :return: new value of the counter
+        """
+        with self.lock:
+            if self.frozen:
+                self.thaw()
+            counts = self.counts
+            if i >= len(counts):
+                counts.extend([None] * (i + 1 - len(counts)))
+            counts[i] = 1 if counts[i] is None else counts[i] + 1
+            return counts[i]
+
+    def hit_unknown(self, key):
+        """
+        Increment the counter of an unknown request.
+        :param key: name of the counter ("unknown_" + repr(request))
+        :return: new value of the counter
+        """
+        value = self.unknown.get(key, 0) + 1
+        self[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            if self.frozen:
+                self.thaw()
+            if is_unknown_counter(key):
+                unknown = self.unknown
+                unknown[key] = value
+                unknown.move_to_end(key)
+                if len(unknown) > UNKNOWN_REQUESTS_SIZE:
+                    unknown.popitem(last=False)
+                    self.evicted += 1
+                return
+            i = counter_id(key)
+            counts = self.counts
+            if i >= len(counts):
+                counts.extend([None] * (i + 1 - len(counts)))
+            counts[i] = value
+
+    def __delitem__(self, key):
+        self[key]  # raise KeyError if missing
+        with self.lock:
+            if self.frozen:
+                self.thaw()
+            if is_unknown_counter(key):
+                del self.unknown[key]
+            else:
+                self.counts[COUNTER_IDS[key]] = None
+
+    def clear(self):
+        with self.lock:
+            self.counts = []
+            self.unknown = OrderedDict()
+            self.frozen = False
+
+
+class LatencyHistogram:
+    """
+    Histogram of latencies in nanoseconds with fixed log-linear buckets
+    (HDR-style): values up to 2^(HISTOGRAM_SUB_BITS+1) are exact, the
+    others are grouped in 2^HISTOGRAM_SUB_BITS buckets per power of 2
+    (relative error below 1/2^HISTOGRAM_SUB_BITS). Recording a value is
+    O(1) with no allocations.
+    """
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * ((HISTOGRAM_MAX_BITS - HISTOGRAM_SUB_BITS) <<
+                             HISTOGRAM_SUB_BITS)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, ns):
+        """
+        Add a value to the histogram.
+        :param ns: latency in nanoseconds (int)
+        """
+        shift = ns.bit_length() - HISTOGRAM_SUB_BITS - 1
+        i = ((shift << HISTOGRAM_SUB_BITS) + (ns >> shift)
+             if shift > 0 else ns)
+        counts = self.counts
+        if i >= len(counts):
+            i = len(counts) - 1
+        counts[i] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    @staticmethod
+    def bucket_max(i):
+        """
+        Return the highest value of the bucket with index i.
+        """
+        shift = (i >> HISTOGRAM_SUB_BITS) - 1
+        if shift <= 0:
+            return i
+        return ((i - (shift << HISTOGRAM_SUB_BITS) + 1) << shift) - 1
+
+    def percentile(self, q):
+        """
+        Return the value below which the fraction q of the recorded values
+        falls (highest value of the related bucket, limited to the max).
+        :param q: fraction (0 to 1)
+        :return: latency in nanoseconds, or None if no value is recorded
+        """
+        if not self.count:
+            return None
+        rank = max(1, int(q * self.count + 0.5))
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(self.bucket_max(i), self.max)
+        return self.max
+
+    def quantiles(self, size):
+        """
+        Return the percentiles of "size" equally spaced fractions from 0 to
+        1 (ref. percentile()), computed in one pass.
+        :param size: number of values (at least 2)
+        :return: list of latencies in nanoseconds (empty if no value is
+            recorded)
+        """
+        if not self.count:
+            return []
+        ranks = [max(1, int(i * self.count / (size - 1) + 0.5))
+                 for i in range(size)]
+        result = []
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if not n:
+                continue
+            seen += n
+            while len(result) < size and seen >= ranks[len(result)]:
+                result.append(min(self.bucket_max(i), self.max))
+            if len(result) == size:
+                break
+        return result + [self.max] * (size - len(result))
+
+
+class StackSampler:
+    """
+    Sampling profiler of a thread (Elm.profiler, used for the thread
+    running Elm.run()). While started, a separate thread reads the stack
+    of the profiled thread at the configured rate and counts each distinct
+    stack; dump() writes them in collapsed-stack format (one
+    "frame;frame;... count" line per stack, root first), which can be
+    processed by flame graph tools. No overhead when stopped.
+    """
+
+    def __init__(self):
+        self.samples = {}  # collapsed stack: number of samples
+        self.labels = {}  # code object: frame label
+        self.thread = None  # sampling thread
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.target = None  # identifier of the profiled thread
+        self.rate = PROFILE_RATE
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    @property
+    def count(self):
+        """
+        Number of collected samples.
+        """
+        with self.lock:
+            return sum(self.samples.values())
+
+    def start(self, thread_id, rate=PROFILE_RATE):
+        """
+        Start sampling a thread (samples are added to the previous ones).
+        :param thread_id: identifier of the thread (threading.get_ident())
+        :param rate: number of samples per second
+        :return: False if already started, otherwise True
+        """
+        if self.thread is not None:
+            return False
+        self.target = thread_id
+        self.rate = rate
+        self.stopping.clear()
+        self.thread = threading.Thread(
+            target=self.sample_loop, name="ELM327-emulator profiler")
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+
+    def stop(self):
+        """
+        Stop sampling.
+        :return: False if not started, otherwise True
+        """
+        if self.thread is None:
+            return False
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+        return True
+
+    def clear(self):
+        """
+        Remove all samples.
+        """
+        with self.lock:
+            self.samples = {}
+
+    def label(self, code):
+        """
+        Return the label of a frame: function (file:line).
+        """
+        label = self.labels.get(code)
+        if label is None:
+            label = self.labels[code] = "%s (%s:%d)" % (
+                code.co_name, os.path.basename(code.co_filename),
+                code.co_firstlineno)
+        return label
+
+    def sample_loop(self):
+        """
+        Body of the sampling thread.
+        """
+        interval = 1 / self.rate
+        while not self.stopping.wait(interval):
+            frame = sys._current_frames().get(self.target)
+            stack = []
+            while frame is not None:
+                stack.append(self.label(frame.f_code))
+                frame = frame.f_back
+            if not stack:
+                continue
+            stack.reverse()
+            key = ";".join(stack)
+            with self.lock:
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+    def dump(self, file):
+        """
+        Write the samples in collapsed-stack format.
+        :param file: file name or file object
+        :return: number of samples
+        """
+        with self.lock:
+            samples = sorted(self.samples.items())
+        if isinstance(file, str):
+            with open(file, "w") as f:
+                return self.dump_samples(f, samples)
+        return self.dump_samples(file, samples)
+
+    @staticmethod
+    def dump_samples(f, samples):
+        for stack, count in samples:
+            f.write("%s %d\n" % (stack, count))
+        return sum(count for stack, count in samples)
+
+
+class TraceBuffer:
+    """
+    Ring buffer of the bytes exchanged with the clients (Elm.trace): each
+    record is a (timestamp, direction, session id, bytes) tuple, where
+    direction is 'in' (read from the client) or 'out' (written to the
+    client). Only the latest "size" records are kept. Recording a message
+    just appends a tuple, with no formatting; records are converted when
+    dumped, in JSON Lines or pcap format.
+    """
+
+    def __init__(self, clock, size=TRACE_SIZE):
+        self.clock = clock
+        self.records = deque(maxlen=size)
+        self.enabled = True
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def size(self):
+        return self.records.maxlen
+
+    def record(self, direction, session, data):
+        """
+        Add a record, if the trace is enabled.
+        :param direction: 'in' or 'out'
+        :param session: Session object
+        :param data: exchanged bytes
+        """
+        if self.enabled and data:
+            self.records.append(
+                (self.clock.time(), direction, session.id, bytes(data)))
+
+    def clear(self):
+        """
+        Remove all records.
+        """
+        self.records.clear()
+
+    def dump(self, file):
+        """
+        Write the records to a file: pcap format if the file name ends with
+        ".pcap", otherwise JSON Lines.
+        :param file: file name
+        :return: number of written records
+        """
+        records = self.records.copy()
+        if file.lower().endswith(".pcap"):
+            with open(file, "wb") as f:
+                return self.dump_pcap(f, records)
+        with open(file, "w") as f:
+            return self.dump_jsonl(f, records)
+
+    @staticmethod
+    def dump_jsonl(f, records):
+        """
+        Write records in JSON Lines format: one object per record with
+        time, dir, session, hex and text (ASCII) fields.
+        """
+        import json
+        for timestamp, direction, session_id, data in records:
+            f.write(json.dumps({
+                "time": timestamp,
+                "dir": direction,
+                "session": session_id,
+                "hex": data.hex(),
+                "text": data.decode("ascii", "replace")}) + "\n")
+        return len(records)
+
+    @staticmethod
+    def dump_pcap(f, records):
+        """
+        Write records in libpcap format (link type LINKTYPE_USER0). The
+        data of each packet is prefixed by an 8-byte pseudo-header: one
+        byte with the direction (0 = in, 1 = out), three reserved bytes
+        and the session id (32-bit big-endian).
+        """
+        f.write(struct.pack("<IHHiIII", 0xa1b2c3d4, 2, 4, 0, 0, 65535,
+                            TRACE_LINKTYPE))
+        for timestamp, direction, session_id, data in records:
+            packet = struct.pack(">B3xI", direction == 'out',
+                                 session_id & 0xFFFFFFFF) + data
+            seconds = int(timestamp)
+            f.write(struct.pack(
+                "<IIII", seconds, int((timestamp - seconds) * 1e6),
+                len(packet), len(packet)))
+            f.write(packet)
+        return len(records)
+
+
+def learned_answer(answer, cmd, use_headers):
+    """
+    Convert the answer of the forwarded OBD-II interface to a list of
+    response items: the echo of the request, "SEARCHING..." and the prompt
+    are removed; with headers (ATH1), CAN frames with 11-bit header are
+    split into header, size and data, while the other lines are kept as
+    they are.
+    :param answer: decoded answer string
+    :param cmd: sanitized request
+    :param use_headers: True if the answer was received with headers
+    :return: tuple of items: ('HD', header, size, data) or ('ST', line);
+        None if the answer is empty or includes a transient error
+    """
+    items = []
+    for line in re.split(r'[\r\n]+', answer.rstrip().rstrip('>')):
+        line = line.strip()
+        if (not line or line.startswith('SEARCHING') or
+                not items and line.replace(' ', '').upper() == cmd):
+            continue
+        if line.startswith(LEARN_TRANSIENT):
+            return None
+        match = use_headers and LEARN_CAN_FRAME.match(line)
+        if match:
+            header, size, data = match.groups()
+            data = data.replace(' ', '')
+            if int(size, 16) >= 16 or len(data) == int(size, 16) * 2:
+                items.append(('HD', header, size, ' '.join(
+                    data[i:i + 2] for i in range(0, len(data), 2))))
+                continue
+        items.append(('ST', line))
+    return tuple(items) or None
+
+
+def learned_response(items):
+    """
+    Return the XML response of the items returned by learned_answer().
+    """
+    return ''.join(
+        HD(item[1]) + SZ(item[2]) + DT(item[3]) if item[0] == 'HD' else
+        ST(item[1].replace('&', '&amp;').replace('<', '&lt;'))
+        for item in items)
+
+
+class LearningCache:
+    """
+    Answers of the forwarded OBD-II interface to the requests unknown to
+    the dictionary (Elm.learning), keyed by header, sanitized request and
+    output format (ref. key()), so that a repeated request is answered
+    without forwarding it again. Answers expire after "ttl" seconds (None
+    means no expiry); at most "size" answers are kept (the least recently
+    learned ones are removed first). export() writes them as a scenario.
+    """
+
+    def __init__(self, clock, ttl=None, size=LEARN_SIZE):
+        self.clock = clock
+        self.ttl = ttl
+        self.size = size
+        self.enabled = False
+        self.answers = OrderedDict()  # key: (time, items, XML response)
+
+    def __len__(self):
+        return len(self.answers)
+
+    @staticmethod
+    def key(header, cmd, profile):
+        """
+        Return the key of an answer.
+        :param header: header of the request (None if not set)
+        :param cmd: sanitized request
+        :param profile: OutputProfile of the session
+        """
+        return (header, cmd, bool(profile.use_headers), profile.sp,
+                profile.nl, profile.caf, profile.cra_pattern)
+
+    def get(self, key):
+        """
+        Return the XML response of a learned answer, or None if the answer
+        is not available or expired.
+        """
+        item = self.answers.get(key)
+        if item is None:
+            return None
+        if self.ttl is not None and self.clock.monotonic() - item[0] > self.ttl:
+            self.answers.pop(key, None)
+            return None
+        return item[2]
+
+    def store(self, key, answer):
+        """
+        Learn the answer of the OBD-II interface to a request.
+        :param key: key returned by key()
+        :param answer: decoded answer string
+        :return: XML response, or None if the answer is not learned
+        """
+        items = learned_answer(answer, key[1], key[2])
+        if items is None:
+            return None
+        response = learned_response(items)
+        self.answers.pop(key, None)
+        self.answers[key] = (self.clock.monotonic(), items, response)
+        while len(self.answers) > self.size:
+            self.answers.popitem(last=False)
+        return response
+
+    def clear(self):
+        """
+        Remove all answers.
+        """
+        self.answers.clear()
+
+    def export(self, file, scenario=LEARN_SCENARIO):
+        """
+        Write the learned answers as a Python module defining an ObdMessage
+        dictionary with one scenario, which can be merged with the
+        dictionary of the emulator ("merge" command). Each request and
+        header produces an entry; if a request was learned with different
+        output formats, the answer with CAN frames (converted to HD/SZ/DT
+        tags, valid with any format) is preferred.
+        :param file: file name
+        :param scenario: scenario name
+        :return: number of written entries
+        """
+        entries = {}
+        for key, (learned, items, response) in list(self.answers.items()):
+            frames = any(item[0] == 'HD' for item in items)
+            if frames or not entries.get(key[:2], (False,))[0]:
+                entries[key[:2]] = (frames, items)
+        lines = [
+            '# ELM327-emulator scenario learned from the OBD-II interface',
+            '',
+            'from elm.obd_message import HD, SZ, DT, ST',
+            '',
+            'ObdMessage = {',
+            '    %r: {' % scenario,
+        ]
+        for (header, cmd), (frames, items) in sorted(
+                entries.items(), key=lambda e: (e[0][1], e[0][0] or '')):
+            lines.append('        %r: {' % (
+                'LEARNED_' + cmd + ('_' + header if header else '')))
+            lines.append("            'Request': %r," % (
+                '^' + re.escape(cmd) + '$'))
+            lines.append("            'Descr': 'Learned from the OBD-II "
+                         "interface',")
+            if header:
+                lines.append("            'Header': %r," % header)
+            lines.append("            'Response': " + ' +\n                '
+                         .join('HD(%r) + SZ(%r) + DT(%r)' % item[1:]
+                               if item[0] == 'HD' else 'ST(%r)' % item[1]
+                               for item in items) + ',')
+            lines.append('        },')
+        lines += ['    },', '}', '']
+        with open(file, 'w') as f:
+            f.write('\n'.join(lines))
+        return len(entries)
+
+
+class TimingProfile:
+    """
+    Response timing of the OBD-II interfaces (Elm.timing). While recording,
+    the forwarder adds the latency (time between the request and the first
+    data of the answer) and the byte pacing (mean time between the
+    following bytes) of each answer to the histograms of the sanitized
+    request (e.g., "010C") and of all the OBD requests (TIMING_ANY, which
+    excludes the AT and ST commands). For the
+    replay, the histograms are converted to tables of "size" quantiles,
+    which can also be saved to and loaded from a JSON file; sample() picks
+    a random point of the tables (inverse transform sampling), so that the
+    emulator reproduces the recorded distributions with one random number
+    and two list lookups per response.
+    """
+
+    def __init__(self, size=TIMING_QUANTILES):
+        self.size = size
+        self.recording = False
+        self.replay = False
+        self.histograms = {}  # request: (latency, pacing) LatencyHistogram
+        self.tables = {}  # request, PID or TIMING_ANY: (latency, pacing)
+        self.changed = False  # histograms changed after the latest build()
+
+    def __len__(self):
+        return len(self.tables.keys() | self.histograms.keys())
+
+    def record(self, request, latency, pacing):
+        """
+        Add the timing of an answer of the OBD-II interface.
+        :param request: sanitized request
+        :param latency: seconds between the request and the first data
+        :param pacing: mean seconds between the following bytes
+        """
+        keys = (request,) if request.startswith(('AT', 'ST')) else (
+            request, TIMING_ANY)
+        for key in keys:
+            histograms = self.histograms.get(key)
+            if histograms is None:
+                histograms = self.histograms[key] = (
+                    LatencyHistogram(), LatencyHistogram())
+            histograms[0].record(int(max(latency, 0) * 1e9))
+            histograms[1].record(int(max(pacing, 0) * 1e9))
+        self.changed = True
+
+    def build(self):
+        """
+        Compute the quantile tables of the recorded histograms, replacing
+        the loaded tables of the same requests.
+        """
+        for key, histograms in list(self.histograms.items()):
+            self.tables[key] = tuple(
+                [ns / 1e9 for ns in histogram.quantiles(self.size)]
+                for histogram in histograms)
+        self.changed = False
+
+    def sample(self, request, pid=None):
+        """
+        Return a random latency and byte pacing with the distribution of a
+        request, or of a PID (scenario entry) if the request is not
+        profiled, or of all the OBD requests (not for AT and ST commands).
+        :param request: sanitized request
+        :param pid: PID of the scenario entry (None if unknown)
+        :return: (latency, pacing) tuple of seconds, or None if no profile
+            is available
+        """
+        if self.changed:
+            self.build()
+        tables = self.tables
+        table = tables.get(request) or tables.get(pid)
+        if table is None and not request.startswith(('AT', 'ST')):
+            table = tables.get(TIMING_ANY)
+        if table is None:
+            return None
+        latency, pacing = table
+        position = random() * (len(latency) - 1)
+        i = int(position)
+        if i + 1 >= len(latency):
+            return latency[-1], pacing[-1]
+        fraction = position - i
+        return (latency[i] + (latency[i + 1] - latency[i]) * fraction,
+                pacing[i] + (pacing[i + 1] - pacing[i]) * fraction)
+
+    def clear(self):
+        """
+        Remove all recorded and loaded profiles.
+        """
+        self.histograms = {}
+        self.tables = {}
+        self.changed = False
+
+    def save(self, file):
+        """
+        Write the quantile tables to a JSON file ("requests" object, with
+        "latency" and "pacing" lists of seconds for each request).
+        :param file: file name
+        :return: number of written profiles
+        """
+        import json
+        if self.changed:
+            self.build()
+        with open(file, 'w') as f:
+            json.dump({
+                'quantiles': self.size,
+                'requests': {
+                    key: {'latency': latency, 'pacing': pacing}
+                    for key, (latency, pacing) in sorted(self.tables.items())
+                }
+            }, f, indent=1)
+        return len(self.tables)
+
+    def load(self, file):
+        """
+        Load the quantile tables written by save(), replacing the profiles
+        of the same requests. The keys can also be PIDs of the scenario
+        entries.
+        :param file: file name
+        :return: number of loaded profiles
+        """
+        import json
+        with open(file) as f:
+            data = json.load(f)
+        tables = {}
+        for key, table in data['requests'].items():
+            latency = [float(value) for value in table['latency']]
+            pacing = [float(value) for value in table['pacing']]
+            if not latency or len(latency) != len(pacing):
+                raise ValueError("invalid profile of %r" % key)
+            tables[key] = (latency, pacing)
+        if self.changed:
+            self.build()
+        for key in tables:
+            self.histograms.pop(key, None)
+        self.tables.update(tables)
+        return len(tables)
+
+
+class ForwardQueue:
+    """
+    Bounded queue of the requests forwarded in background (Elm.forward_queue,
+    ref. the forward_background argument), processed by worker threads (one
+    for each OBD-II interface of the forwarder), so that the emulator
+    answers without waiting for the OBD-II interfaces. Requests are dropped
+    when the queue is full. For the requests unknown to the dictionary, the worker
+    logs the answer and stores it in the learning cache; the
+    "unknown_..._R" counters are updated by the emulator thread (apply()),
+    as the statistics of a session are only changed by that thread.
+    """
+
+    def __init__(self, emulator, size=FORWARD_QUEUE_SIZE):
+        import queue
+        self.emulator = emulator
+        self.queue = queue.Queue(size)
+        self.full = queue.Full
+        self.results = deque()  # (session, unknown counter name, answer)
+        self.dropped = 0  # number of requests dropped because of a full queue
+        self.threads = []
+
+    def __len__(self):
+        return self.queue.qsize()
+
+    def put(self, session, cmd, line, unknown=None, first=False, key=None):
+        """
+        Queue a request to be forwarded, starting the worker if needed.
+        :param session: Session object
+        :param cmd: sanitized request
+        :param line: request string to be forwarded (without newline)
+        :param unknown: name of the counter of the unknown request (None if
+            the request is known to the dictionary: the answer is ignored)
+        :param first: True if the unknown request is received the first time
+        :param key: key of the learning cache (None to not learn the answer)
+        :return: False if the request is dropped, otherwise True
+        """
+        if not self.threads:
+            forwarder = self.emulator.get_forwarder()
+            for i in range(len(forwarder) if forwarder else 1):
+                thread = threading.Thread(
+                    target=self.run, name="ELM327-emulator forwarder")
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        try:
+            self.queue.put_nowait((session, cmd, line, unknown, first, key))
+        except self.full:
+            self.dropped += 1
+            logging.warning("Forward queue full: dropped request %s",
+                            repr(cmd))
+            return False
+        return True
+
+    def run(self):
+        """
+        Worker threads: forward the queued requests up to stop().
+        """
+        emulator = self.emulator
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            session, cmd, line, unknown, first, key = job
+            try:
+                fw_data = emulator.send_receive_forward(
+                    (line + '\r').encode())
+            except Exception as e:
+                logging.error('Forward Write error: %s', e)
+                continue
+            if unknown is None or fw_data is False:
+                continue
+            self.results.append((session, unknown, fw_data))
+            if (first and
+                    re.match(r"^NO DATA *\r", fw_data or "") is None and
+                    re.match(r"^\? *\r", fw_data or "") is None):
+                logging.warning(
+                    'Missing data in dictionary: %s. Answer:\n%s',
+                    repr(cmd), repr(fw_data))
+            if fw_data and key is not None:
+                emulator.learning.store(key, fw_data)
+
+    def apply(self):
+        """
+        Update the "unknown_..._R" counters with the answers received by the
+        worker (invoked by the emulator thread).
+        """
+        results = self.results
+        while results:
+            session, unknown, fw_data = results.popleft()
+            session.statistics[unknown + "_R"] = repr(fw_data)
+
+    def stop(self):
+        """
+        Stop the workers after the queued requests.
+        """
+        for thread in self.threads:
+            try:
+                self.queue.put_nowait(None)
+            except self.full:
+                break  # daemon threads
+        self.threads = []
+
+
+def no_match(cmd):
+    """
+    Match function of the entries with invalid 'Request'.
+    """
+    return None
+
+
+class ScenarioEntry:
+    """
+    Compiled representation of an element of the ObdMessage dictionary,
+    prepared once by set_sorted_obd_msg() and used by handle_request().
+    The 'Request' regular expression is compiled when the entry is checked
+    for the first time (only the entries selected by the dispatch index
+    are checked), so match() shall be used to match a request.
+    """
+    __slots__ = ('pid', 'val', 'uc_val', 'request', 'header', 'action',
+                 'descr', 'task', 'exec_code', 'log_string', 'log_code',
+                 'response', 'response_header', 'response_footer',
+                 'has_response', 'id', 'match')
+
+    def __init__(self, key, val, cache=None):
+        """
+        :param key: PID
+        :param val: dictionary element
+        :param cache: ScenarioCache object providing the compiled code
+        """
+        self.pid = key if key else 'UNKNOWN'
+        self.id = counter_id(self.pid)  # index of the statistics counter
+        self.val = val  # original dictionary element
+        self.uc_val = {k.upper(): v for k, v in val.items()}
+        uc_val = self.uc_val
+        compile_function = cache.get if cache else lambda f, *args: f(*args)
+
+        self.request = uc_val.get('REQUEST')  # string or compiled pattern
+        self.match = self.compile_match
+
+        self.header = uc_val.get('HEADER')
+        if isinstance(self.header, str):
+            self.header = self.header.upper()
+        self.action = uc_val.get('ACTION')
+        self.descr = uc_val.get('DESCR')
+        self.task = uc_val.get('TASK')
+
+        self.exec_code = uc_val.get('EXEC')
+        if isinstance(self.exec_code, str):
+            self.exec_code = compile_function(
+                compile_code, self.exec_code, "<Exec %s>" % self.pid)
+
+        self.log_string = ""
+        if 'INFO' in uc_val:
+            self.log_string = "logging.info(%s)" % uc_val['INFO']
+        if 'WARNING' in uc_val:
+            self.log_string = "logging.warning(%s)" % uc_val['WARNING']
+        if 'LOG' in uc_val:
+            self.log_string = "logging.debug(%s)" % uc_val['LOG']
+        self.log_code = None
+        if self.log_string:
+            self.log_code = compile_function(
+                compile_code, self.log_string, "<Log %s>" % self.pid)
+
+        self.response = uc_val.get('RESPONSE', '')
+        self.response_header = uc_val.get('RESPONSEHEADER')
+        self.response_footer = uc_val.get('RESPONSEFOOTER')
+        self.has_response = any(x in uc_val for x in
+            ['RESPONSE', 'RESPONSEHEADER', 'RESPONSEFOOTER'])
+
+    def compile_match(self, cmd):
+        """
+        First call of match(): compile the 'Request' regular expression,
+        then match the request.
+        :param cmd: request string
+        :return: match object or None
+        """
+        try:
+            self.match = compile_request(self.request).match
+        except Exception as e:
+            logging.error("Invalid 'Request' %s for PID %s: %s",
+                          repr(self.request), self.pid, e)
+            self.match = no_match
+        return self.match(cmd)
+
+
+class ScenarioCache:
+    """
+    Disk cache of the compiled form of a scenario (literal prefixes of the
+    dispatch index and code objects of the dictionary tags), so that a new
+    process does not need to compile them again. Data are written with
+    marshal to a file of the __pycache__ directory of the package, named
+    after the scenario (ref. cache_file()) and stamped with this module,
+    which includes the compile functions (ref. file_stamp()). Each item is
+    keyed by its source string (and by the arguments of the compile
+    function), so changes to the dictionary never return stale data: new
+    items are compiled and the file is rewritten with the items of the
+    scenario.
+    """
+
+    def __init__(self, scenario):
+        self.file = cache_file(
+            "scenario." + re.sub(r'[^\w-]', '_', scenario))
+        self.stamp = file_stamp(os.path.abspath(__file__))
+        self.items = read_cache(self.file, self.stamp)  # key: value
+        if not isinstance(self.items, dict):
+            self.items = {}
+        self.used = {}  # items used by the latest set_sorted_obd_msg()
+        self.dirty = False  # True if items are to be written
+
+    def get(self, function, *args):
+        """
+        Return the cached result of function(*args), computing it if
+        not cached.
+        :param function: compile function (its name is part of the key)
+        :param args: arguments (the first one is the source string)
+        :return: function result
+        """
+        key = (function.__name__,) + args
+        try:
+            value = self.items[key]
+        except KeyError:
+            value = self.items[key] = function(*args)
+            self.dirty = True
+        self.used[key] = value
+        return value
+
+    def start(self):
+        """
+        Start collecting the items used by a new set_sorted_obd_msg() call.
+        """
+        self.used = {}
+
+    def save(self):
+        """
+        Write the items used by the scenario, if new items were compiled.
+        :return: False if the file cannot be written, otherwise True
+        """
+        if not self.dirty:
+            return True
+        self.items = self.used
+        self.dirty = False
+        items = {}
+        for key, value in self.used.items():
+            try:
+                marshal.dumps(value)
+            except ValueError:  # not serializable
+                continue
+            items[key] = value
+        return write_cache(self.file, self.stamp, items)
+
+
+class ScenarioIndex:
+    """
+    Compiled scenario (Elm.scenario_index): the dictionary items and the
+    related ScenarioEntry objects in priority order, the dispatch index
+    (literal prefix: positions in "entries"), the sorted prefix lengths
+    and the cache of the dispatched requests. It is never changed after
+    being published by set_sorted_obd_msg(), apart from the cache.
+    """
+    __slots__ = ('items', 'entries', 'index', 'lengths', 'cache',
+                 'snapshot')
+
+    def __init__(self, items, entries, index, lengths, snapshot=None):
+        self.items = items
+        self.entries = entries
+        self.index = index
+        self.lengths = lengths
+        self.cache = {}  # request: candidate entries (ref. Elm.dispatch())
+        self.snapshot = snapshot  # ref. Elm.scenario_snapshot()
+
+
+# Disk caches of the scenarios loaded by this process (name: ScenarioCache)
+scenario_caches = {}
+
+
+@lru_cache(maxsize=RESPONSE_CACHE_SIZE)
+def compile_response(resp):
+    """
+    Compile an XML response string into a template which can be rendered
+    by handle_response() without parsing XML again. The template only
+    depends on the response string (so it is cached in a bounded LRU);
+    formatting settings, request header/data, <eval> and <exec> tags are
+    applied when rendering.
+    :param resp: XML response string
+    :return: tuple of three elements:
+        - parse error string (None if the response is well-formed)
+        - escaped response string (used in log messages)
+        - tuple of operations; each operation is a tuple whose first
+            element is the operation name (mostly the XML tag name) and
+            the other ones are its static arguments.
+    """
+    from xml.etree.ElementTree import fromstring, ParseError
+    resp = resp.replace('\x00', '\\x00').replace('\x0d', '&#13;')
+    try:
+        root = fromstring('<xml>' + resp + '</xml>')
+    except ParseError as e:
+        return str(e), resp, ()
+    ops = []
+    if root.text and root.text.strip():
+        ops.append(('text', root.text.strip()))
+    s = iter(root)
+    i = None
+    while True:
+        try:
+            i = next(s)
+        except StopIteration:
+            if i is not None and i.tail and i.tail.strip():
+                ops.append(('text', i.tail.strip()))
+            break
+        tag = i.tag.lower()
+        if tag in ('rh', 'rd', 'string', 'writeln', 'space',
+                   'flow', 'answer', 'pos_answer', 'neg_answer'):
+            ops.append((tag, i.text or ""))
+        elif tag == 'eval' or tag == 'exec':
+            if i.text is None:
+                ops.append((tag, None, None, None))
+                continue  # the tail is not added
+            msg = i.text.strip()
+            eval_code = compile_code(msg, "<eval>", 'eval') if msg else None
+            if isinstance(eval_code, str):  # not an expression
+                eval_code = None
+            ops.append((tag, msg, eval_code,
+                        compile_code(msg, "<exec>") if msg else None))
+        elif tag == 'header':
+            try:
+                size = next(s)
+                data = next(s)
+            except StopIteration:
+                ops.append(('incomplete',
+                            'Missing <size> or <data>/<subd> tags '
+                            'after <header> tag in %s.', (repr(resp),)))
+                break
+            if (size.tag.lower() != 'size' or
+                    (data.tag.lower() != 'data' and
+                     data.tag.lower() != 'subd')):
+                ops.append(('incomplete',
+                            'In %s, <size> and <data>/<subd> tags '
+                            'must follow the <header> tag.', (repr(resp),)))
+                break
+            try:
+                int_size = int(size.text, 16)
+            except ValueError as e:
+                ops.append(('incomplete',
+                            'Improper size %s for response %s: %s.',
+                            (repr(size.text), repr(resp), e)))
+                break
+            if not data.text:
+                ops.append(('incomplete', 'Missing data for response %s.',
+                            (repr(resp),)))
+                break
+            unspaced_data = (data.text or "").translate(
+                (data.text or "").maketrans('', '', string.whitespace))
+            if int_size < 16 and len(unspaced_data) != int_size * 2:
+                ops.append(('incomplete',
+                            'In response %s, mismatch between number of data '
+                            'digits %s and related length field %s.',
+                            (repr(resp), repr(data.text), repr(size.text))))
+                break
+            ops.append(('header', i.text, size.text or "", data.text,
+                        unspaced_data, data.tag.lower() == 'data'))
+        else:
+            ops.append(('unknown', i.tag))
+        if i.tail and i.tail.strip():
+            ops.append(('text', i.tail.strip()))
+    return None, resp, tuple(ops)
+
+
+def iso_tp_format(payload, answer_header, use_headers, caf, sp, nl):
+    """
+    Format an ISO-TP (11 bit CAN identifier) answer in a single linear pass
+    over the payload bytes, producing a single frame, or a first frame
+    followed by consecutive frames.
+    :param payload: data bytes of the answer (bytes, bytearray or memoryview)
+    :param answer_header: string including the header of the answer
+    :param use_headers: boolean to indicate whether the header shall be
+            included (in this case the PCI bytes are always included)
+    :param caf: CAN Auto Formatting (False if the PCI bytes are included)
+    :param sp: space string
+    :param nl: newline string
+    :return: string including the formatted frames (without trailing
+            separators)
+    """
+    view = memoryview(payload)
+    length = len(view)
+    if length > ISO_TP_MAX_LENGTH:
+        raise ValueError(
+            "ISO-TP payload too long: %s bytes (max %s)" %
+            (length, ISO_TP_MAX_LENGTH))
+    if length <= 7:  # single frame
+        data = sp.join([HEX_BYTE[x] for x in view])
+        if use_headers:
+            return answer_header + sp + HEX_BYTE[length] + sp + data
+        if not caf:  # PCI byte in requests
+            return HEX_BYTE[length] + sp + data
+        return data
+
+    # multiframe output
+    pci = use_headers or not caf
+    prefix = answer_header + sp if use_headers else ""
+    if pci:
+        answer = [prefix + HEX_BYTE[0x10 | length >> 8] + sp +
+                  HEX_BYTE[length & 0xFF] + sp]
+    else:
+        answer = ["%03X" % length + nl + "0: "]
+    answer.append(sp.join([HEX_BYTE[x] for x in view[:6]]))
+    frame_count = 1
+    for pos in range(6, length, 7):
+        answer.append(sp + nl)
+        if pci:
+            answer.append(prefix + HEX_BYTE[0x20 | frame_count & 0x0F] + sp)
+        else:
+            answer.append("%01X" % (frame_count & 0x0F) + ": ")
+        answer.append(sp.join([HEX_BYTE[x] for x in view[pos:pos + 7]]))
+        frame_count += 1
+    return "".join(answer)
+
+
+class OutputProfile:
+    """
+    Formatting settings of the responses, derived from the 'cmd_cra',
+    'cmd_use_header', 'cmd_spaces', 'cmd_linefeeds' and 'cmd_caf' counters.
+    Built by Elm.get_output_profile() and kept until invalidated (reset,
+    AT commands changing the related counters, set_sorted_obd_msg() or
+    invalidate_output_profile()).
+    """
+    __slots__ = ('cra_pattern', 'cra_regex', 'use_headers', 'sp', 'nl',
+                 'prompt', 'caf')
+
+    def __init__(self, counters):
+        # ATCRA filter
+        self.cra_pattern = r'[0-9A-F]+'
+        cra = counters["cmd_cra"] if "cmd_cra" in counters else None
+        if cra:
+            self.cra_pattern = (r'^' + cra
+                                .replace('X', '[0-9A-F]')
+                                .replace('W', '[0-9A-F]+')
+                                + r'$')
+        self.cra_regex = re.compile(self.cra_pattern)
+
+        # Headers
+        self.use_headers = ("cmd_use_header" in counters and
+                            counters["cmd_use_header"])
+
+        # Space
+        if 'cmd_spaces' in counters and counters['cmd_spaces'] == 0:
+            self.sp = ''
+        else:
+            self.sp = ' '
+
+        # Newline and prompt
+        self.nl = "\r"
+        if 'cmd_linefeeds' in counters:
+            try:
+                self.nl = NL_TYPE[int(counters['cmd_linefeeds'])]
+            except Exception:
+                logging.error(
+                    'Invalid "cmd_linefeeds" value: %s.',
+                    repr(counters['cmd_linefeeds']))
+        if 'cmd_linefeeds' in counters and counters['cmd_linefeeds'] > 2:
+            self.prompt = ">"
+        else:
+            self.prompt = self.nl + ">"
+
+        # CAN Auto Formatting (False when PCI byte is included in requests)
+        self.caf = not ('cmd_caf' in counters and not counters['cmd_caf'])
+
+
+class Unset:
+    """
+    Type of the UNSET value of the Session attributes related to counters
+    which are not defined (it evaluates to False).
+    """
+    __slots__ = ()
+
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return 'UNSET'
+
+
+UNSET = Unset()
+
+
+class Session:
+    """
+    Protocol state of a client of the emulator: settings, statistics,
+    tasks and related data. The Elm instance has a default session; in
+    multi-session mode each TCP/IP connection has its own session, while
+    the dictionary and the compiled scenario are shared.
+    Frequently used settings (ref. SESSION_SETTINGS) are attributes (UNSET
+    if not defined); the other "cmd_..." settings are in the "settings"
+    dictionary and all the other counters (e.g., number of executed PIDs,
+    'commands', unknown requests) are in "statistics" (ref. Statistics).
+    "counters" is a dictionary view of all of them.
+    """
+    __slots__ = tuple(SESSION_SETTINGS.values()) + (
+        'settings', 'statistics', 'counters', 'tasks', 'task_shared_ns',
+        'request_timer', 'shared', 'output_profile', 'read_buffer', 'cmd',
+        'transport', 'peer', 'line', 'line_time', 'out_time', 'out_queue',
+        'out_handle', 'in_handle', 'capture', 'pid', 'slept', 'id',
+        'forward_answer', 'forward_pending', 'pacing', 'clock_offset')
+    ids = itertools.count()  # identifiers of the sessions (ref. Elm.trace)
+
+    def __init__(self, transport=None, peer=None):
+        self.id = next(Session.ids)
+        for attr in SESSION_SETTINGS.values():
+            setattr(self, attr, UNSET)
+        self.settings = {}
+        self.statistics = Statistics()
+        self.counters = Counters(self)
+        self.tasks = {}
+        self.task_shared_ns = {}
+        self.request_timer = {}
+        self.shared = None
+        self.output_profile = None
+        self.read_buffer = bytearray()  # read bytes not yet processed
+        self.cmd = None  # latest request
+        self.transport = transport  # asyncio transport (multi-session mode)
+        self.peer = peer  # client address (multi-session mode)
+        self.line = b""  # characters of the current request (multi-session)
+        self.line_time = 0  # time of the latest read data (multi-session)
+        self.out_time = 0  # time when the output can be written (ref. sleep)
+        self.out_queue = deque()  # deferred output: (due time, bytes) items
+        self.out_handle = None  # timer handle of the deferred output
+        self.in_handle = None  # timer handle of the deferred input
+        self.capture = None  # bytearray replacing the port (ref. Elm.query)
+        self.pid = None  # PID of the current request (None if unknown)
+        self.slept = 0  # blocking delays of the current request (seconds)
+        self.clock_offset = 0.0  # delays skipped by VirtualClock (seconds)
+        self.forward_answer = None  # (request, answer) read by forward_line
+        self.forward_pending = None  # (request, line) to forward in background
+        self.pacing = 0  # inter byte time of the response (timing replay)
+
+
+class Counters(MutableMapping):
+    """
+    Dictionary view of the counters of a session (Elm.counters), merging
+    the attributes in SESSION_SETTINGS, the "settings" dictionary (other
+    "cmd_..." counters) and the "statistics" dictionary.
+    Changing a counter of the output profile invalidates it.
+    """
+    __slots__ = ('session',)
+
+    def __init__(self, session):
+        self.session = session
+
+    def __getitem__(self, key):
+        attr = SESSION_SETTINGS.get(key)
+        if attr is not None:
+            value = getattr(self.session, attr)
+            if value is UNSET:
+                raise KeyError(key)
+            return value
+        if is_setting(key):
+            return self.session.settings[key]
+        return self.session.statistics[key]
+
+    def __setitem__(self, key, value):
+        attr = SESSION_SETTINGS.get(key)
+        if attr is not None:
+            setattr(self.session, attr, value)
+        elif is_setting(key):
+            self.session.settings[key] = value
+        else:
+            self.session.statistics[key] = value
+        if key in OUTPUT_PROFILE_COUNTERS:
+            self.session.output_profile = None
+
+    def __delitem__(self, key):
+        attr = SESSION_SETTINGS.get(key)
+        if attr is not None:
+            if getattr(self.session, attr) is UNSET:
+                raise KeyError(key)
+            setattr(self.session, attr, UNSET)
+        elif is_setting(key):
+            del self.session.settings[key]
+        else:
+            del self.session.statistics[key]
+        if key in OUTPUT_PROFILE_COUNTERS:
+            self.session.output_profile = None
+
+    def __contains__(self, key):
+        attr = SESSION_SETTINGS.get(key)
+        if attr is not None:
+            return getattr(self.session, attr) is not UNSET
+        if is_setting(key):
+            return key in self.session.settings
+        return key in self.session.statistics
+
+    def __iter__(self):
+        for key, attr in SESSION_SETTINGS.items():
+            if getattr(self.session, attr) is not UNSET:
+                yield key
+        yield from list(self.session.settings)
+        yield from list(self.session.statistics)
+
+    def __len__(self):
+        return (sum(getattr(self.session, attr) is not UNSET
+                    for attr in SESSION_SETTINGS.values()) +
+                len(self.session.settings) + len(self.session.statistics))
+
+    def clear(self):
+        for attr in SESSION_SETTINGS.values():
+            setattr(self.session, attr, UNSET)
+        self.session.settings.clear()
+        self.session.statistics.clear()
+        self.session.output_profile = None
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+def is_setting(key):
+    """
+    Return True if the counter "key" is a setting, False if it is a
+    statistics counter.
+    """
+    return isinstance(key, str) and key.startswith('cmd_')
+
+
+def session_property(name):
+    """
+    Return a property of the Elm class referring to the attribute "name"
+    of the current session (self.session).
+    """
+    def setter(self, value):
+        setattr(self.session, name, value)
+    return property(attrgetter('session.' + name), setter,
+                    doc='"%s" attribute of the current session' % name)
+
+
+def set_counters(self, value):
+    """
+    Setter of the Elm.counters property: replace all the counters of the
+    current session with the ones of the "value" dictionary.
+    """
+    counters = self.session.counters
+    if value is counters:
+        return
+    counters.clear()
+    counters.update(value)
+
+
+class SessionProtocol:
+    """
+    asyncio protocol of a TCP/IP connection in multi-session mode
+    (it implements the interface of asyncio.Protocol without deriving
+    from it, so that asyncio is only imported in multi-session mode)
+    """
+    def __init__(self, emulator):
+        self.emulator = emulator
+        self.session = None
+
+    def connection_made(self, transport):
+        self.session = self.emulator.open_session(transport)
+
+    def data_received(self, data):
+        self.emulator.session_data_received(self.session, data)
+
+    def eof_received(self):
+        return None  # close the transport
+
+    def pause_writing(self):
+        pass
+
+    def resume_writing(self):
+        pass
+
+    def connection_lost(self, exc):
+        self.emulator.close_session(self.session)
+
+
 class Elm:
     """
     Main class of the ELM327-emulator
@@ -388,6 +2140,29 @@ class Elm:
         PAUSED = 3
         TERMINATED = 4
 
+    @property
+    def session(self):
+        """
+        Current session of the calling thread: the session set by
+        switch_session() in this thread (e.g., by the emulator thread while
+        processing the requests of a client in multi-session mode),
+        otherwise the default session. Other threads (e.g., the command
+        prompt) are therefore not affected by the session switches of the
+        emulator thread.
+        """
+        return self.local.__dict__.get('session') or self.default_session
+
+    # Attributes of the current session
+    counters = property(attrgetter('session.counters'), set_counters,
+                        doc='Counters of the current session')
+    tasks = session_property('tasks')
+    task_shared_ns = session_property('task_shared_ns')
+    request_timer = session_property('request_timer')
+    shared = session_property('shared')
+    output_profile = session_property('output_profile')
+    read_buffer = session_property('read_buffer')
+    cmd = session_property('cmd')
+
     def sequence(self, pid, base, max, factor, n_bytes):
         """
         Generate a hex data string of n_bytes based on the number of times
@@ -402,7 +2177,7 @@ class Elm:
         :return: hex data string
         """
         # get the number of times a pid has been called
-        c = self.counters[pid] if pid in self.counters else 0
+        c = self.session.statistics.get(pid, 0)
         if self.choice_mode == self.Choice.SEQUENTIAL:
             c = c / self.choice_weights[0]
         # compute the new value [= factor * ( counter % (max * 2) ) + base]
@@ -412,13 +2187,56 @@ class Elm:
         # space the string into chunks of two bytes
         return " ".join(s[i:i + 2] for i in range(0, len(s), 2))
 
+    def get_output_profile(self, session=None):
+        """
+        Return the output profile, building it from the counters if it has
+        been invalidated.
+        :param session: Session object (default is the current session)
+        :return: OutputProfile object
+        """
+        session = session or self.session
+        if session.output_profile is None:
+            session.output_profile = OutputProfile(session.counters)
+        return session.output_profile
+
+    def invalidate_output_profile(self):
+        """
+        Invalidate the output profile, so that it is rebuilt at the next
+        response. Changing the 'cmd_cra', 'cmd_use_header', 'cmd_spaces',
+        'cmd_linefeeds' or 'cmd_caf' counters already does it.
+        """
+        self.session.output_profile = None
+
+    def sleep(self, seconds, session=None):
+        """
+        Delay the output of a session (e.g., P2 timer, STmin,
+        "<exec>self.sleep(4.5)</exec>" in the dictionary).
+        Single session, or virtual clock: wait through the emulator clock
+        (Elm.clock), which blocks the thread with RealClock and moves the
+        time forward without waiting with VirtualClock.
+        Multi-session mode with real clock: do not block; the subsequent output and the
+        processing of the next requests of the session are deferred by the
+        given time, while the other sessions continue to be served.
+        :param seconds: delay in seconds
+        :param session: Session object (default is the current session)
+        """
+        if not seconds or seconds < 0:
+            return
+        session = session or self.session
+        if session.transport is None or self.clock.virtual:
+            self.clock.sleep(seconds)
+            if not self.clock.virtual:
+                session.slept += seconds
+            return
+        session.out_time = max(session.out_time, time.monotonic()) + seconds
+
     def reset(self, sleep):
         """
         Return all settings to their defaults.
         Called by __init__(), ATZ and ATD.
         """
         logging.debug("Resetting counters and sleeping for %s seconds", sleep)
-        time.sleep(sleep)
+        self.sleep(sleep)
         for i in [k for k in self.counters if k.startswith('cmd_')]:
             del (self.counters[i])
         self.counters['ELM_PIDS_A'] = 0
@@ -427,6 +2245,7 @@ class Elm:
         self.counters['cmd_set_header'] = ECU_ADDR_E.upper()
         self.counters['cmd_version'] = self.version
         self.counters.update(self.presets)
+        self.output_profile = None
 
     def set_defaults(self):
         """
@@ -440,42 +2259,47 @@ class Elm:
         self.answer = {}
         self.counters = {}
         self.counters.update(self.presets)
-        if hasattr(self, "tasks"):
-            for ecu in self.tasks:
-                for i in reversed(self.tasks[ecu]):
-                    logging.debug(
-                        'Stopping task "%s", ECU="%s", '
-                        'method=stop()',
-                        i.__module__,
-                        ecu)
-                    try:  # Run the stop() method
-                        i.stop(None)
-                    except Exception as e:
-                        logging.critical(
-                            'Error while stopping task "%s", ECU="%s", '
-                            'method=stop(): %s',
-                            i.__module__,
-                            ecu,
-                            e, exc_info=True)
-        self.tasks = {}
-        if hasattr(self, "task_shared_ns"):
-            for ecu in self.task_shared_ns:
+        self.output_profile = None
+        self.stop_tasks()
+        self.shared = None
+
+    def stop_tasks(self):
+        """
+        Run the stop() method of all the tasks of the current session.
+        """
+        for ecu in self.tasks:
+            for i in reversed(self.tasks[ecu]):
                 logging.debug(
-                    'Stopping ECU task "%s", ECU="%s", '
+                    'Stopping task "%s", ECU="%s", '
                     'method=stop()',
-                    self.task_shared_ns[ecu].__module__,
+                    i.__module__,
                     ecu)
-                try: # Run the stop() method
-                    self.task_shared_ns[ecu].stop(None)
+                try:  # Run the stop() method
+                    i.stop(None)
                 except Exception as e:
                     logging.critical(
-                        'Error while stopping ECU task "%s", ECU="%s", '
+                        'Error while stopping task "%s", ECU="%s", '
                         'method=stop(): %s',
-                        self.task_shared_ns[ecu].__module__,
+                        i.__module__,
                         ecu,
                         e, exc_info=True)
+        self.tasks = {}
+        for ecu in self.task_shared_ns:
+            logging.debug(
+                'Stopping ECU task "%s", ECU="%s", '
+                'method=stop()',
+                self.task_shared_ns[ecu].__module__,
+                ecu)
+            try: # Run the stop() method
+                self.task_shared_ns[ecu].stop(None)
+            except Exception as e:
+                logging.critical(
+                    'Error while stopping ECU task "%s", ECU="%s", '
+                    'method=stop(): %s',
+                    self.task_shared_ns[ecu].__module__,
+                    ecu,
+                    e, exc_info=True)
         self.task_shared_ns = {}
-        self.shared = None
 
     def set_sorted_obd_msg(self, scenario=None):
         """
@@ -485,26 +2309,135 @@ class Elm:
         and 'AT' subdictionaries (they should be there if using the default
         ObdMessage), use them, otherwise only the subdictionary of the selected
         scenario is used.
+        The compiled entries and the dispatch index are built apart and
+        published with one assignment (self.scenario_index), so that a
+        request processed by another thread uses either the previous or
+        the new scenario, never a partially built one.
         :param scenario: when set, it changes the scenario
         :return: (none)
         """
 
         if scenario is not None:
             self.scenario = scenario
+        scenario = self.scenario
+        merged = self.merge_scenario(scenario)
+        # Add 'Priority' to all pids and sort basing on priority (highest = 1, lowest=10)
+        items = sorted(
+            merged.items(),
+            key=lambda x: x[1]['Priority'] if 'Priority' in x[1] else 10)
+        cache = None
+        if SCENARIO_DISK_CACHE:
+            cache = scenario_caches.get(scenario)
+            if cache is None:
+                cache = scenario_caches[scenario] = ScenarioCache(scenario)
+            cache.start()
+        entries = [ScenarioEntry(key, val, cache) for key, val in items]
+        index, lengths = self.build_dispatch_index(entries, cache)
+        self.scenario_index = ScenarioIndex(
+            items, entries, index, lengths,
+            self.scenario_snapshot(scenario, merged))
+        if cache:
+            cache.save()
+
+    def merge_scenario(self, scenario):
+        """
+        Return the union of the subdictionaries of a scenario (ref.
+        set_sorted_obd_msg()).
+        """
         if 'default' in self.ObdMessage and 'AT' in self.ObdMessage:
             # Perform a union of the three subdictionaries
-            self.sortedOBDMsg = {
+            return {
                 **self.ObdMessage['default'],  # highest priority
                 **self.ObdMessage['AT'],
-                **self.ObdMessage[self.scenario]
+                **self.ObdMessage[scenario]
                 # lowest priority ('Priority' to be checked)
             }
+        return {**self.ObdMessage[scenario]}
+
+    @staticmethod
+    def scenario_snapshot(scenario, merged):
+        """
+        Return a string representation of the dictionary of a scenario,
+        used to detect changes (ref. scenario_changed()); functions (e.g.,
+        'ResponseHeader' lambdas) are represented by their identity.
+        :return: string
+        """
+        return repr((scenario, merged))
+
+    def scenario_changed(self):
+        """
+        Check whether the scenario or the related subdictionaries of
+        ObdMessage have changed after the latest set_sorted_obd_msg().
+        :return: True if set_sorted_obd_msg() shall be called
+        """
+        return self.scenario_index.snapshot != self.scenario_snapshot(
+            self.scenario, self.merge_scenario(self.scenario))
+
+    @property
+    def sortedOBDMsg(self):
+        """
+        (key, value) items of the current scenario in priority order.
+        """
+        return self.scenario_index.items
+
+    @property
+    def scenario_entries(self):
+        """
+        ScenarioEntry objects of the current scenario in priority order.
+        """
+        return self.scenario_index.entries
+
+    @staticmethod
+    def build_dispatch_index(entries, cache=None):
+        """
+        Build the request dispatch index of a list of ScenarioEntry objects.
+        Each entry is bucketed by the literal prefix of its 'Request'
+        regular expression (e.g., "0105", "ATSH", "2EF190"); entries without
+        a literal prefix go to the "" bucket, which is always checked.
+        Buckets store positions in the list, so that merging the buckets
+        keeps the priority ordering.
+        :param entries: list of ScenarioEntry objects in priority order
+        :param cache: ScenarioCache object providing the prefixes
+        :return: (index, sorted list of the prefix lengths) tuple
+        """
+        index = {}
+        for position, entry in enumerate(entries):
+            if entry.request is None:  # entries without 'Request' never match
+                continue
+            if cache and isinstance(entry.request, str):
+                prefix = cache.get(regex_literal_prefix, entry.request)
+            else:
+                prefix = regex_literal_prefix(entry.request)
+            index.setdefault(prefix, []).append(position)
+        return index, sorted({len(k) for k in index})
+
+    def dispatch(self, cmd):
+        """
+        Return the dictionary entries which might match the request,
+        in priority order. Only the buckets whose literal prefix is a
+        prefix of the request are merged; results are cached per request.
+        :param cmd: sanitized request (unspaced, uppercase)
+        :return: list of ScenarioEntry elements
+        """
+        scenario_index = self.scenario_index  # consistent during the call
+        cache = scenario_index.cache
+        candidates = cache.get(cmd)
+        if candidates is not None:
+            return candidates
+        index = scenario_index.index
+        buckets = [index[cmd[:length]]
+                   for length in scenario_index.lengths
+                   if length <= len(cmd) and cmd[:length] in index]
+        if len(buckets) == 1:
+            positions = buckets[0]
         else:
-            self.sortedOBDMsg = {**self.ObdMessage[self.scenario]}
-        # Add 'Priority' to all pids and sort basing on priority (highest = 1, lowest=10)
-        self.sortedOBDMsg = sorted(
-            self.sortedOBDMsg.items(),
-            key=lambda x: x[1]['Priority'] if 'Priority' in x[1] else 10)
+            positions = sorted(p for bucket in buckets for p in bucket)
+        entries = scenario_index.entries
+        candidates = [entries[p] for p in positions]
+        if len(cache) >= DISPATCH_CACHE_SIZE:
+            cache.clear()
+        cache[cmd] = candidates
+        return candidates
 
     def __init__(
             self,
@@ -519,7 +2452,40 @@ class Elm:
             forward_net_port=None,
             forward_serial_port=None,
             forward_serial_baudrate=None,
-            forward_timeout=None):
+            forward_timeout=None,
+            forward_terminator=FORWARD_PROMPT,
+            forward_learn_ttl=None,
+            forward_background=False,
+            timing_record=False,
+            timing_replay=None,
+            multi_session=False,
+            clock=None,
+            metrics_port=None):
+        self.clock = clock or RealClock()  # clock of timers and delays
+        self.default_session = Session()  # session of the port client
+        self.local = threading.local()  # current session of each thread
+        self.clock.bind(lambda: self.session)
+        self.sessions = []  # client sessions (multi-session mode)
+        self.latency = {}  # LatencyHistogram of each PID (None if unknown)
+        self.task_latency = {}  # LatencyHistogram of each task method
+        self.profiler = StackSampler()  # sampling profiler of run()
+        self.trace = TraceBuffer(self.clock)  # trace of the exchanged bytes
+        self.forward_latency = LatencyHistogram()  # forwarder round trips
+        self.learning = LearningCache(  # answers of the forwarder
+            self.clock, forward_learn_ttl or None)
+        self.learning.enabled = forward_learn_ttl is not None
+        self.forward_queue = ForwardQueue(self) if forward_background else None
+        self.timing = TimingProfile()  # response timing of the forwarder
+        self.timing.recording = timing_record
+        if timing_replay:
+            self.timing.load(timing_replay)
+            self.timing.replay = True
+        self.metrics_port = metrics_port
+        self.metrics_server = None  # HTTP server of the metrics (ref. metrics)
+        self.run_thread_id = None  # identifier of the thread running run()
+        self.request_lock = threading.RLock()  # ref. query_many()
+        self.loop = None  # asyncio event loop (multi-session mode)
+        self.multi_session = multi_session
         self.version = ELM_VERSION
         self.header_version = ELM_HEADER_VERSION
         self.presets = {}
@@ -539,19 +2505,22 @@ class Elm:
         self.forward_serial_port = forward_serial_port
         self.forward_serial_baudrate = forward_serial_baudrate
         self.forward_timeout = forward_timeout
+        if isinstance(forward_terminator, str):
+            forward_terminator = forward_terminator.encode()
+        self.forward_terminator = forward_terminator or None
         self.reset(0)
         self.slave_name = None  # pty port name, if pty is used
         self.master_fd = None  # pty port FD, if pty is used, or device com port FD (IO)
         self.slave_fd = None  # pty side used by the client application
         self.serial_fd = None  # serial COM port file descriptor (pySerial)
         self.sock_inet = None
-        self.fw_sock_inet = None
-        self.fw_serial_fd = None
+        self.forwarder = None  # pool of the OBD-II interfaces (forwarder)
         self.sock_conn = None
         self.sock_addr = None
         self.thread = None
+        self.logger = logging.getLogger()
+        self.update_log_level()  # set self.log_debug
         self.plugins = {}
-        self.request_timer = {}
         self.choice_mode = self.Choice.SEQUENTIAL
         self.choice_weights = [1]
 
@@ -608,6 +2577,15 @@ class Elm:
                 self.sock_inet.close()
         except:
             logging.debug("Cannot close file descriptors.")
+        if self.forward_queue is not None:
+            self.forward_queue.stop()
+        if self.forwarder is not None:
+            self.forwarder.stop()
+            self.forwarder = None
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+            self.metrics_server = None
         self.set_defaults()
         logging.debug("Terminated.")
         return True
@@ -687,6 +2665,7 @@ class Elm:
             return True
         elif self.serial_port:  # pySerial COM
             try:
+                import serial
                 self.serial_fd = serial.Serial(
                     port=self.serial_port,
                     baudrate=self.serial_baudrate or SERIAL_BAUDRATE)
@@ -754,17 +2733,25 @@ class Elm:
                                     else 1
                                     for i in range(len_values)])[0]
         elif self.choice_mode == self.Choice.SEQUENTIAL:
-            if "cmd_last_pid" not in self.counters:
+            session = self.session
+            if session.last_pid is UNSET:
                 logging.error(
                     'Internal error - Invalid choice usage; '
                     'missing "cmd_last_pid" counter.')
             return (
-                values[int((self.counters[self.counters["cmd_last_pid"]] - 1) /
+                values[int((session.statistics[session.last_pid] - 1) /
                            self.choice_weights[0]) % len(values)])
         else:
             logging.error(
                 "Internal error - Invalid choice mode.")
 
+    def load_plugins(self):
+        """
+        List the task plugins (self.plugins); each plugin is imported and
+        validated when used for the first time (ref. Plugins).
+        """
+        self.plugins = Plugins()
+
     def run(self):  # daemon thread
         """
         This is the core method.
@@ -774,14 +2761,16 @@ class Elm:
 
         No return code.
         """
+        self.run_thread_id = threading.get_ident()
         setup_logging()
         self.logger = logging.getLogger()
-        if self.net_port:
+        self.update_log_level()
+        if self.net_port and not self.multi_session:
             if not self.socket_server():
                 logging.critical("Net connection failed.")
                 self.terminate()
                 return False
-        else:
+        elif not self.multi_session:
             if (not self.device_port and
                     not self.serial_port and
                     not self.get_pty()):
@@ -792,7 +2781,7 @@ class Elm:
                 self.terminate()
                 return False
 
-        if self.sock_inet:
+        if self.sock_inet or self.multi_session:
             if self.net_port:
                 msg = 'at ' + self.get_port_name()
             else:
@@ -809,24 +2798,15 @@ class Elm:
                 '%s\n', __version__, msg)
         """ the ELM's main IO loop """
 
-        # Load and validate plugins
-        self.plugins = {
-            name: importlib.import_module(PLUGIN_DIR + "." + name)
-            for finder, name, ispkg
-            in pkgutil.iter_modules(
-                importlib.import_module(PLUGIN_DIR).__path__)
-            if name.startswith('task_')
-        }
-        remove = []
-        for k, v in self.plugins.items():
-            if (not (hasattr(v, "Task")) or
-                    not inspect.isclass(v.Task)):
-                logging.critical(
-                    "Task class not available in plugin %s", k)
-                remove += [k]
-                continue
-        for k in remove:
-            del self.plugins[k]
+        self.load_plugins()
+        self.get_forwarder()  # connect the OBD-II interfaces
+
+        if self.metrics_port and self.metrics_server is None:
+            from .metrics import start_metrics_server
+            self.metrics_server = start_metrics_server(self, self.metrics_port)
+
+        if self.multi_session:
+            return self.serve_sessions()
 
         self.threadState = self.THREAD.ACTIVE
         while (self.threadState != self.THREAD.STOPPED and
@@ -836,40 +2816,377 @@ class Elm:
                 continue
 
             # get the latest request
-            self.cmd = self.normalized_read_line()
+            cmd = self.normalized_read_line()
             if (self.threadState == self.THREAD.STOPPED or
                     self.threadState == self.THREAD.TERMINATED):
                 return True
-            if self.cmd is None:
+            if cmd is None:
                 continue
+            with self.request_lock:
+                self.process_request(cmd)
+            self.end_forward_line()
+        return True
 
-            # process 'fast' option (command repetition)
-            if re.match('^ *$', self.cmd) and "cmd_last_cmd" in self.counters:
-                self.cmd = self.counters["cmd_last_cmd"]
-                logging.debug("repeating previous command: %s", repr(self.cmd))
-            else:
-                self.counters["cmd_last_cmd"] = self.cmd
-                logging.debug("Received %s", repr(self.cmd))
+    def process_request(self, cmd):
+        """
+        Process a request read from the port and write the response.
+        :param cmd: request string (without newline)
+        :return: (none)
+        """
+        session = self.session
+        forward_queue = self.forward_queue
+        if forward_queue is not None and forward_queue.results:
+            forward_queue.apply()
+
+        # process 'fast' option (command repetition)
+        if re.match('^ *$', cmd) and session.last_cmd is not UNSET:
+            cmd = session.last_cmd
+            if self.log_debug:
+                logging.debug("repeating previous command: %r", cmd)
+        else:
+            session.last_cmd = cmd
+            if self.log_debug:
+                logging.debug("Received %r", cmd)
+        session.cmd = cmd
+
+        # if the request includes valid data, handle it
+        if re.match(ELM_VALID_CHARS, cmd):
+            start = time.perf_counter()
+            session.pid = None
+            session.slept = 0
+            try:
+                request_header, request_data, resp = self.handle_request(
+                    cmd, do_write=True, session=session)
+            except Exception as e:
+                logging.critical("Error while processing %s:\n%s\n%s",
+                                 repr(cmd), e, traceback.format_exc())
+                return
+            if resp is not None:
+                if self.timing.replay:
+                    self.replay_timing(request_data, session)
+                self.handle_response(
+                    resp,
+                    do_write=True,
+                    request_header=request_header,
+                    request_data=request_data,
+                    session=session)
+                session.pacing = 0
+            self.record_latency(
+                self.latency, session.pid, start + session.slept)
+        else:
+            logging.warning("Invalid request: %s", repr(cmd))
 
-            # if the request includes valid data, handle it
-            if re.match(ELM_VALID_CHARS, self.cmd):
-                try:
-                    request_header, request_data, resp = self.handle_request(
-                        self.cmd, do_write=True)
-                except Exception as e:
-                    logging.critical("Error while processing %s:\n%s\n%s",
-                                     repr(self.cmd), e, traceback.format_exc())
-                    continue
-                if resp is not None:
-                    self.handle_response(
-                        resp,
-                        do_write=True,
-                        request_header=request_header,
-                        request_data=request_data)
-            else:
-                logging.warning("Invalid request: %s", repr(self.cmd))
+    def replay_timing(self, cmd, session):
+        """
+        Sleep for a latency sampled from the timing profile of a request
+        (ref. TimingProfile.sample()) and set the byte pacing of its
+        response.
+        :param cmd: sanitized request
+        :param session: Session object
+        """
+        sample = self.timing.sample(cmd, session.pid)
+        if sample is not None:
+            self.sleep(sample[0], session)
+            session.pacing = sample[1]
+
+    def update_log_level(self):
+        """
+        Check whether debug messages are processed by any handler of the
+        logger (not only by the logger itself: handlers can have their own
+        level, e.g., set by the "loglevel" command), caching the result in
+        self.log_debug, so that the arguments of the debug messages on the
+        request path are not built when they would be discarded. To be
+        called after changing the level of the logger or of its handlers.
+        :return: self.log_debug
+        """
+        self.log_debug = log_debug_enabled(self.logger)
+        return self.log_debug
+
+    def record_latency(self, histograms, key, start):
+        """
+        Add the time elapsed since start to the histogram of a PID or task.
+        :param histograms: self.latency or self.task_latency
+        :param key: PID or task method name
+        :param start: time.perf_counter() value at the start of the processing
+        """
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = LatencyHistogram()
+        histogram.record(int((time.perf_counter() - start) * 1e9))
+
+    def query(self, cmd, session=None):
+        """
+        Process a request in-process and return the response, without
+        using the port (e.g., for test harnesses). Counters, settings and
+        tasks are updated as with a request read from the port.
+        :param cmd: request string (without newline)
+        :param session: Session object (default is the current session)
+        :return: bytes written in response to the request (b"" if none)
+        """
+        return self.query_many((cmd,), session)[0]
+
+    def query_many(self, cmds, session=None):
+        """
+        Process a sequence of requests in-process (ref. query()).
+        It can be called by another thread while run() serves the port:
+        the requests are processed one at a time (self.request_lock), and
+        the session switch is local to the calling thread. In this case, a
+        dedicated session is needed in single-session mode, as the default
+        session is the one of the port client: e.g.,
+        emulator.query_many(cmds, emulator.new_session())
+        :param cmds: iterable of request strings (without newline)
+        :param session: Session object (default is the current session)
+        :return: list of the responses (bytes), one for each request
+        :raise RuntimeError: if the default session is used by another
+            thread while run() serves the port in single-session mode
+        """
+        if (not self.multi_session and
+                self.run_thread_id not in (None, threading.get_ident()) and
+                getattr(self, 'threadState', None) in (
+                    self.THREAD.ACTIVE, self.THREAD.PAUSED) and
+                (session or self.session) is self.default_session):
+            raise RuntimeError(
+                "the default session is used by the port client: "
+                "query_many() needs a dedicated session (new_session())")
+        if session is not None and session is not self.session:
+            previous = self.switch_session(session)
+            try:
+                return self.query_many(cmds)
+            finally:
+                self.switch_session(previous)
+
+        if not self.plugins:
+            self.load_plugins()
+        session = self.session
+        with self.request_lock:
+            capture = session.capture
+            session.capture = output = bytearray()
+            answers = []
+            try:
+                for cmd in cmds:
+                    self.trace.record('in', session, cmd.encode() + b'\r')
+                    self.process_request(cmd)
+                    answers.append(bytes(output))
+                    output.clear()
+            finally:
+                session.capture = capture
+        return answers
+
+    def serve_sessions(self):
+        """
+        Multi-session mode: serve concurrent TCP/IP connections through an
+        asyncio event loop, each one with its own session (ref. Session).
+        Requests of all the sessions are processed by this thread.
+        :return: False if the port cannot be opened, otherwise True
+        """
+        import asyncio
+        loop = self.loop = asyncio.new_event_loop()
+        try:
+            server = loop.run_until_complete(loop.create_server(
+                lambda: SessionProtocol(self),
+                host=NETWORK_INTERFACES or None,
+                port=self.net_port,
+                reuse_address=True))
+        except OSError as e:
+            logging.critical("Net connection failed: %s", e)
+            loop.close()
+            self.terminate()
+            return False
+        self.threadState = self.THREAD.ACTIVE
+        try:
+            loop.run_until_complete(self.wait_sessions())
+        finally:
+            server.close()
+            for session in list(self.sessions):
+                session.transport.close()
+            loop.run_until_complete(server.wait_closed())
+            loop.run_until_complete(asyncio.sleep(0))  # run connection_lost()
+            loop.close()
+            self.loop = None
         return True
 
+    async def wait_sessions(self):
+        """
+        Coroutine of the multi-session mode returning at termination time
+        and pausing the reading of all sessions while the emulator is paused.
+        """
+        import asyncio
+        paused = False
+        while (self.threadState != self.THREAD.STOPPED and
+               self.threadState != self.THREAD.TERMINATED):
+            if paused != (self.threadState == self.THREAD.PAUSED):
+                paused = not paused
+                for session in self.sessions:
+                    if paused:
+                        session.transport.pause_reading()
+                    else:
+                        session.transport.resume_reading()
+            await asyncio.sleep(0.1)
+
+    def switch_session(self, session):
+        """
+        Make "session" the current session of the calling thread, referred
+        by the session attributes of the Elm instance (counters, tasks,
+        etc.) in this thread.
+        :param session: Session object
+        :return: previous session
+        """
+        local = self.local.__dict__
+        previous = local.get('session') or self.default_session
+        local['session'] = session
+        return previous
+
+    def new_session(self, transport=None, peer=None):
+        """
+        Create a new session with default settings (ref. reset()).
+        :param transport: asyncio transport (multi-session mode)
+        :param peer: client address (multi-session mode)
+        :return: Session object
+        """
+        session = Session(transport, peer)
+        previous = self.switch_session(session)
+        try:
+            self.reset(0)
+        finally:
+            self.switch_session(previous)
+        return session
+
+    def open_session(self, transport):
+        """
+        Create the session of a new TCP/IP connection (multi-session mode).
+        :param transport: asyncio transport of the connection
+        :return: Session object
+        """
+        session = self.new_session(
+            transport, transport.get_extra_info('peername'))
+        if self.threadState == self.THREAD.PAUSED:
+            transport.pause_reading()
+        self.sessions.append(session)
+        logging.debug("Connected by %s (%s sessions)",
+                      session.peer, len(self.sessions))
+        return session
+
+    def close_session(self, session):
+        """
+        Stop the tasks of a session whose connection is terminated.
+        :param session: Session object
+        """
+        for handle in session.in_handle, session.out_handle:
+            if handle is not None:
+                handle.cancel()
+        session.in_handle = session.out_handle = None
+        session.out_queue.clear()
+        default_session = self.switch_session(session)
+        try:
+            self.stop_tasks()
+        finally:
+            self.switch_session(default_session)
+        if session in self.sessions:
+            self.sessions.remove(session)
+        logging.debug("Connection closed by %s (%s sessions)",
+                      session.peer, len(self.sessions))
+
+    def session_data_received(self, session, data):
+        """
+        Process the data received by a TCP/IP connection (multi-session mode)
+        and answer to each of the included requests.
+        :param session: Session object
+        :param data: received bytes
+        """
+        default_session = self.switch_session(session)
+        try:
+            now = self.clock.monotonic()
+            if session.line and (session.line_time + self.get_req_timeout()
+                                 < now):
+                session.line = b""
+                logging.debug(
+                    "'req_timeout' timeout while reading data: %s", data)
+        finally:
+            self.switch_session(default_session)
+        session.line_time = now
+        self.trace.record('in', session, data)
+        session.read_buffer += data
+        if session.in_handle is None:
+            self.process_session(session)
+
+    def process_session(self, session):
+        """
+        Process the requests buffered by a session (multi-session mode).
+        While the output of the session is delayed (ref. sleep), the
+        processing is rescheduled to the time when the delay expires, so
+        that each request is answered with the configured timing without
+        blocking the other sessions.
+        :param session: Session object
+        """
+        session.in_handle = None
+        if session.transport.is_closing():
+            return
+        default_session = self.switch_session(session)
+        try:
+            while session.read_buffer:
+                if session.out_time > time.monotonic():
+                    session.in_handle = self.loop.call_at(
+                        self.loop_time(session.out_time),
+                        self.process_session, session)
+                    return
+                line = self.read_buffered_line(session.line)
+                if line is None:
+                    return
+                session.line, complete = line
+                if not complete:
+                    continue
+                cmd, session.line = session.line.decode("ascii", "ignore"), b""
+                self.forward_line(cmd)
+                with self.request_lock:
+                    self.process_request(cmd)
+                self.end_forward_line()
+        finally:
+            self.switch_session(default_session)
+
+    def loop_time(self, monotonic_time):
+        """
+        Convert a time.monotonic() value to the clock of the event loop.
+        :param monotonic_time: time returned by time.monotonic()
+        :return: corresponding time of the event loop
+        """
+        return self.loop.time() + monotonic_time - time.monotonic()
+
+    def session_write(self, session, data):
+        """
+        Write data to the connection of a session (multi-session mode).
+        If the output of the session is delayed (ref. sleep), the data are
+        queued and written by the event loop when the delay expires.
+        :param session: Session object
+        :param data: bytes to be written
+        """
+        if not session.out_queue and session.out_time <= time.monotonic():
+            session.transport.write(data)
+            return
+        session.out_queue.append((session.out_time, data))
+        if session.out_handle is None:
+            session.out_handle = self.loop.call_at(
+                self.loop_time(session.out_queue[0][0]),
+                self.flush_session_output, session)
+
+    def flush_session_output(self, session):
+        """
+        Write the queued output of a session whose delay is expired and
+        reschedule the remaining one (multi-session mode).
+        :param session: Session object
+        """
+        session.out_handle = None
+        if session.transport.is_closing():
+            session.out_queue.clear()
+            return
+        queue = session.out_queue
+        now = time.monotonic()
+        while queue and queue[0][0] <= now:
+            session.transport.write(queue.popleft()[1])
+        if queue:
+            session.out_handle = self.loop.call_at(
+                self.loop_time(queue[0][0]),
+                self.flush_session_output, session)
+
     def accept_connection(self):
         """
         Perform the "accept" socket method of an INET connection.
@@ -891,115 +3208,54 @@ class Elm:
             logging.debug("Connected by %s", self.sock_addr)
         return True
 
-    def serial_client(self):
-        """
-        Internally used by send_receive_forward().
-        Open the forwarded port if serial mode is used..
-        :return: True when successfully opened, otherwise False
-        """
-        if self.fw_serial_fd:
-            return True
-        try:
-            self.fw_serial_fd = serial.Serial(
-                port=self.forward_serial_port,
-                baudrate=int(self.forward_serial_baudrate)
-                if self.forward_serial_baudrate else SERIAL_BAUDRATE,
-                timeout=self.forward_timeout or FORWARD_READ_TIMEOUT)
-            return True
-        except Exception as e:
-            logging.error('Cannot open forward port: %s', e)
-            return False
-
-    def net_client(self):
+    def get_forwarder(self):
         """
-        Internally used by send_receive_forward()
-        Open a socket connection if socket mode is used.
-        :return: (not really used)
+        Return the forwarder (Forwarder object of the forwarder module),
+        created and started the first time if the forward_... arguments
+        configure an OBD-II interface.
+        :return: Forwarder object, or None if not configured
         """
-        if (self.fw_sock_inet
-                or self.forward_net_host is None
-                or self.forward_net_port is None):
-            return False
-        s = None
-        for res in socket.getaddrinfo(
-                self.forward_net_host, self.forward_net_port,
-                socket.AF_UNSPEC, socket.SOCK_STREAM):
-            af, socktype, proto, canonname, sa = res
-            try:
-                s = socket.socket(af, socktype, proto)
-                self.sock_inet.setsockopt(
-                    socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                self.sock_inet.setsockopt(
-                    socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-            except OSError as msg:
-                s = None
-                continue
-            try:
-                s.connect(sa)
-                s.settimeout(self.forward_timeout or FORWARD_READ_TIMEOUT)
-            except OSError as msg:
-                s.close()
-                s = None
-                continue
-            break
-        if s is None:
-            logging.critical(
-                "Cannot connect to host %s with port %s",
-                self.forward_net_host, self.forward_net_port)
-            self.terminate()
-            return False
-        self.fw_sock_inet = s
-        return True
+        if self.forwarder is None and (self.forward_serial_port or (
+                self.forward_net_host and self.forward_net_port)):
+            from .forwarder import Forwarder
+            self.forwarder = Forwarder.from_emulator(self)
+            if self.forwarder is not None:
+                self.forwarder.start()
+        return self.forwarder
 
     def send_receive_forward(self, i):
         """
-            If a forwarder is active, send data if it is not None
-            and try receiving data until a timeout.
+            If a forwarder is active, send data to an OBD-II interface and
+            receive the answer up to the terminator or until a timeout
+            (ref. Forwarder.send_receive()).
             Then received data are logged and returned.
 
             return False: no connection
             return None: no data
             return data: decoded string
         """
-
-        if self.forward_serial_port:
-            if self.fw_serial_fd is None:
-                if not self.serial_client():
-                    return False
-            if self.fw_serial_fd:
-                if i:
-                    self.fw_serial_fd.write(i)
-                    logging.info(
-                        "Write forward data: %s", repr(i))
-                proxy_data = self.fw_serial_fd.read(1024)
-                logging.info(
-                    "Read forward data: %s", repr(proxy_data))
-                return repr(proxy_data)
+        forwarder = self.forwarder or self.get_forwarder()
+        if forwarder is None or not i:
             return False
-
-        if not self.forward_net_host or not self.forward_net_port:
+        logging.info("Write forward data: %s", repr(i))
+        start = time.perf_counter()
+        proxy_data = forwarder.send_receive(i)
+        if proxy_data is None:
+            logging.info("No OBD-II interface available for forwarding.")
             return False
-        if self.fw_sock_inet is None:
-            self.net_client()
-        if self.fw_sock_inet:
-            if i:
-                try:
-                    self.fw_sock_inet.sendall(i)
-                    logging.info(
-                        "Write forward data: %s", repr(i))
-                except BrokenPipeError:
-                    logging.error(
-                        "The network link of the OBDII interface dropped.")
-            try:
-                proxy_data = self.fw_sock_inet.recv(1024)
-                logging.info(
-                    "Read forward data: %s", repr(proxy_data))
-                return proxy_data.decode("utf-8", "ignore")
-            except socket.timeout:
-                logging.info(
-                    "No forward data received.")
-                return None
-        return False
+        self.record_forward_latency(start)
+        if not proxy_data:
+            logging.info("No forward data received.")
+            return None
+        logging.info("Read forward data: %s", repr(proxy_data))
+        return proxy_data.decode("utf-8", "ignore")
+
+    def record_forward_latency(self, start):
+        """
+        Add the round-trip time of the forwarded request started at "start"
+        (time.perf_counter() value) to self.forward_latency.
+        """
+        self.forward_latency.record(int((time.perf_counter() - start) * 1e9))
 
     def get_port_name(self, extended=False):
         """
@@ -1007,6 +3263,10 @@ class Elm:
         :param extended: False or True
         :return: string
         """
+        if self.multi_session and self.net_port:
+            return ('TCP/IP network port ' + str(self.net_port) +
+                    ' (multi-session).')
+
         if self.sock_inet:
             if self.net_port:
                 postfix = ''
@@ -1057,11 +3317,13 @@ class Elm:
 
     def read_from_device(self, bytes):
         """
-        Read from the port; returns up to bytes characters (generally 1).
+        Read from the port; returns up to bytes characters, blocking until
+        at least one character is available.
         Manage socket, serial or device output.
-        Process echo; returns None in case of error
+        Echo is not processed here (ref. echo_to_device()).
+        Returns None in case of error
 
-        :param bytes: max number of bytes to read (we use 1 byte a time)
+        :param bytes: max number of bytes to read
         :return: Read character(s) or None if error.
         """
 
@@ -1094,10 +3356,6 @@ class Elm:
                 logging.error(
                     "Error while reading from network: %s", msg)
                 return None
-            if 'cmd_echo' not in self.counters or (
-                    'cmd_echo' in self.counters and
-                    self.counters['cmd_echo']):
-                self.sock_conn.sendall(c)
             return c
 
         # Process serial (COM or device)
@@ -1109,15 +3367,14 @@ class Elm:
             # Serial COM port (uses pySerial)
             if self.serial_fd and self.serial_port:
                 try:
-                    c = self.serial_fd.read(bytes)
+                    c = self.serial_fd.read(1)
+                    waiting = self.serial_fd.in_waiting
+                    if bytes > 1 and waiting:
+                        c += self.serial_fd.read(min(bytes - 1, waiting))
                 except Exception:
                     logging.debug(
                         'Error while reading from %s', self.get_port_name())
                     return None
-                if 'cmd_echo' not in self.counters or (
-                        'cmd_echo' in self.counters and
-                        self.counters['cmd_echo']):
-                    self.serial_fd.write(c)
 
             # Device port (use os IO)
             else:
@@ -1127,22 +3384,6 @@ class Elm:
                     self.terminate()
                     return None
                 c = os.read(self.master_fd, bytes)
-                if 'cmd_echo' not in self.counters or (
-                        'cmd_echo' in self.counters and
-                        self.counters['cmd_echo']):
-                    try:
-                        os.write(self.master_fd, c)
-                    except OSError as e:
-                        if e.errno == errno.EBADF or e.errno == errno.EIO:  # [Errno 9] Bad file descriptor/[Errno 5] Input/output error
-                            logging.debug("Read interrupted. Terminating.")
-                            self.terminate()
-                            return None
-                        else:
-                            logging.critical(
-                                "PANIC - Internal OSError in read(): %s",
-                                e, exc_info=True)
-                            self.terminate()
-                            return None
         except UnicodeDecodeError as e:
             logging.warning("Invalid character received: %s", e)
             return None
@@ -1150,63 +3391,210 @@ class Elm:
             return None
         return c
 
-    def normalized_read_line(self):
+    def echo_to_device(self, c):
         """
-            Read the next newline delimited command invoking read_from_device()
-            Concatenate read characters until newline.
-            Manage req_timeout input UDS P4 timer.
-            Manage send_receive_forward()
-            returns a normalized string command
+        Echo read characters to the port, if echo is enabled.
+        Manage socket, serial or device output.
+        :param c: read characters (bytes)
+        :return: False in case of error, otherwise True.
         """
-        buffer = ""
-        first = True
+        session = self.session
+        echo = session.echo
+        if not c or (echo is not UNSET and not echo):
+            return True
+        self.trace.record('out', session, c)
+
+        # Process multi-session connection
+        if session.transport:
+            self.session_write(session, c)
+            return True
+
+        # Process inet
+        if self.sock_inet:
+            try:
+                self.sock_conn.sendall(c)
+            except Exception as e:
+                logging.error("Error while writing to network: %s", e)
+                return False
+            return True
+
+        # Serial COM port (uses pySerial)
+        if self.serial_fd and self.serial_port:
+            try:
+                self.serial_fd.write(c)
+            except Exception:
+                logging.debug(
+                    'Error while writing to %s', self.get_port_name())
+                return False
+            return True
+
+        # Device port (use os IO)
+        try:
+            os.write(self.master_fd, c)
+        except OSError as e:
+            if e.errno == errno.EBADF or e.errno == errno.EIO:  # [Errno 9] Bad file descriptor/[Errno 5] Input/output error
+                logging.debug("Read interrupted. Terminating.")
+            else:
+                logging.critical(
+                    "PANIC - Internal OSError in read(): %s",
+                    e, exc_info=True)
+            self.terminate()
+            return False
+        return True
 
+    def get_req_timeout(self):
+        """
+        Return the req_timeout input UDS P4 timer, validating the
+        'req_timeout' counter.
+        :return: req_timeout (seconds)
+        """
+        session = self.session
         req_timeout = self.max_req_timeout
         try:
-            req_timeout = float(self.counters['req_timeout'])
+            req_timeout = float(session.req_timeout)
         except Exception as e:
-            if 'req_timeout' in self.counters:
+            if session.req_timeout is not UNSET:
                 logging.error("Improper configuration of\n\"self.counters" \
                               "['req_timeout']\": '%s' (%s). "
                               "Resetting it to %s",
-                              self.counters['req_timeout'], e,
+                              session.req_timeout, e,
                               self.max_req_timeout
                               )
-            self.counters['req_timeout'] = req_timeout
+            session.req_timeout = req_timeout
+        return req_timeout
+
+    def read_buffered_line(self, buffer):
+        """
+        Process the characters in self.read_buffer up to the first newline
+        (included), echoing them; the remaining ones are kept for the next
+        request.
+        :param buffer: characters of the current request read so far (bytes)
+        :return: tuple (buffer, True if the newline is reached),
+            or None in case of echo error.
+        """
+        eol = b'\n' if self.newline else b'\r'
+        end = self.read_buffer.find(eol) + 1
+        if end:
+            c = bytes(self.read_buffer[:end])
+            del self.read_buffer[:end]
+        else:
+            c = bytes(self.read_buffer)
+            self.read_buffer.clear()
+        if not self.echo_to_device(c):
+            return None
+        c = c.replace(b'\r', b'').replace(b'\n', b'')  # ignore newlines
+        return buffer + c, end > 0
+
+    def normalized_read_line(self):
+        """
+            Read the next newline delimited command invoking read_from_device()
+            Read data are buffered (self.read_buffer): characters are
+            processed (and echoed) up to the newline; the remaining ones are
+            kept for the next command.
+            Manage req_timeout input UDS P4 timer.
+            Manage send_receive_forward()
+            returns a normalized string command
+        """
+        buffer = b""
+        req_timeout = self.get_req_timeout()
         while True:
-            prev_time = time.time()
-            c = self.read_from_device(1)
-            if c is None:
+            if not self.read_buffer:
+                prev_time = self.clock.monotonic()
+                c = self.read_from_device(READ_BUFFER_SIZE)
+                if c is None:
+                    return None
+                self.trace.record('in', self.session, c)
+                if (prev_time + req_timeout < self.clock.monotonic() and
+                        buffer):
+                    buffer = b""
+                    logging.debug(
+                        "'req_timeout' timeout while reading data: %s", c)
+                self.read_buffer += c
+            line = self.read_buffered_line(buffer)
+            if line is None:
                 return None
-            c = c.decode("utf-8", "ignore")
-            if prev_time + req_timeout < time.time() and first == False:
-                buffer = ""
-                logging.debug("'req_timeout' timeout while reading data: %s", c)
-            if c == '\r':
-                if self.newline:
-                    continue
+            buffer, complete = line
+            if complete:
                 break
-            if c == '\n':
-                if self.newline:
-                    break
-                continue  # ignore newlines
-            first = False
-            buffer += c
+        buffer = buffer.decode("ascii", "ignore")
+        self.forward_line(buffer)
+        return buffer
 
+    def forward_line(self, line):
+        """
+        Forward a request read from the port to the OBD-II interface, if a
+        forwarder is configured, unless its answer is in the learning cache.
+        The answer is kept in session.forward_answer, so that
+        handle_request() does not forward the same request again if it is
+        unknown to the dictionary. With background forwarding, the request
+        is kept in session.forward_pending: it is queued by handle_request()
+        if unknown, otherwise by end_forward_line().
+        :param line: request string (without newline)
+        :return: (none)
+        """
+        session = self.session
+        session.forward_answer = None
+        cmd = line.translate(line.maketrans('', '', string.whitespace)).upper()
+        if self.learning.enabled and self.learning.get(
+                self.learning_key(cmd)) is not None:
+            return
+        if self.forward_queue is not None:
+            session.forward_pending = (cmd, line)
+            return
         try:
-            self.send_receive_forward((buffer + '\r').encode())
+            session.forward_answer = (
+                cmd, self.send_receive_forward((line + '\r').encode()))
         except Exception as e:
             logging.error('Forward Write error: %s', e)
-        return buffer
 
-    def write_to_device(self, i):
+    def end_forward_line(self):
+        """
+        Background forwarding: queue the request read from the port if it
+        was not queued by handle_request() (known to the dictionary).
+        """
+        session = self.session
+        pending = session.forward_pending
+        if pending is not None:
+            session.forward_pending = None
+            self.forward_queue.put(session, *pending)
+
+    def learning_key(self, cmd):
+        """
+        Return the key of the learning cache of a sanitized request of the
+        current session (ref. LearningCache.key()).
+        """
+        header = self.session.set_header
+        return self.learning.key(None if header is UNSET else header, cmd,
+                                 self.get_output_profile())
+
+    def write_to_device(self, i, session=None):
         """
         Write a response to the port (no data returned).
         Manage socket, serial or device output.
         No return code.
         :param i: encoded bytearray to be written
+        :param session: Session object (default is the current session)
         :return: (none)
         """
+        session = session or self.session
+        self.trace.record('out', session, i)
+
+        # Process in-process queries (ref. query_many)
+        if session.capture is not None:
+            session.capture += i
+            return
+
+        delay = session.pacing or self.interbyte_out_delay
+
+        # Process multi-session connection
+        if session.transport:
+            if delay:
+                for j in i:
+                    self.session_write(session, bytes([j]))
+                    self.sleep(delay, session)
+            else:
+                self.session_write(session, i)
+            return
 
         # Process inet
         if self.sock_inet:
@@ -1214,10 +3602,10 @@ class Elm:
                 self.terminate()
                 return
             try:
-                if self.interbyte_out_delay:
+                if delay:
                     for j in i:
                         self.sock_conn.sendall(bytes([j]))
-                        time.sleep(self.interbyte_out_delay)
+                        self.sleep(delay, session)
                 else:
                     self.sock_conn.sendall(i)
             except BrokenPipeError:
@@ -1229,11 +3617,11 @@ class Elm:
 
             # Serial COM port (uses pySerial)
             try:
-                if self.interbyte_out_delay:
+                if delay:
                     for j in i:
                         self.serial_fd.write(bytes([j]))
                         self.serial_fd.flush()
-                        time.sleep(self.interbyte_out_delay)
+                        self.sleep(delay, session)
                 else:
                     self.serial_fd.write(i)
             except Exception:
@@ -1249,11 +3637,11 @@ class Elm:
                 self.terminate()
                 return
             try:
-                if self.interbyte_out_delay:
+                if delay:
                     for j in i:
                         os.write(self.master_fd, bytes([j]))
                         os.fsync(self.master_fd)
-                        time.sleep(self.interbyte_out_delay)
+                        self.sleep(delay, session)
                 else:
                     os.write(self.master_fd, i)
             except OSError as e:
@@ -1288,20 +3676,19 @@ class Elm:
         :return: string including the formatted UDS answer
         """
         answer = ""
-        if request_header is None and "cmd_set_header" in self.counters:
-            request_header = self.counters['cmd_set_header']
+        if request_header is None and self.session.set_header is not UNSET:
+            request_header = self.session.set_header
         request_header = (request_header or '').translate(
             (request_header or '').maketrans('', '', string.whitespace)).upper()
         if not request_header:
             logging.error('Invalid request header; request %s', repr(data))
             return ""
         try:
-            length = len(bytearray.fromhex(data))
-            data = (sp.join('{:02x}'.format(x)
-                            for x in bytearray.fromhex(data)).upper())
+            payload = bytes.fromhex(data)
         except ValueError:
             logging.error('Invalid data in answer: %s', repr(data))
             return ""
+        length = len(payload)
         answer_header = hex(int(request_header, 16) + 8)[2:].upper()
         if not re.match(cra_pattern, answer_header):
             logging.debug(
@@ -1309,72 +3696,20 @@ class Elm:
                 'request_header=%s, answer_header=%s, cra_pattern=%s.',
                 repr(request_header), repr(answer_header), repr(cra_pattern))
             return ""
+        if len(request_header) == 3 and not is_flow_control:  # ISO-TP 11 bit
+            try:
+                answer = iso_tp_format(
+                    payload, answer_header, use_headers,
+                    self.get_output_profile().caf, sp, nl)
+            except ValueError as e:
+                logging.error('Invalid answer %s: %s', repr(data), e)
+                return ""
+            return answer + sp + nl
+        data = sp.join([HEX_BYTE[x] for x in payload])
         if len(request_header) == 3 and is_flow_control:  # 11 bit header + FC
             if use_headers:
                 answer = answer_header + sp
             answer += is_flow_control + sp + data
-        elif len(request_header) == 3:  # ISO-TP 11 bit CAN identifier
-            if use_headers:
-                if length > 7:  # produce a multframe output
-                    answer = (answer_header +
-                              sp + "10" + sp + "%02X" % length + sp)
-                    bytes_to_add = 6
-                    answer += data[:(3 if sp else 2) * bytes_to_add] + nl
-                    remaining_length = length - bytes_to_add
-                    remaining_data = data[(3 if sp else 2) * bytes_to_add:]
-                    bytes_to_add += 1
-                    frame_count = 1
-                    while remaining_length > 0:
-                        if frame_count == 0x10:
-                            frame_count = 0
-                        answer += (answer_header
-                                   + sp + "%02X" % (frame_count + 0x20) + sp)
-                        remaining_length -= bytes_to_add
-                        answer += (remaining_data[
-                                   :(3 if sp else 2) * bytes_to_add] + nl)
-                        remaining_data = remaining_data[
-                                         (3 if sp else 2) * bytes_to_add:]
-                        frame_count += 1
-                    answer = answer.rstrip(sp + nl)
-                else:
-                    answer = answer_header + sp + "%02X" % length + sp + data
-            else:
-                if length > 7:  # produce a multframe output
-                    if ('cmd_caf' in self.counters and
-                            not self.counters[
-                                'cmd_caf']):  # PCI byte in requests
-                        answer = "10" + sp + "%02X" % length + sp
-                        pci = True
-                    else:
-                        pci = False
-                        answer = "%03X" % length + nl + "0: "
-                    bytes_to_add = 6
-                    answer += data[:(3 if sp else 2) * bytes_to_add] + nl
-                    remaining_length = length - bytes_to_add
-                    remaining_data = data[(3 if sp else 2) * bytes_to_add:]
-                    bytes_to_add += 1
-                    frame_count = 1
-                    while remaining_length > 0:
-                        if frame_count == 0x10:
-                            frame_count = 0
-                        if pci:
-                            answer += "%02X" % (frame_count + 0x20) + sp
-                        else:
-                            answer += "%01X" % frame_count + ": "
-                        remaining_length -= bytes_to_add
-                        answer += (remaining_data[
-                                   :(3 if sp else 2) * bytes_to_add] + nl)
-                        remaining_data = remaining_data[
-                                         (3 if sp else 2) * bytes_to_add:]
-                        frame_count += 1
-                    answer = answer.rstrip(sp + nl)
-                else:
-                    if ('cmd_caf' in self.counters and
-                            not self.counters[
-                                'cmd_caf']):  # PCI byte in requests
-                        answer = "%02X" % length + sp + data
-                    else:
-                        answer = data
         elif len(request_header) == 6 and is_flow_control:  # KWP2000 FC
             logging.error(
                 'KWP2000 format with flow control: unimplemented case.')
@@ -1407,7 +3742,8 @@ class Elm:
                         resp,
                         do_write=False,
                         request_header=None,
-                        request_data=None):
+                        request_data=None,
+                        session=None):
         """
         Compute the response and returns data written to the device.
         :param resp: XML response string to compute
@@ -1418,109 +3754,85 @@ class Elm:
                 (used to compute the response header)
         :param request_data: data of the request
                 (used to compute the positive and negative response data)
+        :param session: Session object (default is the current session)
         :return: computed response, or empty (no output) or None (error).
         """
-
-        logging.debug("Processing: %s", repr(resp))
-
-        # Compute cra_pattern (ATCRA filter)
-        cra_pattern = r'[0-9A-F]+'
-        cra = self.counters["cmd_cra"] if "cmd_cra" in self.counters else None
-        if cra:
-            cra_pattern = (r'^' + cra
-                           .replace('X', '[0-9A-F]').replace('W', '[0-9A-F]+')
-                           + r'$')
-
-        # Compute use_headers
-        use_headers = ("cmd_use_header" in self.counters and
-                       self.counters["cmd_use_header"])
-
-        # Compute sp (space)
-        if ('cmd_spaces' in self.counters
-                and self.counters['cmd_spaces'] == 0):
-            sp = ''
-        else:
-            sp = ' '
-
-        # Compute nl (newline)
-        nl_type = {
-            0: "\r",
-            1: "\r\n",
-            2: "\n",
-            3: "\r",
-            4: "\r\n",
-            5: "\n"
-        }
-        nl = "\r"
-        if 'cmd_linefeeds' in self.counters:
+        if session is not None and session is not self.session:
+            previous = self.switch_session(session)
             try:
-                nl = nl_type[int(self.counters['cmd_linefeeds'])]
-            except Exception:
-                logging.error(
-                    'Invalid "cmd_linefeeds" value: %s.',
-                    repr(self.counters['cmd_linefeeds']))
+                return self.handle_response(
+                    resp, do_write, request_header, request_data, session)
+            finally:
+                self.switch_session(previous)
+
+        log_debug = self.log_debug
+        if log_debug:
+            logging.debug("Processing: %r", resp)
+
+        session = session or self.session
+        profile = self.get_output_profile(session)
+        cra_pattern = profile.cra_pattern
+        use_headers = profile.use_headers
+        sp = profile.sp
+        nl = profile.nl
 
         # Generate string
+        error, resp, ops = compile_response(resp)
         incomplete_resp = False
-        root = None
-        resp = resp.replace('\x00', '\\x00').replace('\x0d', '&#13;')
-        try:
-            root = fromstring('<xml>' + resp + '</xml>')
-            s = iter(root)
-        except ParseError as e:
+        if error:
             incomplete_resp = True
             logging.error(
-                'Wrong response format for "%s"; %s', resp, e)
-        answ = root.text.strip() if root is not None and root.text else ""
+                'Wrong response format for "%s"; %s', resp, error)
+        answ = ""
         answers = False
-        i = None
 
-        while not incomplete_resp:
-            try:
-                i = next(s)
-            except StopIteration:
-                answ += i.tail.strip() if i is not None and i.tail else ""
-                break
-            if i.tag.lower() == 'rh':
-                request_header = (i.text or "")
-            elif i.tag.lower() == 'rd':
-                request_data = (i.text or "")
-            elif i.tag.lower() == 'string':
-                answ += (i.text or "")
-            elif i.tag.lower() == 'writeln':
-                answ += (i.text or "") + nl
-            elif i.tag.lower() == 'space':
-                answ += (i.text or "") + sp
-            elif (i.tag.lower() == 'eval' or
-                  i.tag.lower() == 'exec'):
+        for op in ops:
+            tag = op[0]
+            if tag == 'text':
+                answ += op[1]
+            elif tag == 'rh':
+                request_header = op[1]
+            elif tag == 'rd':
+                request_data = op[1]
+            elif tag == 'string':
+                answ += op[1]
+            elif tag == 'writeln':
+                answ += op[1] + nl
+            elif tag == 'space':
+                answ += op[1] + sp
+            elif tag == 'eval' or tag == 'exec':
                 answ = answ.replace('\\x00', '\x00')
-                logging.debug("Write: %s", repr(answ))
-                if i.tag.lower() == 'exec' and do_write:
-                    self.write_to_device(answ.encode())
+                if log_debug:
+                    logging.debug("Write: %r", answ)
+                if tag == 'exec' and do_write:
+                    self.write_to_device(answ.encode(), session)
                     answ = ""
-                if i.text is None:
+                msg, eval_code, exec_code = op[1:]
+                if msg is None:
                     continue
-                msg = i.text.strip()
                 if msg:
                     try:
-                        evalmsg = eval(msg)
-                        logging.debug(
-                            "Evaluated command: %s -> %s",
-                            msg, repr(evalmsg))
+                        if eval_code is None:
+                            raise SyntaxError(msg)
+                        evalmsg = eval(eval_code)
+                        if log_debug:
+                            logging.debug(
+                                "Evaluated command: %s -> %r", msg, evalmsg)
                         if evalmsg != None:
                             answ += str(evalmsg)
                     except Exception:
                         try:
-                            exec(msg, globals())
-                            logging.debug("Executed command: %s", msg)
+                            exec(exec_code, globals())
+                            if log_debug:
+                                logging.debug("Executed command: %s", msg)
                         except Exception as e:
                             logging.error("Cannot execute '%s': %s", msg, e)
                 else:
                     logging.debug(
                         "Missing command to execute: %s", resp)
 
-            elif i.tag.lower() == 'flow':
-                answ += self.uds_answer(data=i.text or "",
+            elif tag == 'flow':
+                answ += self.uds_answer(data=op[1],
                                         request_header=request_header,
                                         use_headers=use_headers,
                                         cra_pattern=cra_pattern,
@@ -1528,18 +3840,18 @@ class Elm:
                                         nl=nl,
                                         is_flow_control='30')
 
-            elif i.tag.lower() == 'answer':
-                answ += self.uds_answer(data=i.text or "",
+            elif tag == 'answer':
+                answ += self.uds_answer(data=op[1],
                                         request_header=request_header,
                                         use_headers=use_headers,
                                         cra_pattern=cra_pattern,
                                         sp=sp,
                                         nl=nl)
-            elif i.tag.lower() == 'pos_answer' or i.tag.lower() == 'neg_answer':
+            elif tag == 'pos_answer' or tag == 'neg_answer':
                 if not request_data:
                     logging.error(
                         'Missing request with <%s> tag: %s.',
-                        i.tag.lower(), repr(resp))
+                        tag, repr(resp))
                     break
 
                 # Calculate uds_pos_answ for uds_pos_answer
@@ -1560,9 +3872,9 @@ class Elm:
                 except:
                     uds_pos_answ = None
 
-                if i.tag.lower() == 'pos_answer' and uds_pos_answ is None:
+                if tag == 'pos_answer' and uds_pos_answ is None:
                     logging.error(
-                        'Invalid <%s> tag: %s.', i.tag.lower(), repr(resp))
+                        'Invalid <%s> tag: %s.', tag, repr(resp))
                     break
                 try:
                     request_data = (''.join('{:02x}'.format(x)
@@ -1572,14 +3884,14 @@ class Elm:
                     logging.error('Invalid request %s related to response %s '
                                   'including <%s> tag: %s',
                                   repr(request_data), repr(resp),
-                                  i.tag.lower(), e)
+                                  tag, e)
                     return ""
-                if i.tag.lower() == 'pos_answer':
+                if tag == 'pos_answer':
                     data = ("%02X" % (bytearray.fromhex(request_data[:2])[0]
                                       | 0x40) +
-                            uds_pos_answ + (i.text or ""))
+                            uds_pos_answ + op[1])
                 else:  # Generate a negative response UDS SID
-                    data = "7F" + sp + request_data[:2] + (i.text or "")
+                    data = "7F" + sp + request_data[:2] + op[1]
                 answ += self.uds_answer(data=data,
                                         request_header=request_header,
                                         use_headers=use_headers,
@@ -1587,77 +3899,39 @@ class Elm:
                                         sp=sp,
                                         nl=nl)
 
-            elif i.tag.lower() == 'header':
+            elif tag == 'header':
                 answers = True
-                incomplete_resp = True
-                try:
-                    size = next(s)
-                    data = next(s)
-                except StopIteration:
-                    logging.error(
-                        'Missing <size> or <data>/<subd> tags '
-                        'after <header> tag in %s.', repr(resp))
-                    break
-                # check that the tags are valid
-                if (size.tag.lower() != 'size' or
-                        (data.tag.lower() != 'data' and
-                         data.tag.lower() != 'subd')):
-                    logging.error(
-                        'In %s, <size> and <data>/<subd> tags '
-                        'must follow the <header> tag.', repr(resp))
-                    break
-
-                # check validity of the content fields
-                try:
-                    int_size = int(size.text, 16)
-                except ValueError as e:
-                    logging.error(
-                        'Improper size %s for response %s: %s.',
-                        repr(size.text), repr(resp), e)
-                    break
-                if not data.text:
-                    logging.error('Missing data for response %s.',
-                                  repr(resp))
-                    break
-                unspaced_data = (data.text or "").translate(
-                    (data.text or "").maketrans('', '', string.whitespace))
-                if int_size < 16 and len(unspaced_data) != int_size * 2:
-                    logging.error(
-                        'In response %s, mismatch between number of data '
-                        'digits %s and related length field %s.',
-                        repr(resp), repr(data.text), repr(size.text))
-                    break
-                incomplete_resp = False
-                if re.match(cra_pattern, i.text.upper()):
+                header, size, data, unspaced_data, is_data = op[1:]
+                if profile.cra_regex.match(header.upper()):
                     # concatenate answ from header, size and data/subd
-                    answ += ((((i.text or "") + sp + (size.text or "") + sp)
+                    answ += ((((header or "") + sp + size + sp)
                               if use_headers else "") +
-                             ((data.text or "") if sp else unspaced_data) +
-                             sp + (nl if data.tag.lower() == 'data' else ""))
-                else:
+                             (data if sp else unspaced_data) +
+                             sp + (nl if is_data else ""))
+                elif log_debug:
                     logging.debug(
                         'Skipping answer which does not match ATCRA: '
-                        'header=%s, cra_pattern=%s.',
-                        repr(i.text), repr(cra_pattern))
+                        'header=%r, cra_pattern=%r.', header, cra_pattern)
+            elif tag == 'incomplete':
+                answers = True
+                incomplete_resp = True
+                logging.error(op[1], *op[2])
+                break
             else:
                 logging.error(
-                    'Unknown tag "%s" in response "%s"', i.tag, resp)
-            answ += i.tail.strip() if i is not None and i.tail else ""
+                    'Unknown tag "%s" in response "%s"', op[1], resp)
         if incomplete_resp or (answers and not answ):
             answ = "NO DATA" + nl
         if not answ:
             logging.debug(
                 'Null response received after processing "%s".', resp)
             return None
-        if ('cmd_linefeeds' in self.counters and
-                self.counters['cmd_linefeeds'] > 2):
-            answ += ">"
-        else:
-            answ += nl + ">"
+        answ += profile.prompt
         answ = answ.replace('\\x00', '\x00')
         if do_write:
-            logging.debug("Write: %s", repr(answ))
-            self.write_to_device(answ.encode())
+            if log_debug:
+                logging.debug("Write: %r", answ)
+            self.write_to_device(answ.encode(), session)
         return answ
 
     def task_action(
@@ -1679,7 +3953,8 @@ class Elm:
         :return: a tuple of three elements with the same return parameters
                 as the Task methods
         """
-        if not is_ecu:
+        log_debug = self.log_debug and not is_ecu
+        if log_debug:
             logging.debug(
                 "Running task %s.%s(%s, %s, %s) for ECU %s",
                 self.tasks[ecu][-1].__module__,
@@ -1689,6 +3964,9 @@ class Elm:
         r_cmd = None
         r_task = Tasks.RETURN.TERMINATE
         r_cont = None
+        session = self.session
+        slept = session.slept
+        start = time.perf_counter()
         try:  # Run the task method
             r_cmd, r_task, r_cont = task_method(cmd, length, frame)
         except Exception as e:
@@ -1710,7 +3988,13 @@ class Elm:
                     e, exc_info=True)
                 del self.tasks[ecu][-1]
             return Tasks.RETURN.ERROR
-        if not is_ecu:
+        finally:
+            self.record_latency(
+                self.task_latency,
+                task_method.__self__.__module__.replace(
+                    PLUGIN_DIR + '.', '') + '.' + task_method.__name__,
+                start + session.slept - slept)
+        if log_debug:
             logging.debug(
                 "r_cmd=%s, r_task=%s, r_cont=%s", r_cmd, r_task, r_cont)
         if r_cont is not None and r_cmd is not None:
@@ -1737,10 +4021,10 @@ class Elm:
                     self.tasks[ecu][-1].__module__, ecu)
                 self.account_task(ecu)
                 del self.tasks[ecu][-1]
-        if r_cont is not None and not is_ecu:
+        if r_cont is not None and log_debug:
             logging.debug(
-                "Continue processing command %s after execution of task "
-                "for ECU %s.", repr(r_cont), ecu)
+                "Continue processing command %r after execution of task "
+                "for ECU %s.", r_cont, ecu)
         return r_cmd, r_task, r_cont
 
     def account_task(self, ecu):
@@ -1759,7 +4043,7 @@ class Elm:
             self.counters[task_name] = 0
         self.counters[task_name] += 1
 
-    def handle_request(self, cmd, do_write=False):
+    def handle_request(self, cmd, do_write=False, session=None):
         """
         Generate an XML response by processing a request,
         returning a string to be processed by process_response(),
@@ -1772,8 +4056,17 @@ class Elm:
         :param cmd: the request to be processed
         :param do_write: passed to process_response() when
                         implicitly called, or used for logging.
+        :param session: Session object (default is the current session)
         :return: (header, request, None or an XML string)
         """
+        if session is not None and session is not self.session:
+            previous = self.switch_session(session)
+            try:
+                return self.handle_request(cmd, do_write, session)
+            finally:
+                self.switch_session(previous)
+        session = session or self.session
+        statistics = session.statistics
 
         org_cmd = cmd
         # Sanitize cmd (request has all unspaced uppercase chars)
@@ -1781,35 +4074,33 @@ class Elm:
             (cmd or '').maketrans('', '', string.whitespace)).upper()
 
         # Increment 'commands' counter
-        if 'commands' not in self.counters:
-            self.counters['commands'] = 0
-        self.counters['commands'] += 1
+        statistics.hit(COMMANDS_ID)
 
         # cmd_can is experimental (to be removed)
-        if ('cmd_can' in self.counters and
-                self.counters['cmd_can']
-                and is_hex_sp(cmd[:3])):
-            self.counters['cmd_set_header'] = cmd[:3]
+        if session.can and is_hex_sp(cmd[:3]):
+            session.set_header = cmd[:3]
             header = cmd[:3]
-            self.counters['cmd_caf'] = False
-            self.counters['cmd_use_header'] = True
+            session.caf = False
+            session.use_header = True
+            session.output_profile = None
             cmd = cmd[3:]
 
         # Set header and ecu
         header = None
         ecu = None
-        if "cmd_set_header" in self.counters:
-            header = self.counters['cmd_set_header']
+        if session.set_header is not UNSET:
+            header = session.set_header
             if len(header) == 6:
                 ecu = header[2:]
             else:
                 ecu = header
 
         # Manage the UDS P2 delay timer
-        logging.debug("Handling: %s, header %s, ECU %s",
-                      repr(cmd), repr(header), repr(ecu))
+        log_debug = self.log_debug
+        if log_debug:
+            logging.debug("Handling: %r, header %r, ECU %r", cmd, header, ecu)
         if self.delay > 0:
-            time.sleep(self.delay)
+            self.sleep(self.delay, session)
 
         if len(org_cmd) > 1 and cmd[1] == 'T' and org_cmd.upper()[1] != 'T':
             # AT or ST shall be unspaced
@@ -1821,9 +4112,9 @@ class Elm:
             return header, cmd, ""
 
         #  Manage ECU task and shared namespace
-        if ecu and ecu in self.task_shared_ns:  # ECU task exists with its namespace
+        if ecu and ecu in session.task_shared_ns:  # ECU task exists with its namespace
             r_cmd, *_, r_cont = self.task_action(header, ecu, do_write,
-                                                 self.task_shared_ns[ecu].run,
+                                                 session.task_shared_ns[ecu].run,
                                                  cmd, None, None,
                                                  is_ecu=True)
             if r_cont is None:
@@ -1840,76 +4131,76 @@ class Elm:
                                  .replace('W', '[0-9A-F]+') +
                                  r'$')
                     if (i.startswith(ECU_TASK) and
-                            re.match(i_pattern, ECU_TASK.upper() + ecu)):
+                            re.match(i_pattern, ECU_TASK.upper() + ecu) and
+                            i in self.plugins):
                         plugin = i
                         break
             try:  # use the plugin if existing, else directly use EcuTasks()
                 if plugin:
-                    self.task_shared_ns[ecu] = self.plugins[plugin].Task(
+                    session.task_shared_ns[ecu] = self.plugins[plugin].Task(
                         emulator=self, pid=None, header=header, ecu=ecu,
                         request=cmd, attrib=None, do_write=do_write)
                 else:  # Create a default ECU task
-                    self.task_shared_ns[ecu] = EcuTasks(
+                    session.task_shared_ns[ecu] = EcuTasks(
                         emulator=self, pid=None, header=header, ecu=ecu,
                         request=cmd, attrib=None, do_write=do_write)
-                    self.task_shared_ns[ecu].__module__ = DEFAULT_ECU_TASK
+                    session.task_shared_ns[ecu].__module__ = DEFAULT_ECU_TASK
             except Exception as e:
                 logging.critical(
                     'Cannot instantiate ECU task "%s", ECU="%s": %s',
                     ECU_TASK + ecu, ecu, e, exc_info=True)
                 return header, cmd, None
             logging.debug('Instantiating ECU task "%s" for ECU "%s"',
-                          self.task_shared_ns[ecu].__module__, ecu)
+                          session.task_shared_ns[ecu].__module__, ecu)
             r_cmd, *_, r_cont = self.task_action(header, ecu, do_write,
-                                                 self.task_shared_ns[ecu].start,
+                                                 session.task_shared_ns[ecu].start,
                                                  cmd, None, None,
                                                  is_ecu=True)
             if r_cont is None:
                 return header, cmd, r_cmd
             else:
                 cmd = r_cont
-        self.shared = None
-        if ecu and ecu in self.task_shared_ns:
-            self.shared = self.task_shared_ns[ecu]
+        session.shared = None
+        if ecu and ecu in session.task_shared_ns:
+            session.shared = session.task_shared_ns[ecu]
 
         # Manage cmd_caf, length, frame & process UDS ISO-TP Multiframe data link
         size = cmd[:2]
         length = None  # No byte length in request
         frame = None  # Single Frame by default
         if ecu and is_hex_sp(cmd):  # Not AT or ST command
-            if (ecu in self.request_timer and
-                    self.request_timer[ecu] + self.multiframe_timer <
-                    time.time()):
-                if ecu in self.tasks and len(self.tasks[ecu]):
+            if (ecu in session.request_timer and
+                    session.request_timer[ecu] + self.multiframe_timer <
+                    self.clock.time()):
+                if ecu in session.tasks and len(session.tasks[ecu]):
                     logging.warning(
                         "UDS P3 timer expired, removing active tasks.")
-                    for i in reversed(self.tasks[ecu]):
+                    for i in reversed(session.tasks[ecu]):
                         self.task_action(
                             header, ecu, do_write, i.stop, cmd, length, frame,
                             is_ecu=False)
-                    del self.tasks[ecu]
-                if ecu in self.task_shared_ns:
+                    del session.tasks[ecu]
+                if ecu in session.task_shared_ns:
                     logging.debug(
                         'UDS P3 timer expired: running stop() method for '
                         'ECU task "%s", ECU="%s".',
-                        self.task_shared_ns[ecu].__module__,
+                        session.task_shared_ns[ecu].__module__,
                         ecu)
                     try:  # Run the stop() method
-                        r_cmd, r_task, r_cont = self.task_shared_ns[ecu].stop(
+                        r_cmd, r_task, r_cont = session.task_shared_ns[ecu].stop(
                             None)
                         if (r_task is Tasks.RETURN.TERMINATE and
                                 r_cont == 'DELETE'):
-                            del self.task_shared_ns[ecu]
+                            del session.task_shared_ns[ecu]
                     except Exception as e:
                         logging.critical(
                             'Error while running stop() method for ECU '
                             'task "%s", ECU="%s": %s',
-                            self.task_shared_ns[ecu].__module__,
+                            session.task_shared_ns[ecu].__module__,
                             ecu,
                             e, exc_info=True)
-            self.request_timer[ecu] = time.time()
-        if ('cmd_caf' in self.counters and
-                not self.counters['cmd_caf'] and  # PCI byte in requests
+            session.request_timer[ecu] = self.clock.time()
+        if (not self.get_output_profile(session).caf and  # PCI byte in requests
                 is_hex_sp(cmd)):  # not AT or ST command
             try:
                 int_size = int(size, 16)
@@ -1930,9 +4221,10 @@ class Elm:
                         return header, cmd, ""
                     cmd = payload[:int_size * 2]
                     length = int_size
-                    logging.debug(
-                        "Single-Frame. Length: %s, frame: %s, header: %s, "
-                        "cmd: %s", length, frame, header, cmd)
+                    if log_debug:
+                        logging.debug(
+                            "Single-Frame. Length: %s, frame: %s, "
+                            "header: %s, cmd: %s", length, frame, header, cmd)
                 else:
                     logging.error('Invalid ISO-TP Single frame with size '
                                   'greater than 7 bytes. %s',
@@ -1941,12 +4233,13 @@ class Elm:
             elif size[0] == '1':  # E.g., 10 = first frame of an ISO-TP Multiframe Request
                 try:
                     length = int(cmd[1:4], 16)  # read ISO-TP Multiframe length
-                    logging.debug(
-                        'ISO-TP Multiframe message with length 0x%s = (int) %s '
-                        '(message %s)', repr(cmd[1:4]), length, repr(cmd))
-                    logging.debug(
-                        "First-Frame. Length: %s, frame: %s, header: %s, "
-                        "cmd: %s", length, frame, header, cmd)
+                    if log_debug:
+                        logging.debug(
+                            'ISO-TP Multiframe message with length 0x%r = '
+                            '(int) %s (message %r)', cmd[1:4], length, cmd)
+                        logging.debug(
+                            "First-Frame. Length: %s, frame: %s, "
+                            "header: %s, cmd: %s", length, frame, header, cmd)
                 except ValueError as e:
                     logging.error('Improper size %s for request %s: %s',
                                   repr(cmd[2:4]), repr(org_cmd), e)
@@ -1959,45 +4252,46 @@ class Elm:
                     frame = -1  # Marker for ISO-TP Multiframe() to detect a recycle
                 if 32 < int_size < 48:  # from 21 to 2F
                     frame = int_size - 32  # compute the multiframe count
-                logging.debug(
-                    "Consecutive-Frame. Length: %s, frame: %s, header: %s, "
-                    "cmd: %s", length, frame, header, cmd)
+                if log_debug:
+                    logging.debug(
+                        "Consecutive-Frame. Length: %s, frame: %s, "
+                        "header: %s, cmd: %s", length, frame, header, cmd)
             elif size[0] == '3':  # E.g., from 30 on = flow control of a ISO-TP Multiframe Request
                 try:
-                    self.shared.flow_control_fc_flag = int(size[1])
-                    self.shared.flow_control_block_size = int(cmd[2:4], 16)
-                    self.shared.flow_control_separation_time = int(cmd[4:6], 16)
+                    session.shared.flow_control_fc_flag = int(size[1])
+                    session.shared.flow_control_block_size = int(cmd[2:4], 16)
+                    session.shared.flow_control_separation_time = int(cmd[4:6], 16)
                 except Exception as e:
                     logging.error(
                         'Improper Flow-control-Frame %s: %s', repr(org_cmd), e)
                     return header, cmd, ""
-                if self.shared.flow_control_fc_flag == 0:  # Clear To Send
-                    if self.shared.flow_control_block_size > 0:
+                if session.shared.flow_control_fc_flag == 0:  # Clear To Send
+                    if session.shared.flow_control_block_size > 0:
                         logging.debug(
                             'Flow-control-Frame. Input is ignored by now: '
                             'int_size: %s, length: %s, frame: %s, header: %s, '
                             'cmd: %s, fc_flag: %s, block_size: %s, '
                             'separation_time: %s.',
                             int_size, length, frame, header, cmd,
-                            self.shared.flow_control_fc_flag,
-                            self.shared.flow_control_block_size,
-                            self.shared.flow_control_separation_time)
-                elif self.shared.flow_control_fc_flag == 1:  # Wait
-                    sleep = self.shared.flow_control_separation_time
+                            session.shared.flow_control_fc_flag,
+                            session.shared.flow_control_block_size,
+                            session.shared.flow_control_separation_time)
+                elif session.shared.flow_control_fc_flag == 1:  # Wait
+                    sleep = session.shared.flow_control_separation_time
                     if sleep > 240:
-                        sleep = ((self.shared.flow_control_separation_time -
+                        sleep = ((session.shared.flow_control_separation_time -
                                   240) * 100)
                     logging.debug(
                         'Sleeping for %s milliseconds', sleep)
-                    time.sleep(sleep / 1000)
-                elif self.shared.flow_control_fc_flag == 2:  # 2 = Overflow/abort
+                    self.sleep(sleep / 1000, session)
+                elif session.shared.flow_control_fc_flag == 2:  # 2 = Overflow/abort
                     logging.error('Overflow-abort received in ISO-TP '
                                   'Flow-control-Frame. %s', repr(org_cmd))
                     return header, cmd, ""
                 else:
                     logging.error(
                         'Improper Flow-control-Frame FC flag %s. %s: %s',
-                        self.shared.flow_control_fc_flag, repr(org_cmd))
+                        session.shared.flow_control_fc_flag, repr(org_cmd))
                     return header, cmd, ""
                 return header, cmd, None
             else:
@@ -2007,32 +4301,32 @@ class Elm:
 
         # Manage ISO-TP Multiframe
         if length is not None and frame is not None:  # ISO-TP Multiframe condition
-            if ecu not in self.tasks:
-                self.tasks[ecu] = []
-            if len(self.tasks[ecu]) > MAX_TASKS:
+            if ecu not in session.tasks:
+                session.tasks[ecu] = []
+            if len(session.tasks[ecu]) > MAX_TASKS:
                 logging.critical(
                     'Too many active tasks for ECU %s while adding '
                     'a ISO-TP Multiframe frame. Latest task was %s.',
-                    ecu, self.tasks[ecu][-1].__module__)
+                    ecu, session.tasks[ecu][-1].__module__)
                 return header, cmd, ""
-            if (len(self.tasks[ecu]) and
-                    self.tasks[ecu][-1].__module__ == ISO_TP_MULTIFRAME_MODULE):
+            if (len(session.tasks[ecu]) and
+                    session.tasks[ecu][-1].__module__ == ISO_TP_MULTIFRAME_MODULE):
                 logging.error(
                     'Improper frame within ISO-TP ISO-TP Multiframe. ECU: %s, '
                     'data length: %s, frame: %s, data: %s',
                     ecu, length, frame, cmd)
                 return header, cmd, ""
-            self.tasks[ecu].append(
+            session.tasks[ecu].append(
                 IsoTpMultiframe(
                     self, "ISO-TP-Multiframe", header, ecu, cmd, None, do_write)
             )
-            self.tasks[ecu][-1].__module__ = ISO_TP_MULTIFRAME_MODULE
+            session.tasks[ecu][-1].__module__ = ISO_TP_MULTIFRAME_MODULE
 
         # Manage active tasks
-        if ecu in self.tasks and self.tasks[ecu]:  # if a task exists
+        if ecu in session.tasks and session.tasks[ecu]:  # if a task exists
             if len_hex(cmd):
                 r_cmd, *_, r_cont = self.task_action(header, ecu, do_write,
-                                                     self.tasks[ecu][-1].run,
+                                                     session.tasks[ecu][-1].run,
                                                      cmd, length, frame,
                                                      is_ecu=False)
                 if r_cont is None:
@@ -2045,14 +4339,14 @@ class Elm:
                 frame = None
                 if INTERRUPT_TASK_IF_NOT_HEX:
                     logging.warning('Interrupted task "%s" for ECU "%s"',
-                                    self.tasks[ecu][-1].__module__, ecu)
+                                    session.tasks[ecu][-1].__module__, ecu)
                     r_cmd, *_, r_cont = self.task_action(header, ecu, do_write,
-                                                         self.tasks[ecu][
+                                                         session.tasks[ecu][
                                                              -1].stop, cmd,
                                                          length, frame,
                                                          is_ecu=False)
-                    if ecu in self.tasks and self.tasks[ecu]:
-                        del self.tasks[ecu][-1]
+                    if ecu in session.tasks and session.tasks[ecu]:
+                        del session.tasks[ecu][-1]
                     if r_cont is None:
                         return header, cmd, r_cmd
                     else:
@@ -2061,39 +4355,36 @@ class Elm:
                     logging.debug(
                         'Non-hex request "%s" will not be passed to active '
                         'task "%s" for ECU "%s".',
-                        cmd, self.tasks[ecu][-1].__module__, ecu)
+                        cmd, session.tasks[ecu][-1].__module__, ecu)
 
         if frame is not None:
             logging.error("Invalid multiframe %s", repr(org_cmd))
             return header, cmd, ""
 
         # Process response for data stored in cmd
-        i_obd_msg = iter(self.sortedOBDMsg)
+        i_obd_msg = iter(self.dispatch(cmd))
         chained_command = 0
         while True:
             try:
-                key, val = next(i_obd_msg)
+                entry = next(i_obd_msg)
             except StopIteration:
                 break
-            uc_val = {k.upper(): v for k, v in val.items()}
-            if ('REQUEST' in uc_val and
-                    re.match(uc_val['REQUEST'], cmd)):
-                if ('HEADER' in uc_val and header and
-                        uc_val['HEADER'].upper() !=
-                        self.counters["cmd_set_header"]):
+            if entry.match(cmd):
+                if (entry.header is not None and header and
+                        entry.header != session.set_header):
                     continue
-                pid = key if key else 'UNKNOWN'
-                self.counters["cmd_last_pid"] = pid
-                if pid not in self.counters:
-                    self.counters[pid] = 0
-                self.counters[pid] += 1
-                if 'ACTION' in uc_val and uc_val['ACTION'] == 'skip':
+                uc_val = entry.uc_val
+                pid = entry.pid
+                session.last_pid = session.pid = pid
+                statistics.hit(entry.id)
+                if entry.action == 'skip':
                     logging.info("Received %s. PID %s. Action=%s", cmd, pid,
-                                 uc_val['ACTION'])
+                                 entry.action)
                     continue
-                if 'DESCR' in uc_val:
-                    logging.debug("Description: %s, PID %s (%s)",
-                                  uc_val['DESCR'], pid, cmd)
+                if entry.descr is not None:
+                    if log_debug:
+                        logging.debug("Description: %s, PID %s (%s)",
+                                      entry.descr, pid, cmd)
                 else:
                     logging.warning(
                         "Internal error - Missing description for %s, PID %s",
@@ -2105,89 +4396,82 @@ class Elm:
                         logging.error(
                             "Error while processing '%s' for PID %s (%s)",
                             self.answer, pid, e)
-                if 'TASK' in uc_val:
-                    if uc_val['TASK'] not in self.plugins:
+                if entry.task is not None:
+                    if entry.task not in self.plugins:
                         logging.error(
                             'Unexisting plugin %s for pid %s',
-                            repr(uc_val['TASK']), repr(pid))
+                            repr(entry.task), repr(pid))
                         return header, cmd, None
-                    if uc_val['TASK'].startswith('task_ecu_'):
+                    if entry.task.startswith('task_ecu_'):
                         logging.error(
                             'ECU Tasks are not expected to be run by '
                             'standard requests. Plugin %s, pid %s',
-                            repr(uc_val['TASK']), repr(pid))
+                            repr(entry.task), repr(pid))
                         return header, cmd, None
-                    if ecu not in self.tasks:
-                        self.tasks[ecu] = []
-                    if len(self.tasks[ecu]) > MAX_TASKS:
+                    if ecu not in session.tasks:
+                        session.tasks[ecu] = []
+                    if len(session.tasks[ecu]) > MAX_TASKS:
                         logging.critical(
                             'Too many active tasks for ECU %s. '
                             'Latest one was %s.',
-                            ecu, self.tasks[ecu][-1].__module__)
+                            ecu, session.tasks[ecu][-1].__module__)
                         return header, cmd, ""
                     try:
-                        self.tasks[ecu].append(
-                            self.plugins[uc_val['TASK']].Task(
+                        session.tasks[ecu].append(
+                            self.plugins[entry.task].Task(
                                 emulator=self, pid=pid, header=header, ecu=ecu,
                                 request=cmd, attrib=uc_val, do_write=do_write)
                         )
                     except Exception as e:
                         logging.critical(
                             'Cannot add task "%s", ECU="%s": %s',
-                            uc_val['TASK'], ecu, e, exc_info=True)
+                            entry.task, ecu, e, exc_info=True)
                         return header, cmd, None
                     logging.debug('Starting task "%s" for ECU "%s"',
-                                  self.tasks[ecu][-1].__module__, ecu)
+                                  session.tasks[ecu][-1].__module__, ecu)
                     r_cmd, *_, r_cont = self.task_action(
                         header, ecu, do_write,
-                        self.tasks[ecu][-1].start, cmd, length, frame,
+                        session.tasks[ecu][-1].start, cmd, length, frame,
                         is_ecu=False)
                     if r_cont is None:
                         return header, cmd, r_cmd
                     else:  # chain a subsequent command
                         if cmd == r_cont:  # no transformation performed
-                            logging.debug(
-                                'Passthrough task executed: '
-                                'continue processing %s for ECU %s.',
-                                cmd, ecu)
+                            if log_debug:
+                                logging.debug(
+                                    'Passthrough task executed: '
+                                    'continue processing %s for ECU %s.',
+                                    cmd, ecu)
                         else:  # newly reprocess the changed request
                             chained_command += 1
                             if chained_command > MAX_TASKS:
                                 logging.critical(
                                     'Too many subsequent chained commands '
                                     'for ECU %s. Latest task was %s.',
-                                    ecu, uc_val['TASK'])
+                                    ecu, entry.task)
                                 return header, cmd, ""
                             cmd = r_cont
-                            i_obd_msg = iter(self.sortedOBDMsg)
+                            i_obd_msg = iter(self.dispatch(cmd))
                             continue  # restart the loop from the beginning
-                if 'EXEC' in uc_val:
+                if entry.exec_code is not None:
                     try:
-                        exec(uc_val['EXEC'])
+                        exec(entry.exec_code)
                     except Exception as e:
                         logging.error(
                             "Cannot execute '%s' for PID %s (%s)",
                             uc_val['EXEC'], pid, e, exc_info=True)
-                log_string = ""
-                if 'INFO' in uc_val:
-                    log_string = "logging.info(%s)" % uc_val['INFO']
-                if 'WARNING' in uc_val:
-                    log_string = "logging.warning(%s)" % uc_val['WARNING']
-                if 'LOG' in uc_val:
-                    log_string = "logging.debug(%s)" % uc_val['LOG']
-                if log_string:
+                if entry.log_code is not None:
                     try:
-                        exec(log_string)
+                        exec(entry.log_code)
                     except Exception as e:
                         logging.error(
                             "Error while logging '%s' for PID %s (%s)",
-                            log_string, pid, e, exc_info=True)
-                if any(x in uc_val for x in
-                       ['RESPONSE', 'RESPONSEHEADER', 'RESPONSEFOOTER']):
+                            entry.log_string, pid, e, exc_info=True)
+                if entry.has_response:
                     r_header = ''
-                    if 'RESPONSEHEADER' in uc_val:
+                    if entry.response_header is not None:
                         try:
-                            r_header = uc_val['RESPONSEHEADER'](
+                            r_header = entry.response_header(
                                 self, cmd, pid, uc_val)
                         except Exception as e:
                             logging.error(
@@ -2195,18 +4479,16 @@ class Elm:
                                 "for PID %s (%s)",
                                 uc_val['RESPONSEHEADER'], pid, e, exc_info=True)
                     r_footer = ''
-                    if 'RESPONSEFOOTER' in uc_val:
+                    if entry.response_footer is not None:
                         try:
-                            r_footer = uc_val['RESPONSEFOOTER'](
+                            r_footer = entry.response_footer(
                                 self, cmd, pid, uc_val)
                         except Exception as e:
                             logging.error(
                                 "Error while running 'ResponseFooter' %s '"
                                 "for PID %s (%s)",
                                 uc_val['RESPONSEHEADER'], pid, e, exc_info=True)
-                    r_response = ''
-                    if 'RESPONSE' in uc_val:
-                        r_response = uc_val['RESPONSE']
+                    r_response = entry.response
                     if not any([r_response, r_header, r_footer]):
                         return header, cmd, None
                     if isinstance(r_response, (list, tuple)):
@@ -2218,32 +4500,57 @@ class Elm:
                         cmd, pid)
                     return header, cmd, None
         # Here cmd is unknown
-        if "unknown_" + repr(cmd) not in self.counters:
-            self.counters["unknown_" + repr(cmd)] = 0
-        self.counters["unknown_" + repr(cmd)] += 1
+        unknown = "unknown_" + repr(cmd)
+        unknown_count = statistics.hit_unknown(unknown)
         if cmd == '':
             logging.info("No ELM command")
             return header, cmd, ""
-        fw_data = self.send_receive_forward((cmd + '\r').encode())
+        learning = self.learning.enabled
+        forward_queue = self.forward_queue
+        if learning or forward_queue is not None:
+            key = self.learning_key(cmd)
+        if learning:
+            learned = self.learning.get(key)
+            if learned is not None:
+                logging.info("Answer to %s from the learning cache", repr(cmd))
+                return header, cmd, learned
+        forward_answer, session.forward_answer = session.forward_answer, None
+        if forward_queue is not None:
+            pending, session.forward_pending = session.forward_pending, None
+            forward_queue.put(
+                session, cmd,
+                pending[1] if pending is not None and pending[0] == cmd
+                else cmd, unknown, unknown_count == 1, key)
+            fw_data = False  # answered locally
+            learning = False
+        elif forward_answer is not None and forward_answer[0] == cmd:
+            fw_data = forward_answer[1]
+        else:
+            fw_data = self.send_receive_forward((cmd + '\r').encode())
         if fw_data is not False:
-            self.counters["unknown_" + repr(cmd) + "_R"] = repr(fw_data)
+            statistics[unknown + "_R"] = repr(fw_data)
         if (fw_data is not False and
                 re.match(r"^NO DATA *\r", fw_data or "") is None and
                 re.match(r"^\? *\r", fw_data or "") is None and
-                self.counters["unknown_" + repr(cmd)] == 1):
+                unknown_count == 1):
             logging.warning(
                 'Missing data in dictionary: %s. Answer:\n%s',
                 repr(cmd), repr(fw_data))
+        if learning and fw_data:
+            learned = self.learning.store(key, fw_data)
+            if learned is not None:
+                logging.info("Learned answer to %s", repr(cmd))
+                return header, cmd, learned
         if len_hex(cmd):
             if header:
                 logging.info("Unknown request: %s, header=%s",
-                             repr(cmd), self.counters["cmd_set_header"])
+                             repr(cmd), session.set_header)
             else:
                 logging.info("Unknown request: %s", repr(cmd))
             return header, cmd, ST('NO DATA')
         if header:
             logging.info("Unknown ELM command: %s, header=%s",
-                         repr(cmd), self.counters["cmd_set_header"])
+                         repr(cmd), session.set_header)
         else:
             logging.info("Unknown ELM command: %s", repr(cmd))
         return header, cmd, self.ELM_R_UNKNOWN
@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+###########################################################################
+# ELM327-emulator
+# ELM327 Emulator for testing software interfacing OBDII via ELM327 adapter
+# https://github.com/Ircama/ELM327-emulator
+# (C) Ircama 2021 - CC-BY-NC-SA-4.0
+###########################################################################
+
+"""
+Forwarder of the requests to one or more OBD-II interfaces (ELM327
+adapters) connected through serial ports or TCP/IP (ref. the forward_...
+arguments of Elm).
+
+The connection of each interface is opened when the forwarder starts and
+kept open; if it fails, it is closed and reopened with exponential
+backoff, without stopping the emulator. Idle connections are checked by a
+periodic ATI probe. Requests are distributed across the connected
+interfaces (round robin), while the AT and ST commands are sent to all of
+them and replayed when an interface is reconnected, so that all the
+interfaces keep the same settings. The response timing of each request
+can be recorded (ref. Elm.timing).
+"""
+
+import logging
+import socket
+import threading
+import time
+from .elm import (READ_BUFFER_SIZE, SERIAL_BAUDRATE, FORWARD_TIMEOUT,
+                  FORWARD_READ_TIMEOUT)
+
+FORWARD_BACKOFF_MIN = 0.5  # seconds - first delay before reconnecting
+FORWARD_BACKOFF_MAX = 30.0  # seconds - max delay before reconnecting
+FORWARD_PROBE = b"ATI\r"  # health probe of the idle interfaces
+FORWARD_PROBE_INTERVAL = 30.0  # seconds - idle time before a probe
+FORWARD_PROBE_TIMEOUT = 2.0  # seconds - max time to wait for the probe answer
+FORWARD_CHECK_INTERVAL = 1.0  # seconds - period of the probe thread
+FORWARD_SETTINGS_SIZE = 64  # max number of AT/ST commands replayed
+FORWARD_RESET = (b"ATZ", b"ATWS", b"ATD")  # commands clearing the settings
+
+
+def as_list(value):
+    """
+    Return a list of values from None, a single value or a sequence.
+    """
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+
+def pairs(first, second):
+    """
+    Pair the values of two lists; the last value of the shorter list is
+    reused (e.g., one host with more ports).
+    :return: list of tuples (empty if the first list is empty)
+    """
+    if not first:
+        return []
+    second = second or [None]
+    return [(first[min(i, len(first) - 1)], second[min(i, len(second) - 1)])
+            for i in range(max(len(first), len(second)))]
+
+
+class ForwardTarget:
+    """
+    Connection to an OBD-II interface. Subclasses implement connect(),
+    write(), flush(), set_timeout() and receive(). The lock shall be
+    held when using the connection.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.handle = None  # socket or serial.Serial object
+        self.lock = threading.Lock()
+        self.failures = 0  # consecutive failures (backoff)
+        self.retry_time = 0  # time.monotonic() value of the next connection
+        self.last_used = 0  # time.monotonic() value of the last exchange
+        self.sent = 0  # time.monotonic() value of the last written request
+        self.received = 0  # time.monotonic() value of its first answer data
+        self.errors = 0  # total number of failures
+
+    def __repr__(self):
+        return self.name
+
+    @property
+    def connected(self):
+        return self.handle is not None
+
+    def open(self):
+        """
+        Open the connection, if not already open and if the backoff delay
+        is elapsed.
+        :return: True if the connection is open
+        """
+        if self.handle is not None:
+            return True
+        if time.monotonic() < self.retry_time:
+            return False
+        try:
+            self.connect()
+        except Exception as e:
+            self.failed(e)
+            return False
+        self.failures = 0
+        self.last_used = time.monotonic()
+        logging.info("Connected to the OBD-II interface %s", self.name)
+        return True
+
+    def failed(self, error):
+        """
+        Close a failed connection and set the backoff delay.
+        :param error: exception or description of the failure
+        """
+        self.close()
+        self.errors += 1
+        self.failures += 1
+        delay = min(FORWARD_BACKOFF_MIN * 2 ** (self.failures - 1),
+                    FORWARD_BACKOFF_MAX)
+        self.retry_time = time.monotonic() + delay
+        logging.error("OBD-II interface %s failed (%s); retrying in %.1f s",
+                      self.name, error, delay)
+
+    def close(self):
+        if self.handle is not None:
+            try:
+                self.handle.close()
+            except Exception:
+                pass
+            self.handle = None
+
+
+class NetTarget(ForwardTarget):
+    """
+    OBD-II interface connected through TCP/IP.
+    """
+
+    def __init__(self, host, port):
+        super().__init__("%s:%s" % (host, port))
+        self.host = host
+        self.port = int(port)
+
+    def connect(self):
+        sock = socket.create_connection(
+            (self.host, self.port), timeout=FORWARD_TIMEOUT)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.handle = sock
+
+    def write(self, data):
+        self.handle.sendall(data)
+
+    def flush(self):
+        """
+        Discard the data received after the timeout of the previous request.
+        """
+        self.handle.setblocking(False)
+        try:
+            while True:
+                if not self.handle.recv(READ_BUFFER_SIZE):
+                    raise ConnectionError("connection closed")
+        except BlockingIOError:
+            pass
+        finally:
+            self.handle.setblocking(True)
+
+    def set_timeout(self, timeout):
+        self.handle.settimeout(timeout)
+
+    def receive(self):
+        try:
+            data = self.handle.recv(READ_BUFFER_SIZE)
+        except socket.timeout:
+            return b""
+        if not data:
+            raise ConnectionError("connection closed")
+        return data
+
+
+class SerialTarget(ForwardTarget):
+    """
+    OBD-II interface connected through a serial port.
+    """
+
+    def __init__(self, port, baudrate=None):
+        super().__init__(port)
+        self.port = port
+        self.baudrate = int(baudrate) if baudrate else SERIAL_BAUDRATE
+
+    def connect(self):
+        import serial
+        self.handle = serial.Serial(
+            port=self.port, baudrate=self.baudrate, timeout=FORWARD_TIMEOUT)
+
+    def write(self, data):
+        self.handle.write(data)
+
+    def flush(self):
+        self.handle.reset_input_buffer()
+
+    def set_timeout(self, timeout):
+        self.handle.timeout = timeout
+
+    def receive(self):
+        return self.handle.read(self.handle.in_waiting or 1)
+
+
+class Forwarder:
+    """
+    Pool of the connections to the OBD-II interfaces (Elm.forwarder).
+    """
+
+    def __init__(self, emulator, targets):
+        """
+        :param emulator: Elm object (forward_timeout and forward_terminator
+            attributes)
+        :param targets: list of ForwardTarget objects
+        """
+        self.emulator = emulator
+        self.targets = targets
+        self.next = 0  # index of the next target (round robin)
+        self.settings = []  # AT/ST commands sent since the last reset
+        self.settings_lock = threading.Lock()  # protects settings
+        self.probe_interval = FORWARD_PROBE_INTERVAL  # None disables probes
+        self.stopped = threading.Event()  # stop event of the probe thread
+        self.thread = None
+
+    @classmethod
+    def from_emulator(cls, emulator):
+        """
+        Create a Forwarder with the targets configured by the forward_...
+        arguments of an Elm object, which accept a single value or a list
+        of values (one for each OBD-II interface).
+        :return: Forwarder object, or None if no target is configured
+        """
+        targets = [
+            SerialTarget(port, baudrate) for port, baudrate in pairs(
+                as_list(emulator.forward_serial_port),
+                as_list(emulator.forward_serial_baudrate))
+        ] + [
+            NetTarget(host, port) for host, port in pairs(
+                as_list(emulator.forward_net_host),
+                as_list(emulator.forward_net_port)) if port
+        ]
+        return cls(emulator, targets) if targets else None
+
+    def __len__(self):
+        return len(self.targets)
+
+    def start(self):
+        """
+        Open the connections and start the thread reconnecting and probing
+        the targets.
+        """
+        for target in self.targets:
+            with target.lock:
+                self.open(target)
+        if self.thread is None:
+            self.stopped = threading.Event()
+            self.thread = threading.Thread(
+                target=self.check, args=(self.stopped,),
+                name="ELM327-emulator forward probe")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        """
+        Stop the probe thread, waiting for its termination, and close the
+        connections.
+        """
+        self.stopped.set()
+        thread, self.thread = self.thread, None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        for target in self.targets:
+            with target.lock:
+                target.close()
+
+    def open(self, target):
+        """
+        Open the connection of a target (lock held), replaying the AT/ST
+        commands sent to the other targets.
+        :return: True if the connection is open
+        """
+        if target.connected:
+            return True
+        if not target.open():
+            return False
+        with self.settings_lock:
+            settings = list(self.settings)
+        for data in settings:
+            try:
+                self.exchange(target, data)
+            except Exception as e:
+                target.failed(e)
+                return False
+        return True
+
+    def get_timeout(self):
+        """
+        Return the max time to wait for an answer: emulator.forward_timeout
+        if set, otherwise FORWARD_TIMEOUT when the answer is read up to a
+        terminator and FORWARD_READ_TIMEOUT when it is not.
+        :return: seconds (float)
+        """
+        if self.emulator.forward_timeout:
+            return self.emulator.forward_timeout
+        if self.emulator.forward_terminator:
+            return FORWARD_TIMEOUT
+        return FORWARD_READ_TIMEOUT
+
+    def exchange(self, target, data, timeout=None):
+        """
+        Send data to a target (lock held) and read the answer, accumulating
+        data up to emulator.forward_terminator (the ELM327 prompt by
+        default) within the timeout. Without terminator, the first data
+        read are returned. Data received after the timeout of the previous
+        request are discarded before sending.
+        :param target: ForwardTarget object
+        :param data: bytes to be sent
+        :param timeout: max time (default is get_timeout())
+        :return: read bytes (b"" if no data)
+        """
+        terminator = self.emulator.forward_terminator
+        deadline = time.monotonic() + (timeout or self.get_timeout())
+        target.flush()
+        target.write(data)
+        target.sent = target.received = time.monotonic()
+        answer = b""
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logging.debug("Forward terminator not received within "
+                                  "the timeout: %r", answer)
+                    return answer
+                target.set_timeout(remaining)
+                chunk = target.receive()
+                if not chunk:
+                    return answer
+                if not answer:
+                    target.received = time.monotonic()
+                start = max(len(answer) - len(terminator) + 1, 0) \
+                    if terminator else 0
+                answer += chunk
+                if not terminator or answer.find(terminator, start) >= 0:
+                    return answer
+        finally:
+            target.last_used = time.monotonic()
+
+    def send_receive(self, data):
+        """
+        Forward data to the next connected target (round robin), trying the
+        other ones if it fails or is busy; AT and ST commands are sent to
+        all the connected targets.
+        :param data: bytes to be sent
+        :return: answer (bytes) of the first target, or None if no target
+            is available
+        """
+        command = data.strip().upper()
+        if command.startswith((b"AT", b"ST")):
+            return self.send_setting(data, command)
+        count = len(self.targets)
+        for blocking in (False, True):
+            for i in range(count):
+                index = (self.next + i) % count
+                target = self.targets[index]
+                if not target.lock.acquire(blocking):
+                    continue
+                try:
+                    if not self.open(target):
+                        continue
+                    try:
+                        answer = self.exchange(target, data)
+                    except Exception as e:
+                        target.failed(e)
+                        continue
+                    self.next = (index + 1) % count
+                    if answer and self.emulator.timing.recording:
+                        self.record_timing(target, command, answer)
+                    return answer
+                finally:
+                    target.lock.release()
+        return None
+
+    def record_timing(self, target, command, answer):
+        """
+        Add the latency and the byte pacing of the last answer of a target
+        to the timing profile of the emulator (ref. TimingProfile.record()).
+        :param target: ForwardTarget object
+        :param command: request (bytes)
+        :param answer: read bytes
+        """
+        pacing = (target.last_used - target.received) / (len(answer) - 1) \
+            if len(answer) > 1 else 0
+        self.emulator.timing.record(
+            b"".join(command.split()).decode("utf-8", "ignore"),
+            target.received - target.sent, pacing)
+
+    def send_setting(self, data, command):
+        """
+        Send an AT or ST command to all the connected targets and store it
+        to be replayed when a target is reconnected (reset commands clear
+        the stored ones).
+        :return: answer (bytes) of the first target, or None if no target
+            is available
+        """
+        if command.startswith(FORWARD_RESET):
+            with self.settings_lock:
+                self.settings = []
+        result = None
+        for target in self.targets:
+            with target.lock:
+                if not self.open(target):
+                    continue
+                try:
+                    answer = self.exchange(target, data)
+                except Exception as e:
+                    target.failed(e)
+                    continue
+                if result is None:
+                    result = answer
+                    if answer and self.emulator.timing.recording:
+                        self.record_timing(target, command, answer)
+        with self.settings_lock:
+            self.settings.append(data)
+            del self.settings[:-FORWARD_SETTINGS_SIZE]
+        return result
+
+    def check(self, stopped):
+        """
+        Probe thread: reconnect the failed targets after the backoff delay
+        and send FORWARD_PROBE to the targets idle for probe_interval
+        seconds, closing them if they do not answer.
+        :param stopped: threading.Event terminating the thread
+        """
+        while not stopped.wait(FORWARD_CHECK_INTERVAL):
+            for target in self.targets:
+                if not target.lock.acquire(False):
+                    continue  # in use
+                try:
+                    if not target.connected:
+                        self.open(target)
+                        continue
+                    if (not self.probe_interval or time.monotonic() -
+                            target.last_used < self.probe_interval):
+                        continue
+                    try:
+                        answer = self.exchange(
+                            target, FORWARD_PROBE, FORWARD_PROBE_TIMEOUT)
+                    except Exception as e:
+                        target.failed(e)
+                        continue
+                    if not answer.strip():
+                        target.failed("no answer to the ATI probe")
+                    else:
+                        logging.debug("ATI probe of %s: %r",
+                                      target.name, answer)
+                finally:
+                    target.lock.release()
@@ -9,7 +9,6 @@
 
 import sys
 import traceback
-import webbrowser
 
 import elm.elm
 
@@ -17,10 +16,9 @@ try:
     if sys.hexversion < 0x3060000:
         raise ImportError("Python version must be >= 3.6")
     import threading
-    from .elm import Elm
+    from .elm import Elm, VirtualClock, PROFILE_RATE, FORWARD_PROMPT
     import time
     from cmd import Cmd
-    import rlcompleter
     import glob
     import logging
     import re
@@ -28,7 +26,6 @@ try:
     import os
     import os.path
     import argparse
-    import datetime
     try:
         import readline
     except ImportError:
@@ -39,16 +36,12 @@ try:
         except ImportError:
             pass
     else:
-        import daemon
-        import daemon.pidfile
+        from lockfile.pidlockfile import read_pid_from_pidfile
+        from lockfile import AlreadyLocked, NotLocked, LockFailed
     import signal
-    from lockfile.pidlockfile import PIDLockFile
-    from lockfile import AlreadyLocked, NotLocked, LockFailed
     from .__version__ import __version__
     from .obd_message import ObdMessage, ECU_ADDR_E, ELM_R_OK
     from random import randint
-    from xml.etree.ElementTree import fromstring, ParseError, tostring
-    import pprint
 except ImportError as detail:
     print(
         "ELM327 OBD-II adapter emulator import error:\n "
@@ -56,12 +49,16 @@ except ImportError as detail:
         + "\nInstall prerequisites before running the product."
         )
     sys.exit(1)
+# Other modules are imported when the related feature is used: daemon (-d
+# option), rlcompleter (TAB completion), webbrowser (usage), pprint and
+# datetime (tasks), xml.etree (Edit class)
 
 DAEMON_PIDFILE_DIR_ROOT = '/var/run/'
 DAEMON_PIDFILE_DIR_NON_ROOT = '/tmp/'
 DAEMON_PIDFILE = 'ELM327_emulator.pid'
 DAEMON_UMASK = 0o002
 DAEMON_DIR = '/tmp'
+DAEMON_PROFILE_FILE = 'ELM327_emulator_profile.folded'
 
 
 class Edit:
@@ -134,6 +131,7 @@ class Edit:
             return False
         if isinstance(r_response, (list, tuple)):
             r_response = r_response[randint(0, len(r_response) - 1)]
+        from xml.etree.ElementTree import fromstring, ParseError, tostring
         try:
             root = fromstring('<xml>' + r_response + '</xml>')
         except ParseError as e:
@@ -184,6 +182,7 @@ def dump_var(var_name, value):
     if var_name in ["logging", "emulator", "shared", "__module__"]:
         return
     if var_name == "time_started":
+        import datetime
         print("    {}: {}".format(
             var_name,
             datetime.datetime.fromtimestamp(float(value)).strftime('%c, ')) +
@@ -195,7 +194,7 @@ def dump_var(var_name, value):
 class Interpreter(Cmd):
 
     __hiden_methods = ('do_EOF',)
-    rlc = rlcompleter.Completer().complete
+    completer = None  # rlcompleter.Completer object (ref. rlc())
     histfile = os.path.expanduser('~/.ELM327_emulator_history')
     host_lib = 'emulator' # must be declared in default(), completedefault(), completenames()
     histfile_size = 1000
@@ -329,14 +328,16 @@ class Interpreter(Cmd):
     def do_wait(self, arg):
         "Perform an immediate sleep of the seconds specified "\
         "in the argument.\n"\
-        "(Floating point number; default is 10 seconds.)"
+        "(Floating point number; default is 10 seconds.)\n"\
+        "With the virtual clock (-c option), the emulator time is moved "\
+        "forward without waiting."
         try:
             delay = 10 if len(arg) == 0 else float(arg.split()[0])
         except ValueError:
             print ("Invalid format.")
             return
         print("Sleeping for %s seconds" % delay)
-        time.sleep(delay)
+        self.emulator.clock.sleep(delay)
 
     def do_prompt(self, arg):
         "Toggle prompt off/on or change the prompt."
@@ -374,6 +375,7 @@ class Interpreter(Cmd):
         "CRITICAL=50, ERROR=40, WARNING=30, INFO=20, DEBUG=10."
         if arg and arg.isnumeric():  # numeric
             logging.getLogger().handlers[0].setLevel(int(arg))
+            self.emulator.update_log_level()
             log = logging.getLogger().handlers[0].level
             if int(arg) in logging._levelToName:
                 print("Logging level set to {} ({})".format(
@@ -387,6 +389,7 @@ class Interpreter(Cmd):
                 dict(zip(
                     logging._levelToName.values(),
                     logging._levelToName.keys()))[arg.upper()])
+            self.emulator.update_log_level()
             log = logging.getLogger().handlers[0].level
             print("Logging level set to {} ({})".format(
                 log, logging._levelToName[log]))
@@ -523,6 +526,7 @@ class Interpreter(Cmd):
         if arg:
             print ("Invalid format.")
             return
+        import pprint
         if self.emulator.plugins:
             print("Plugins:")
             for i in sorted(self.emulator.plugins):
@@ -578,15 +582,242 @@ class Interpreter(Cmd):
         if arg:
             print ("Invalid format.")
             return
-        if self.emulator.counters:
+        session = self.emulator.default_session
+        statistics = session.statistics
+        snapshot = statistics.snapshot()
+        settings = {k: v for k, v in session.counters.items()
+                    if k not in snapshot}
+        if settings or snapshot:
             print("PID Counters:")
-            for i in sorted(self.emulator.counters):
-                print("  {:22s} = {}".format(i, self.emulator.counters[i]))
+            for i in sorted(settings):
+                print("  {:22s} = {}".format(i, settings[i]))
+            for i in sorted(k for k in snapshot
+                            if not elm.elm.is_unknown_counter(k)):
+                print("  {:22s} = {}".format(i, snapshot[i]))
+            for i in snapshot.unknown:  # least recently updated first
+                print("  {:22s} = {}".format(i, snapshot.unknown[i]))
+            if statistics.evicted:
+                print("  ({} older unknown request counters removed)".format(
+                    statistics.evicted))
         else:
             print("No counters available.")
         print("  {:22s} = {}".format("delay", self.emulator.delay))
         print("  {:22s} = {}".format("scenario", self.emulator.scenario))
 
+    def do_stats(self, arg):
+        "Print the processing time of each executed PID and of each\n"\
+        "plugin task method (count, total time in milliseconds, mean,\n"\
+        "50th, 95th and 99th percentile and max in microseconds),\n"\
+        "sorted by total time. The processing time of a PID includes\n"\
+        "the request dispatch, Exec, response lambdas, response template\n"\
+        "and device write, excluding the configured delays.\n"\
+        "'stats reset' clears the collected data."
+        if arg == 'reset':
+            self.emulator.latency.clear()
+            self.emulator.task_latency.clear()
+            print("Statistics cleared.")
+            return
+        if arg:
+            print ("Invalid format.")
+            return
+        if not self.emulator.latency and not self.emulator.task_latency:
+            print("No statistics available.")
+            return
+        for title, histograms in (
+                ("PID", self.emulator.latency),
+                ("Plugin task", self.emulator.task_latency)):
+            if not histograms:
+                continue
+            print("{:30s} {:>8s} {:>10s} {:>9s} {:>9s} {:>9s} {:>9s} "
+                  "{:>9s}".format(title, "count", "total ms", "mean us",
+                                  "p50 us", "p95 us", "p99 us", "max us"))
+            for key, h in sorted(list(histograms.items()),
+                                 key=lambda x: -x[1].total):
+                print("  {:28s} {:8d} {:10.3f} {:9.1f} {:9.1f} {:9.1f} "
+                      "{:9.1f} {:9.1f}".format(
+                          "(unknown request)" if key is None else key,
+                          h.count, h.total / 1e6, h.total / h.count / 1e3,
+                          h.percentile(0.50) / 1e3,
+                          h.percentile(0.95) / 1e3,
+                          h.percentile(0.99) / 1e3, h.max / 1e3))
+
+    def do_profile(self, arg):
+        "Sampling profiler of the emulator thread. Arguments:\n"\
+        "  start [RATE]: start sampling (RATE samples per second),\n"\
+        "  stop: stop sampling,\n"\
+        "  dump FILE: write the samples in collapsed-stack format\n"\
+        "      (for flame graphs) and clear them.\n"\
+        "Without arguments, print the profiler status."
+        profiler = self.emulator.profiler
+        args = arg.split()
+        if not args:
+            print("Profiler {}, {} samples.".format(
+                "running at {} samples/s".format(profiler.rate)
+                if profiler.running else "stopped",
+                profiler.count))
+            return
+        if args[0] == 'start' and len(args) <= 2:
+            try:
+                rate = float(args[1]) if len(args) > 1 else self.args.profile_rate[0]
+                if rate <= 0:
+                    raise ValueError
+            except ValueError:
+                print("Invalid rate.")
+                return
+            if self.emulator.run_thread_id is None:
+                print("Emulator not running.")
+            elif profiler.start(self.emulator.run_thread_id, rate):
+                print("Profiler started.")
+            else:
+                print("Profiler already running.")
+        elif args[0] == 'stop' and len(args) == 1:
+            if profiler.stop():
+                print("Profiler stopped.")
+            else:
+                print("Profiler not running.")
+        elif args[0] == 'dump' and len(args) == 2:
+            try:
+                n = profiler.dump(args[1])
+            except Exception as e:
+                print("Cannot write file:", e)
+                return
+            profiler.clear()
+            print("Written {} samples to {}.".format(n, args[1]))
+        else:
+            print("Invalid format.")
+
+    def do_trace(self, arg):
+        "Trace of the bytes exchanged with the clients (ring buffer of the\n"\
+        "latest records). Arguments:\n"\
+        "  on: enable the trace,\n"\
+        "  off: disable the trace,\n"\
+        "  clear: remove all records,\n"\
+        "  dump FILE: write the records to FILE, in pcap format if\n"\
+        "      FILE ends with .pcap, otherwise in JSON Lines format.\n"\
+        "Without arguments, print the trace status."
+        trace = self.emulator.trace
+        args = arg.split()
+        if not args:
+            print("Trace {}, {} of {} records.".format(
+                "enabled" if trace.enabled else "disabled",
+                len(trace), trace.size))
+        elif args == ['on']:
+            trace.enabled = True
+            print("Trace enabled.")
+        elif args == ['off']:
+            trace.enabled = False
+            print("Trace disabled.")
+        elif args == ['clear']:
+            trace.clear()
+            print("Trace cleared.")
+        elif args[0] == 'dump' and len(args) == 2:
+            try:
+                n = trace.dump(args[1])
+            except Exception as e:
+                print("Cannot write file:", e)
+                return
+            print("Written {} records to {}.".format(n, args[1]))
+        else:
+            print("Invalid format.")
+
+    def do_learn(self, arg):
+        "Learning cache of the answers of the forwarded OBD-II interface\n"\
+        "to the requests unknown to the dictionary. Arguments:\n"\
+        "  on [TTL]: enable the cache (answers expire after TTL seconds;\n"\
+        "      0 means no expiry),\n"\
+        "  off: disable the cache,\n"\
+        "  clear: remove all answers,\n"\
+        "  export FILE [SCENARIO]: write the answers to the FILE module as\n"\
+        "      an ObdMessage scenario (default name is 'learned'), which\n"\
+        "      can be loaded with the 'merge' command.\n"\
+        "Without arguments, print the cache status."
+        learning = self.emulator.learning
+        args = arg.split()
+        if not args:
+            print("Learning cache {}, {} answers{}.".format(
+                "enabled" if learning.enabled else "disabled",
+                len(learning),
+                ", expiring after {} seconds".format(learning.ttl)
+                if learning.ttl else ""))
+        elif args[0] == 'on' and len(args) <= 2:
+            if len(args) == 2:
+                try:
+                    ttl = float(args[1])
+                    if ttl < 0:
+                        raise ValueError
+                except ValueError:
+                    print("Invalid TTL.")
+                    return
+                learning.ttl = ttl or None
+            learning.enabled = True
+            print("Learning cache enabled.")
+        elif args == ['off']:
+            learning.enabled = False
+            print("Learning cache disabled.")
+        elif args == ['clear']:
+            learning.clear()
+            print("Learning cache cleared.")
+        elif args[0] == 'export' and len(args) in (2, 3):
+            try:
+                n = learning.export(args[1], *args[2:])
+            except Exception as e:
+                print("Cannot write file:", e)
+                return
+            print("Written {} entries to {}.".format(n, args[1]))
+        else:
+            print("Invalid format.")
+
+    def do_timing(self, arg):
+        "Response timing profiles (latency and byte pacing of each request)\n"\
+        "recorded from the forwarded OBD-II interface. Arguments:\n"\
+        "  record on|off: start or stop recording,\n"\
+        "  replay on|off: delay the responses with the profile of each\n"\
+        "      request (or PID, or of all requests),\n"\
+        "  save FILE: write the profiles to the FILE JSON file,\n"\
+        "  load FILE: read the profiles from FILE,\n"\
+        "  clear: remove all profiles.\n"\
+        "Without arguments, print the profiles."
+        timing = self.emulator.timing
+        args = arg.split()
+        if not args:
+            print("Timing recording {}, replay {}, {} profiles.".format(
+                "on" if timing.recording else "off",
+                "on" if timing.replay else "off", len(timing)))
+            if timing.changed:
+                timing.build()
+            for key, (latency, pacing) in sorted(timing.tables.items()):
+                print("  {}: latency p50 {:.1f} ms, p99 {:.1f} ms, "
+                      "max {:.1f} ms; pacing p50 {:.3f} ms/byte".format(
+                    key, latency[len(latency) // 2] * 1000,
+                    latency[(len(latency) - 1) * 99 // 100] * 1000,
+                    latency[-1] * 1000, pacing[len(pacing) // 2] * 1000))
+        elif len(args) == 2 and args[0] in ('record', 'replay') and \
+                args[1] in ('on', 'off'):
+            if args[0] == 'record':
+                timing.recording = args[1] == 'on'
+            else:
+                timing.replay = args[1] == 'on'
+            print("Timing {} {}.".format(args[0], args[1]))
+        elif args == ['clear']:
+            timing.clear()
+            print("Timing profiles cleared.")
+        elif len(args) == 2 and args[0] == 'save':
+            try:
+                n = timing.save(args[1])
+            except Exception as e:
+                print("Cannot write file:", e)
+                return
+            print("Written {} profiles to {}.".format(n, args[1]))
+        elif len(args) == 2 and args[0] == 'load':
+            try:
+                n = timing.load(args[1])
+            except Exception as e:
+                print("Cannot load file:", e)
+                return
+            print("Loaded {} profiles from {}.".format(n, args[1]))
+        else:
+            print("Invalid format.")
+
     def do_pause(self, arg):
         "Pause the execution."
         if arg:
@@ -757,6 +988,7 @@ class Interpreter(Cmd):
             try:
                 exec('from ' + arg + ' import ObdMessage', globals())
                 self.emulator.ObdMessage.update(ObdMessage)
+                self.emulator.set_sorted_obd_msg()
                 print("ObdMessage successfully imported and merged. "
                       "Available scenarios:")
                 print("%s" % ', '.join([
@@ -805,6 +1037,7 @@ class Interpreter(Cmd):
             print ("Invalid format of the command.")
             return
         try:
+            import webbrowser
             ret = webbrowser.open(url)
             if ret:
                 print("The web browser is being opened.")
@@ -848,6 +1081,20 @@ class Interpreter(Cmd):
                     return False
         return not queue
 
+    def rlc(self, text, state):
+        """
+        Python identifier completion (rlcompleter.Completer().complete);
+        rlcompleter is imported when first used.
+        """
+        if Interpreter.completer is None:
+            if readline:  # importing rlcompleter replaces the completer
+                completer = readline.get_completer()
+            import rlcompleter
+            if readline:
+                readline.set_completer(completer)
+            Interpreter.completer = rlcompleter.Completer()
+        return Interpreter.completer.complete(text, state)
+
     # completedefault and completenames manage autocompletion of Python
     # identifiers and namespaces
     def completedefault(self, text, line, begidx, endidx):
@@ -903,7 +1150,8 @@ class Interpreter(Cmd):
         return Cmd.precmd(self, line)
 
     def postcmd(self, stop, line):
-        self.emulator.set_sorted_obd_msg()
+        if self.emulator.scenario_changed():
+            self.emulator.set_sorted_obd_msg()
         return Cmd.postcmd(self, stop, line)
 
     def preloop(self):
@@ -1074,55 +1322,147 @@ def main():
         nargs = 1,
         metavar = 'INET_PORT'
     )
+    parser.add_argument(
+        '-m', '--multi-session',
+        dest = 'multi_session',
+        action='store_true',
+        help = "Serve concurrent connections of the INET socket port, "
+            "each one with its own emulator session (requires -n)."
+    )
+    parser.add_argument(
+        '-c', '--virtual-clock',
+        dest = 'virtual_clock',
+        action='store_true',
+        help = "Use a virtual clock, moving the time forward instantly "
+            "instead of waiting for the configured delays (e.g., in batch "
+            "mode, to run timing-heavy scenarios faster than real time)."
+    )
+    parser.add_argument(
+        '-r', '--profile-rate',
+        dest = 'profile_rate',
+        type=float,
+        help = "Set the sampling rate (samples per second) of the profiler "
+            "started by the 'profile' command or by SIGUSR1 in daemon mode "
+            "(default is %s)." % PROFILE_RATE,
+        default = [PROFILE_RATE],
+        nargs = 1,
+        metavar = 'RATE'
+    )
+    parser.add_argument(
+        '-M', '--metrics',
+        dest = 'metrics_port',
+        type=int,
+        help = "Expose the metrics of ELM327-emulator in Prometheus text "
+            "format through an HTTP listener on the given local port.",
+        default = None,
+        nargs = 1,
+        metavar = 'METRICS_PORT'
+    )
     parser.add_argument(
         '-H', '--forward_host',
         dest = 'forward_net_host',
-        help = "Set the INET host used by ELM327-emulator."
-            "when forwarding the client interaction to a remote OBD-II port.",
+        action = 'append',
+        help = "Set the INET host used by ELM327-emulator "
+            "when forwarding the client interaction to a remote OBD-II port "
+            "(can be repeated to use more OBD-II interfaces).",
         default = None,
-        nargs = 1,
         metavar = 'INET_FORWARD_HOST'
     )
     parser.add_argument(
         '-N', '--forward_port',
         dest = 'forward_net_port',
+        action = 'append',
         type=int,
         help = "Set the INET socket port used by ELM327-emulator "
-            "when forwarding the client interaction to a remote OBD-II port.",
+            "when forwarding the client interaction to a remote OBD-II port "
+            "(can be repeated to use more OBD-II interfaces).",
         default = None,
-        nargs = 1,
         metavar = 'INET_FORWARD_PORT'
     )
     parser.add_argument(
         '-S', '--forward_serial_port',
         dest = 'forward_serial_port',
+        action = 'append',
         help = "Set the serial device port used by ELM327-emulator "
-            "when forwarding the client interaction to a serial device.",
+            "when forwarding the client interaction to a serial device "
+            "(can be repeated to use more OBD-II interfaces).",
         default = None,
-        nargs = 1,
         metavar = 'FORWARD_SERIAL_PORT'
     )
     parser.add_argument(
         '-B', '--forward_serial_baudrate',
         dest = 'forward_serial_baudrate',
+        action = 'append',
         type=int,
         help = "Set the device baud rate used by ELM327-emulator "
-            "when forwarding the client interaction to a serial device.",
+            "when forwarding the client interaction to a serial device "
+            "(can be repeated, one for each -S option).",
         default = None,
-        nargs = 1,
         metavar = 'FORWARD_SERIAL_BAUDRATE'
     )
     parser.add_argument(
         '-T', '--forward_timeout',
         dest = 'forward_timeout',
         type=float,
-        help = "Set forward timeout as floating number "
-            "(default is 5 seconds).",
+        help = "Set forward timeout as floating number: max time to "
+            "wait for the answer of the OBD-II interface (default is 5 "
+            "seconds, or 0.2 seconds with an empty FORWARD_TERMINATOR).",
         default = None,
         nargs = 1,
         metavar = 'FORWARD_TIMEOUT'
     )
+    parser.add_argument(
+        '-F', '--forward_terminator',
+        dest = 'forward_terminator',
+        help = "Set the string ending the answers of the OBD-II interface "
+            "when forwarding (backslash escapes are allowed; default is "
+            "the ELM327 prompt '>'; an empty string returns the data read "
+            "at the first attempt).",
+        default = None,
+        nargs = 1,
+        metavar = 'FORWARD_TERMINATOR'
+    )
+    parser.add_argument(
+        '-L', '--forward_learn',
+        dest = 'forward_learn_ttl',
+        type=float,
+        help = "Enable the learning cache of the forwarder: the answers of "
+            "the OBD-II interface to the requests unknown to the dictionary "
+            "are returned to the client and reused for FORWARD_LEARN_TTL "
+            "seconds (0 means no expiry).",
+        default = None,
+        nargs = 1,
+        metavar = 'FORWARD_LEARN_TTL'
+    )
+    parser.add_argument(
+        '-Q', '--forward_background',
+        dest = 'forward_background',
+        action='store_true',
+        help = "Forward the requests in background through a bounded queue, "
+            "answering the client without waiting for the OBD-II interface "
+            "(the answers to the unknown requests are logged and learned)."
+    )
+    parser.add_argument(
+        '-R', '--timing_record',
+        dest = 'timing_record',
+        action='store_true',
+        help = "Record the response timing (latency and byte pacing) of the "
+            "forwarded OBD-II interface for each request (ref. 'timing' "
+            "command)."
+    )
+    parser.add_argument(
+        '-E', '--timing_replay',
+        dest = 'timing_replay',
+        help = "Load the timing profiles of TIMING_FILE (written by the "
+            "'timing save' command) and delay each response with the "
+            "recorded latency and byte pacing distributions.",
+        default = None,
+        nargs = 1,
+        metavar = 'TIMING_FILE'
+    )
     args = parser.parse_args()
+    if args.multi_session and not args.net_port:
+        parser.error("the -m/--multi-session option requires -n/--net")
 
     if args.version:
         print(f'ELM327-emulator version {__version__}.')
@@ -1150,24 +1490,31 @@ def main():
             if args.serial_baudrate else None,
         net_port=args.net_port[0]
             if args.net_port else None,
-        forward_net_host=args.forward_net_host[0]
-            if args.forward_net_host else None,
-        forward_net_port=args.forward_net_port[0]
-            if args.forward_net_port else None,
-        forward_serial_port=args.forward_serial_port[0]
-            if args.forward_serial_port else None,
-        forward_serial_baudrate = args.forward_serial_baudrate[0]
-            if args.forward_serial_baudrate else None,
+        forward_net_host=args.forward_net_host,
+        forward_net_port=args.forward_net_port,
+        forward_serial_port=args.forward_serial_port,
+        forward_serial_baudrate = args.forward_serial_baudrate,
         forward_timeout = args.forward_timeout[0]
-            if args.forward_timeout else None)
+            if args.forward_timeout else None,
+        forward_terminator = args.forward_terminator[0].encode(
+            'latin-1', 'backslashreplace').decode('unicode_escape')
+            if args.forward_terminator else FORWARD_PROMPT,
+        forward_learn_ttl = args.forward_learn_ttl[0]
+            if args.forward_learn_ttl else None,
+        forward_background=args.forward_background,
+        timing_record=args.timing_record,
+        timing_replay=args.timing_replay[0]
+            if args.timing_replay else None,
+        multi_session=args.multi_session,
+        clock=VirtualClock() if args.virtual_clock else None,
+        metrics_port=args.metrics_port[0] if args.metrics_port else None)
 
     if os.name != 'nt':
         if os.getuid() == 0:
             daemon_pid_fname = DAEMON_PIDFILE_DIR_ROOT + DAEMON_PIDFILE
         else:
             daemon_pid_fname = DAEMON_PIDFILE_DIR_NON_ROOT + DAEMON_PIDFILE
-        pidfile = daemon.pidfile.PIDLockFile(daemon_pid_fname)
-        pid = pidfile.read_pid()
+        pid = read_pid_from_pidfile(daemon_pid_fname)
 
     if args.terminate:
         if pid:
@@ -1186,7 +1533,28 @@ def main():
             print('Cannot terminate daemon process: not running.')
             sys.exit(0)
 
+    def toggle_profiler(signum, frame):
+        """
+        SIGUSR1 handler in daemon mode: start the profiler, or stop it and
+        dump the samples to DAEMON_PROFILE_FILE in DAEMON_DIR.
+        """
+        profiler = emulator.profiler
+        if profiler.stop():
+            fname = os.path.join(DAEMON_DIR, DAEMON_PROFILE_FILE)
+            try:
+                n = profiler.dump(fname)
+                logging.warning("Profiler stopped: %s samples written to %s",
+                                n, fname)
+            except Exception as e:
+                logging.error("Cannot write profiler file %s: %s", fname, e)
+            profiler.clear()
+        elif emulator.run_thread_id is not None:
+            profiler.start(emulator.run_thread_id, args.profile_rate[0])
+            logging.warning("Profiler started.")
+
     if args.batch_mode and args.daemon_mode:
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, toggle_profiler)
         try:
             print(emulator.get_pty())
             print('ELM327-emulator service STARTED')
@@ -1199,6 +1567,17 @@ def main():
         sys.exit(0)
 
     if args.daemon_mode and not args.batch_mode:
+        try:
+            import daemon
+            import daemon.pidfile
+        except ImportError as detail:
+            print(
+                "ELM327 OBD-II adapter emulator import error:\n "
+                + str(detail)
+                + "\nInstall prerequisites before running the product."
+                )
+            sys.exit(1)
+        pidfile = daemon.pidfile.PIDLockFile(daemon_pid_fname)
         if pid:
             try:
                 pidfile.acquire()
@@ -1223,7 +1602,8 @@ def main():
             stderr=sys.stderr,
             signal_map={
                 signal.SIGTERM: lambda signum, frame: emulator.terminate(),
-                signal.SIGINT: lambda signum, frame: emulator.terminate()
+                signal.SIGINT: lambda signum, frame: emulator.terminate(),
+                signal.SIGUSR1: toggle_profiler
                 }
             )
         try:
@@ -1266,6 +1646,7 @@ def main():
             p_elm = Interpreter(session, args)
             if args.log:
                 logging.getLogger().handlers[0].setLevel(int(args.log[0]))
+                session.update_log_level()
             if args.batch_mode:
                 p_elm.cmdloop_with_keyboard_interrupt(
                     'ELM327-emulator batch mode STARTED\n'
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+###########################################################################
+# ELM327-emulator
+# ELM327 Emulator for testing software interfacing OBDII via ELM327 adapter
+# https://github.com/Ircama/ELM327-emulator
+# (C) Ircama 2021 - CC-BY-NC-SA-4.0
+###########################################################################
+
+"""
+Metrics of the emulator in Prometheus text format, served by an HTTP
+listener running in its own thread (ref. Elm metrics_port argument).
+
+Metrics are read from snapshots of the session statistics and from the
+latency histograms, without locking the thread processing the requests.
+"""
+
+import logging
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from .elm import is_unknown_counter, COUNTER_NAMES, COMMANDS_ID
+from .__version__ import __version__
+
+METRICS_HOST = "127.0.0.1"  # local interface used by the HTTP listener
+METRICS_PATHS = ('/', '/metrics')
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def label(value):
+    """
+    Escape a label value.
+    """
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def session_name(session):
+    """
+    Return the label of a session: "default" or the address of the client.
+    """
+    if session.peer is None:
+        return "default"
+    try:
+        return "%s:%s" % session.peer[:2]
+    except TypeError:
+        return str(session.peer)
+
+
+def histogram_lines(lines, name, histograms, label_name):
+    """
+    Add the lines of a summary metric computed from LatencyHistogram
+    objects (seconds).
+    :param lines: list of output lines
+    :param name: metric name
+    :param histograms: list of (label value, LatencyHistogram) tuples
+    :param label_name: label name
+    """
+    for key, h in histograms:
+        count = h.count
+        if not count:
+            continue
+        key = label(key)
+        for q in QUANTILES:
+            lines.append('%s{%s="%s",quantile="%s"} %.9f' % (
+                name, label_name, key, q, h.percentile(q) / 1e9))
+        lines.append('%s_sum{%s="%s"} %.9f' % (
+            name, label_name, key, h.total / 1e9))
+        lines.append('%s_count{%s="%s"} %d' % (name, label_name, key, count))
+
+
+def render_metrics(emulator):
+    """
+    Return the metrics of an emulator in Prometheus text format.
+    :param emulator: Elm object
+    :return: string
+    """
+    sessions = [emulator.default_session] + list(emulator.sessions)
+    snapshots = [(session_name(s), s, s.statistics.snapshot())
+                 for s in sessions]
+    lines = [
+        '# HELP elm_info ELM327-emulator information.',
+        '# TYPE elm_info gauge',
+        'elm_info{version="%s",scenario="%s"} 1' % (
+            label(__version__), label(emulator.scenario)),
+        '# HELP elm_sessions Number of connected client sessions.',
+        '# TYPE elm_sessions gauge',
+        'elm_sessions %d' % len(emulator.sessions),
+        '# HELP elm_requests_total Number of processed requests.',
+        '# TYPE elm_requests_total counter',
+    ]
+    for name, session, snapshot in snapshots:
+        counts = snapshot.counts
+        lines.append('elm_requests_total{session="%s"} %d' % (
+            label(name), (counts[COMMANDS_ID] or 0) if counts else 0))
+
+    lines += [
+        '# HELP elm_pid_requests_total Number of requests of each PID.',
+        '# TYPE elm_pid_requests_total counter',
+    ]
+    for name, session, snapshot in snapshots:
+        counts = list(snapshot.counts)
+        for i, value in enumerate(counts):
+            if i == COMMANDS_ID or not isinstance(value, int):
+                continue
+            lines.append('elm_pid_requests_total{session="%s",pid="%s"} %d'
+                         % (label(name), label(COUNTER_NAMES[i]), value))
+
+    lines += [
+        '# HELP elm_unknown_requests_total Number of each unknown request.',
+        '# TYPE elm_unknown_requests_total counter',
+    ]
+    for name, session, snapshot in snapshots:
+        for key, value in snapshot.unknown.items():
+            if is_unknown_counter(key) and isinstance(value, int):
+                lines.append(
+                    'elm_unknown_requests_total{session="%s",request="%s"} '
+                    '%d' % (label(name), label(key[len('unknown_'):]), value))
+    lines += [
+        '# HELP elm_unknown_counters_evicted_total Number of unknown request '
+        'counters removed from the LRU table.',
+        '# TYPE elm_unknown_counters_evicted_total counter',
+    ]
+    for name, session, snapshot in snapshots:
+        lines.append('elm_unknown_counters_evicted_total{session="%s"} %d' % (
+            label(name), session.statistics.evicted))
+
+    lines += [
+        '# HELP elm_active_tasks Number of active tasks of each ECU.',
+        '# TYPE elm_active_tasks gauge',
+    ]
+    for name, session, snapshot in snapshots:
+        for ecu, tasks in list(session.tasks.items()):
+            lines.append('elm_active_tasks{session="%s",ecu="%s"} %d' % (
+                label(name), label(ecu), len(tasks)))
+
+    lines += [
+        '# HELP elm_output_queue_depth Number of deferred writes '
+        '(multi-session mode).',
+        '# TYPE elm_output_queue_depth gauge',
+    ]
+    for name, session, snapshot in snapshots:
+        lines.append('elm_output_queue_depth{session="%s"} %d' % (
+            label(name), len(session.out_queue)))
+
+    forward_queue = emulator.forward_queue
+    lines += [
+        '# HELP elm_forward_queue_depth Number of requests waiting for '
+        'background forwarding.',
+        '# TYPE elm_forward_queue_depth gauge',
+        'elm_forward_queue_depth %d' % (len(forward_queue)
+                                        if forward_queue else 0),
+        '# HELP elm_forward_dropped_total Number of requests not forwarded '
+        'because the background queue was full.',
+        '# TYPE elm_forward_dropped_total counter',
+        'elm_forward_dropped_total %d' % (forward_queue.dropped
+                                          if forward_queue else 0),
+    ]
+
+    targets = emulator.forwarder.targets if emulator.forwarder else []
+    lines += [
+        '# HELP elm_forward_target_up Whether the connection to each '
+        'OBD-II interface of the forwarder is open.',
+        '# TYPE elm_forward_target_up gauge',
+    ]
+    for target in targets:
+        lines.append('elm_forward_target_up{target="%s"} %d' % (
+            label(target.name), target.connected))
+    lines += [
+        '# HELP elm_forward_target_errors_total Number of failures of each '
+        'OBD-II interface of the forwarder.',
+        '# TYPE elm_forward_target_errors_total counter',
+    ]
+    for target in targets:
+        lines.append('elm_forward_target_errors_total{target="%s"} %d' % (
+            label(target.name), target.errors))
+
+    lines += [
+        '# HELP elm_request_duration_seconds Processing time of the '
+        'requests of each PID.',
+        '# TYPE elm_request_duration_seconds summary',
+    ]
+    histogram_lines(
+        lines, 'elm_request_duration_seconds',
+        [("(unknown)" if k is None else k, h)
+         for k, h in list(emulator.latency.items())], 'pid')
+    lines += [
+        '# HELP elm_task_duration_seconds Processing time of each plugin '
+        'task method.',
+        '# TYPE elm_task_duration_seconds summary',
+    ]
+    histogram_lines(lines, 'elm_task_duration_seconds',
+                    list(emulator.task_latency.items()), 'task')
+    lines += [
+        '# HELP elm_forward_roundtrip_seconds Round-trip time of the '
+        'requests forwarded to the OBD-II interface.',
+        '# TYPE elm_forward_roundtrip_seconds summary',
+    ]
+    histogram_lines(lines, 'elm_forward_roundtrip_seconds',
+                    [("forwarder", emulator.forward_latency)], 'forwarder')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    HTTP request handler returning the metrics of self.server.emulator.
+    """
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in METRICS_PATHS:
+            self.send_error(404)
+            return
+        try:
+            body = render_metrics(self.server.emulator).encode()
+        except Exception as e:
+            logging.error("Cannot compute the metrics: %s", e)
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Metrics request from %s: " + format,
+                      self.address_string(), *args)
+
+
+def start_metrics_server(emulator, port, host=METRICS_HOST):
+    """
+    Start the HTTP listener of the metrics in a daemon thread.
+    :param emulator: Elm object
+    :param port: TCP port
+    :param host: listening address (default is the local interface)
+    :return: HTTPServer object (to be stopped with shutdown()), or None
+        if the port cannot be opened
+    """
+    try:
+        server = HTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        logging.error("Cannot open the metrics port %s: %s", port, e)
+        return None
+    server.emulator = emulator
+    thread = threading.Thread(
+        target=server.serve_forever, name="ELM327-emulator metrics")
+    thread.daemon = True
+    thread.start()
+    logging.debug("Metrics available at http://%s:%s/metrics", host, port)
+    return server
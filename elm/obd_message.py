@@ -214,7 +214,7 @@ ObdMessage = {
         'AT_DESCRIBE_PROTO': {
             'Request': '^ATDP$',
             'Descr': 'AT set DESCRIBE PROTO',
-            'Exec': 'time.sleep(0.5)',
+            'Exec': 'self.sleep(0.5)',
             'ResponseHeader': \
                 lambda self, cmd, pid, uc_val: \
                     ST('AUTO, ISO 15765-4 (CAN 11/500) ') \
@@ -227,7 +227,7 @@ ObdMessage = {
         'AT_DESCRIBE_PROTO_N': {
             'Request': '^ATDPN$',
             'Descr': 'AT Display Protocol Number',
-            'Exec': 'time.sleep(0.5)',
+            'Exec': 'self.sleep(0.5)',
             'Response': ST("A6")
         },
         'AT_ECHO': {
@@ -523,7 +523,7 @@ ObdMessage = {
         'ST_REPORT_PROTOCOL': {
             'Request': '^STPR$',
             'Descr': 'ST Report current protocol number.',
-            'Exec': 'time.sleep(0.5)',
+            'Exec': 'self.sleep(0.5)',
             'Response': ST("A6")
         },
         'ST_DI': {
@@ -593,7 +593,7 @@ ObdMessage = {
             'ResponseHeader': \
             lambda self, cmd, pid, uc_val: \
                 '<string>SEARCHING...</string>'
-                '<exec>time.sleep(4.5)</exec>' + ST('') + \
+                '<exec>self.sleep(4.5)</exec>' + ST('') + \
                 ST('UNABLE TO CONNECT') \
                 if self.counters[pid] == 1 else \
                 self.choice([ST('NO DATA'), ST('BUS INIT:ERROR')]),
@@ -605,7 +605,7 @@ ObdMessage = {
             'ResponseHeader': \
             lambda self, cmd, pid, uc_val: \
                 '<string>SEARCHING...</string>'
-                '<exec>time.sleep(4.5)</exec>' + ST('') + \
+                '<exec>self.sleep(4.5)</exec>' + ST('') + \
                 ST('UNABLE TO CONNECT') \
                 if self.counters[pid] == 1 else \
                 self.choice([ST('NO DATA'), ST('BUS INIT:ERROR')]),
@@ -614,7 +614,7 @@ ObdMessage = {
         'AT_DESCRIBE_PROTO_N': {
             'Request': '^ATDPN$',
             'Descr': 'set DESCRIBE_PROTO_N',
-            'Exec': 'time.sleep(0.5)',
+            'Exec': 'self.sleep(0.5)',
             'Response': ST("A0")
         },
         'NO_DATA': {
@@ -779,7 +779,7 @@ ObdMessage = {
             'ResponseHeader': \
                 lambda self, cmd, pid, uc_val: \
                     '<string>SEARCHING...</string>'
-                    '<exec>time.sleep(3)</exec>' + ST('') \
+                    '<exec>self.sleep(3)</exec>' + ST('') \
                         if self.counters[pid] == 1 else "",
             'Response':
             HD(ECU_R_ADDR_H) + SZ('06') + DT('41 00 98 3A 80 13') +
@@ -4575,7 +4575,7 @@ def generate_dynamic_pids_entries(scenario_dict: Dict[str, Dict[str, Any]], serv
             pids_entries[entry_name]["ResponseHeader"] = \
                 lambda self, cmd, pid, uc_val: \
                     "<string>SEARCHING...</string>" \
-                    "<exec>time.sleep(1.5)</exec>" + ST('') \
+                    "<exec>self.sleep(1.5)</exec>" + ST('') \
                         if self.counters[pid] == 1 else ''
 
     return pids_entries
@@ -9,7 +9,6 @@
 ###########################################################################
 
 from elm import Tasks
-import time
 
 EXECUTION_TIME = 0.5 # seconds
 
@@ -19,7 +18,7 @@ EXECUTION_TIME = 0.5 # seconds
 # FF 00, erase_memory (RID)
 class Task(Tasks):
     def run(self, cmd, *_):
-        if time.time() < self.time_started + EXECUTION_TIME:
+        if self.emulator.clock.time() < self.time_started + EXECUTION_TIME:
             # 78 in negative answer = requestCorrectlyReceived-ResponsePending
             return (self.NA('78'),
                     Tasks.RETURN.CONTINUE,
@@ -9,7 +9,6 @@
 ###########################################################################
 
 from elm import Tasks
-import time
 
 EXECUTION_TIME = 0.5 # seconds
 
@@ -23,7 +22,7 @@ class Task(Tasks):
         return self.run(cmd)
 
     def run(self, cmd, *_):
-        if time.time() < self.time_started + EXECUTION_TIME:
+        if self.emulator.clock.time() < self.time_started + EXECUTION_TIME:
             # 78 in negative answer = requestCorrectlyReceived-ResponsePending
             return (self.NA('78'),
                     Tasks.RETURN.CONTINUE,
@@ -9,7 +9,6 @@
 ###########################################################################
 
 from elm import Tasks
-import time
 
 EXECUTION_TIME = 0.5 # seconds
 
@@ -17,7 +16,7 @@ EXECUTION_TIME = 0.5 # seconds
 # UDS - MODE 11 - ECU Reset - hardReset
 class Task(Tasks):
     def run(self, cmd, *_):
-        if time.time() < self.time_started + EXECUTION_TIME:
+        if self.emulator.clock.time() < self.time_started + EXECUTION_TIME:
             # 78 in negative answer = requestCorrectlyReceived-ResponsePending
             return (self.NA('78'),
                     Tasks.RETURN.CONTINUE,
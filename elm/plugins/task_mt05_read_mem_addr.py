@@ -8,7 +8,6 @@
 # (C) Ircama 2021 - CC-BY-NC-SA-4.0
 ###########################################################################
 
-import time
 from elm import Tasks
 
 MEM_RANGE = 0x3fffff
@@ -60,7 +59,7 @@ class Task(Tasks):
             self.logging.info(
                 'Just executed routine %s.', self.shared.executed_routine)
             self.shared.executed_routine = False
-            time.sleep(0.3)
+            self.emulator.sleep(0.3)
 
         # Terminate the task returning a positive answer
         return Task.RETURN.ANSWER(self.PA(data.strip()))
@@ -9,7 +9,6 @@
 ###########################################################################
 
 from elm import Tasks
-import time
 
 EXECUTION_TIME = 0.5 # seconds
 SEED = 'A641B5E9'
@@ -18,7 +17,7 @@ SEED = 'A641B5E9'
 # UDS - MODE 27 - Security Access - 11=request seed
 class Task(Tasks):
     def run(self, cmd, *_):
-        if time.time() < self.time_started + EXECUTION_TIME:
+        if self.emulator.clock.time() < self.time_started + EXECUTION_TIME:
             # 78 in negative answer = requestCorrectlyReceived-ResponsePending
             return (self.NA('78'),
                     Tasks.RETURN.CONTINUE,